@@ -0,0 +1,318 @@
+import asyncio
+import fcntl
+import math
+import os
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from cache_store import connect_database
+from config import Cache, Model, Refresh
+from metrics import ANSWER_REFRESHES
+from models import StreamSearchResponse
+from query_cache import QueryCache
+from rate_limiter import RateLimiter, TokenBucket
+from tracing import print_log
+
+
+def log2_add(a: float, b: float) -> float:
+    """log2(2^a + 2^b) without overflow."""
+    high, low = max(a, b), min(a, b)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+class QueryPopularity:
+    """
+    Popularity of prompts, as hit counts decaying with Refresh.POPULARITY_HALF_LIFE_SECS, kept in the
+    node-wide SQLite database so it is shared by workers and survives restarts.
+
+    Hits are stored with forward decay: each hit at time t adds 2^(t / half_life) to a prompt's
+    weight, kept as its log2. Weights never need rewriting as time passes, ordering by weight is
+    ordering by decayed count at any time, so the top prompts are an index scan. Methods block on
+    disk I/O; call them from a worker thread.
+    """
+
+    def __init__(self, path: str, half_life_secs: float, max_entries: int):
+        self.path = path
+        self.half_life_secs = half_life_secs
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._connect()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect_database(self.path)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_popularity ("
+                "key TEXT PRIMARY KEY, prompt TEXT NOT NULL, log_weight REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS query_popularity_weight ON query_popularity (log_weight)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS refresh_failures ("
+                "key TEXT PRIMARY KEY, failures INTEGER NOT NULL, retry_at REAL NOT NULL)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def record(self, hits: Dict[str, Tuple[str, int]]):
+        """Add hits, by normalized prompt, of (latest prompt, number of hits)."""
+        conn = self._connect()
+        now_exponent = time.time() / self.half_life_secs
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for key, (prompt, num_hits) in hits.items():
+                row = conn.execute("SELECT log_weight FROM query_popularity WHERE key = ?", (key,)).fetchone()
+                log_weight = now_exponent + math.log2(num_hits)
+                if row is not None:
+                    log_weight = log2_add(row[0], log_weight)
+                conn.execute("INSERT OR REPLACE INTO query_popularity VALUES (?, ?, ?)", (key, prompt, log_weight))
+            # Forget the least popular prompts beyond the limit
+            conn.execute(
+                "DELETE FROM query_popularity WHERE key IN ("
+                "SELECT key FROM query_popularity ORDER BY log_weight DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            conn.execute("DELETE FROM refresh_failures WHERE key NOT IN (SELECT key FROM query_popularity)")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def top(self, limit: int, min_hits: float) -> List[Tuple[str, str, float]]:
+        """The most popular (key, prompt, decayed hits), best first, with at least min_hits."""
+        now_exponent = time.time() / self.half_life_secs
+        rows = (
+            self._connect()
+            .execute(
+                "SELECT key, prompt, log_weight FROM query_popularity WHERE log_weight >= ? "
+                "ORDER BY log_weight DESC LIMIT ?",
+                (now_exponent + math.log2(min_hits), limit),
+            )
+            .fetchall()
+        )
+        return [(key, prompt, 2 ** (log_weight - now_exponent)) for key, prompt, log_weight in rows]
+
+    def record_failure(self, key: str, backoff_secs: float, max_backoff_secs: float) -> float:
+        """
+        Count a failed refresh of a prompt, which is not retried for backoff_secs, doubling with each
+        consecutive failure up to max_backoff_secs. Returns the time it may be retried.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT failures FROM refresh_failures WHERE key = ?", (key,)).fetchone()
+            failures = (row[0] if row is not None else 0) + 1
+            retry_at = time.time() + min(backoff_secs * 2 ** (failures - 1), max_backoff_secs)
+            conn.execute("INSERT OR REPLACE INTO refresh_failures VALUES (?, ?, ?)", (key, failures, retry_at))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return retry_at
+
+    def clear_failures(self, key: str):
+        self._connect().execute("DELETE FROM refresh_failures WHERE key = ?", (key,))
+
+    def failures(self) -> Dict[str, float]:
+        """Prompts with a failed refresh, by the time each may be retried, including those already due."""
+        return dict(self._connect().execute("SELECT key, retry_at FROM refresh_failures").fetchall())
+
+
+class LeaderLock:
+    """
+    Non-blocking exclusive flock on a file, held by at most one process on the node. The OS releases
+    it when the holder exits, so another worker takes over after a recycle on its next attempt.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class AnswerRefresher:
+    """
+    Keeps the answers to popular prompts warm in the query cache.
+
+    Every worker counts the prompts looked up by /stream_search and flushes the counts to the
+    shared popularity table. One worker per node, the holder of the leader lock, periodically walks
+    the most popular prompts and reruns the pipeline for those whose answer is missing (pre-warming
+    after a restart or eviction) or within Refresh.AHEAD_SECS of expiring, while the old answer keeps
+    being served (stale-while-revalidate). Refreshes run one at a time, within hourly token and
+    search budgets, and only while the LLM quota has Refresh.MIN_LLM_HEADROOM to spare, so they
+    never hold up live requests. Only refreshes whose search results are not fresh in the search
+    cache are charged to the search budget. A prompt whose refresh fails to produce an answer, e.g.
+    one with no search results, backs off from Refresh.FAILURE_BACKOFF_SECS rather than spending
+    budget every round.
+    """
+
+    # Seconds between flushes of the counted hits to the popularity table
+    FLUSH_INTERVAL_SECS = 10
+    # Delay before the first pre-warm, so a starting worker serves requests first
+    STARTUP_DELAY_SECS = 10
+
+    def __init__(
+        self,
+        query_cache: QueryCache,
+        refresh: Callable[[str, str], Awaitable[Optional[StreamSearchResponse]]],
+        search_cached: Callable[[str], Awaitable[bool]],
+        llm_rate_limiter: RateLimiter,
+        expected_tokens: int,
+    ):
+        self.query_cache = query_cache
+        self.refresh = refresh
+        self.search_cached = search_cached
+        self.llm_rate_limiter = llm_rate_limiter
+        self.expected_tokens = expected_tokens
+        self.popularity = QueryPopularity(
+            Cache.CACHE_DB_PATH, Refresh.POPULARITY_HALF_LIFE_SECS, Refresh.POPULARITY_MAX_ENTRIES
+        )
+        self.leader = LeaderLock(Cache.CACHE_DB_PATH + ".refresh.lock")
+        self.token_budget = TokenBucket(Refresh.TOKENS_PER_HOUR, Refresh.TOKENS_PER_HOUR / 3600)
+        self.search_budget = TokenBucket(Refresh.SEARCHES_PER_HOUR, Refresh.SEARCHES_PER_HOUR / 3600)
+        self.pending_hits: Dict[str, Tuple[str, int]] = {}
+        self.tasks: List[asyncio.Task] = []
+        self.refreshed = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def record_hit(self, cache_key: str, user_prompt: str):
+        """Count a lookup of a prompt, O(1) in memory until the next flush."""
+        _, num_hits = self.pending_hits.get(cache_key, (None, 0))
+        self.pending_hits[cache_key] = (user_prompt, num_hits + 1)
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._flush_loop()), asyncio.create_task(self._refresh_loop())]
+
+    async def aclose(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.flush()
+        self.leader.release()
+
+    async def flush(self):
+        hits, self.pending_hits = self.pending_hits, {}
+        if hits:
+            try:
+                await asyncio.to_thread(self.popularity.record, hits)
+            except Exception as e:
+                print_log(f"Error recording query popularity: {e}")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.FLUSH_INTERVAL_SECS)
+            await self.flush()
+
+    async def _refresh_loop(self):
+        await asyncio.sleep(self.STARTUP_DELAY_SECS)
+        while True:
+            if self.leader.try_acquire():
+                try:
+                    await self.refresh_popular()
+                except Exception as e:
+                    print_log(f"Error refreshing popular answers: {e}")
+            await asyncio.sleep(Refresh.INTERVAL_SECS)
+
+    def is_due(self, cached_response: Optional[dict]) -> bool:
+        if cached_response is None:
+            return True
+        # Answers cached before cached_at was recorded are as good as expiring
+        age_secs = time.time() - cached_response.get("cached_at", 0)
+        return age_secs >= Cache.QUERY_CACHE_TTL_SECS - Refresh.AHEAD_SECS
+
+    async def refresh_popular(self):
+        """Refresh the due answers among the most popular prompts, most popular first, until out of budget."""
+        popular = await asyncio.to_thread(self.popularity.top, Refresh.TOP_N, Refresh.MIN_HITS)
+        failures = await asyncio.to_thread(self.popularity.failures)
+        for cache_key, user_prompt, num_hits in popular:
+            if failures.get(cache_key, 0) > time.time():
+                continue
+            if not self.is_due(await self.query_cache.apeek(cache_key)):
+                continue
+            num_searches = 0 if await self.search_cached(user_prompt) else 1
+            if self.search_budget.available() < num_searches or self.token_budget.available() < self.expected_tokens:
+                ANSWER_REFRESHES.labels("over_budget").inc()
+                self.skipped += 1
+                return
+            if await self.llm_rate_limiter.headroom() < Refresh.MIN_LLM_HEADROOM:
+                ANSWER_REFRESHES.labels("busy").inc()
+                self.skipped += 1
+                return
+
+            self.search_budget.consume(num_searches)
+            self.token_budget.consume(self.expected_tokens)
+            print_log(f"Refreshing answer for: {user_prompt} ({num_hits:.1f} recent hits)")
+            try:
+                response = await self.refresh(user_prompt, cache_key)
+            except Exception as e:
+                print_log(f"Error refreshing answer for: {user_prompt}: {e}")
+                response = None
+            if response is None or response.error is not None:
+                ANSWER_REFRESHES.labels("failed").inc()
+                self.failed += 1
+                retry_at = await asyncio.to_thread(
+                    self.popularity.record_failure,
+                    cache_key,
+                    Refresh.FAILURE_BACKOFF_SECS,
+                    Refresh.MAX_FAILURE_BACKOFF_SECS,
+                )
+                print_log(f"Refresh failed for: {user_prompt}, retrying in {retry_at - time.time():.0f}s")
+            else:
+                ANSWER_REFRESHES.labels("refreshed").inc()
+                self.refreshed += 1
+                if cache_key in failures:
+                    await asyncio.to_thread(self.popularity.clear_failures, cache_key)
+            # Settle the token budget against actual usage
+            used_tokens = (response.token_usage or {}).get("total_tokens", 0) if response is not None else 0
+            self.token_budget.consume(used_tokens - self.expected_tokens)
+
+    def stats(self) -> dict:
+        return {
+            "leader": self.leader.held,
+            "refreshed": self.refreshed,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "token_budget": round(self.token_budget.available()),
+            "search_budget": round(self.search_budget.available(), 1),
+        }
+
+
+def create_answer_refresher(
+    query_cache: QueryCache,
+    refresh: Callable[[str, str], Awaitable[Optional[StreamSearchResponse]]],
+    search_cached: Callable[[str], Awaitable[bool]],
+    llm_rate_limiter: RateLimiter,
+    expected_completion_tokens: int,
+) -> Optional[AnswerRefresher]:
+    """The answer refresher, or None when disabled or there is no node-wide database to share popularity in."""
+    if not Refresh.ENABLED or not Cache.CACHE_DB_PATH:
+        return None
+    return AnswerRefresher(
+        query_cache,
+        refresh,
+        search_cached,
+        llm_rate_limiter,
+        Model.PROMPT_TOKEN_BUDGET + expected_completion_tokens,
+    )
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Benchmark the HTML extractors in extractors.py on a corpus of saved webpages.
+
+    python benchmarks/bench_extractors.py --save https://en.wikipedia.org/wiki/Rust_(programming_language) ...
+    python benchmarks/bench_extractors.py [--corpus DIR] [--repeat N] [--limit-tokens N]
+
+Pages are saved as .html files in the corpus directory (benchmarks/pages by default). When the
+corpus is empty, synthetic pages are generated so the benchmark still runs offline.
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extractors import EXTRACTORS  # noqa: E402
+
+DEFAULT_CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pages")
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36'
+
+
+def save_pages(urls, corpus_dir):
+    import httpx
+
+    os.makedirs(corpus_dir, exist_ok=True)
+    with httpx.Client(headers={"User-Agent": USER_AGENT}, follow_redirects=True, timeout=10) as client:
+        for url in urls:
+            response = client.get(url)
+            response.raise_for_status()
+            path = os.path.join(corpus_dir, hashlib.sha1(url.encode()).hexdigest()[:12] + ".html")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(response.text)
+            print(f"saved {url} -> {path} ({len(response.text)} chars)")
+
+
+def synthetic_pages(num_pages=20, seed=0):
+    rng = random.Random(seed)
+    words = [f"word{i}" for i in range(2000)]
+    pages = []
+    for _ in range(num_pages):
+        parts = ["<html><head><style>body { color: red }</style><script>var x = 1;</script></head><body>"]
+        parts.append("<nav>" + "".join(f"<a href='/{i}'>link {i}</a>" for i in range(200)) + "</nav>")
+        for _ in range(rng.randint(20, 300)):
+            sentence = " ".join(rng.choices(words, k=rng.randint(10, 80)))
+            parts.append(f"<div class='c'><p>{sentence} <b>bold</b> <a href='#'>ref</a></p></div>")
+        parts.append("<script>" + "x();" * 2000 + "</script></body></html>")
+        pages.append("".join(parts))
+    return pages
+
+
+def load_pages(corpus_dir):
+    if not os.path.isdir(corpus_dir):
+        return []
+    pages = []
+    for name in sorted(os.listdir(corpus_dir)):
+        if name.endswith(".html"):
+            with open(os.path.join(corpus_dir, name), encoding="utf-8", errors="replace") as f:
+                pages.append(f.read())
+    return pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS_DIR)
+    parser.add_argument("--save", nargs="+", metavar="URL", help="download pages into the corpus and exit")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--limit-tokens", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.save:
+        save_pages(args.save, args.corpus)
+        return
+
+    pages = load_pages(args.corpus)
+    if not pages:
+        print(f"No pages in {args.corpus}, using synthetic pages")
+        pages = synthetic_pages()
+    total_chars = sum(len(page) for page in pages)
+    print(f"{len(pages)} pages, {total_chars / 1e6:.1f}M chars, limit {args.limit_tokens} tokens\n")
+
+    outputs = {}
+    print(f"{'extractor':<10} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'MB/s':>8}")
+    for name, extractor_cls in EXTRACTORS.items():
+        extractor = extractor_cls()
+        timings = []
+        for _ in range(args.repeat):
+            for page in pages:
+                start = time.perf_counter()
+                extractor.extract(page, args.limit_tokens)
+                timings.append((time.perf_counter() - start) * 1000)
+        outputs[name] = [
+            " ".join(extractor.extract(page, args.limit_tokens).split()[: args.limit_tokens]) for page in pages
+        ]
+        p95 = statistics.quantiles(timings, n=20)[-1] if len(timings) > 1 else timings[0]
+        throughput = total_chars * args.repeat / (sum(timings) / 1000) / 1e6
+        mean, median = statistics.mean(timings), statistics.median(timings)
+        print(f"{name:<10} {mean:>9.2f} {median:>9.2f} {p95:>9.2f} {throughput:>8.1f}")
+
+    # Word overlap with the reference BeautifulSoup output, as a sanity check on extraction quality
+    if "soup" in outputs:
+        print()
+        for name, texts in outputs.items():
+            if name == "soup":
+                continue
+            overlaps = []
+            for text, reference in zip(texts, outputs["soup"]):
+                a, b = set(text.split()), set(reference.split())
+                overlaps.append(len(a & b) / len(a | b) if a | b else 1.0)
+            print(f"{name} vs soup word overlap: mean {statistics.mean(overlaps):.2f}, min {min(overlaps):.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks of the CPU spent per request outside the network: HTML extraction, escaping of
+scraped documents, token counting and truncation, passage selection, prompt building and the
+JSON encoding of each streamed frame.
+
+    python benchmarks/bench_hot_path.py [--filter tokens] [--corpus DIR] [--min-time 0.5]
+    python benchmarks/bench_hot_path.py --json after.json --compare before.json
+
+Like pytest-benchmark, each benchmark is calibrated to run enough iterations per round to fill
+--min-round-ms, then timed over rounds for at least --min-time seconds, and reported as the min,
+median and mean time per call and calls per second. --compare prints the change against a previous
+--json run. Inputs are 8 result pages from the extractor corpus (or synthetic ones), a typical
+request's worth.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Importing the app only needs the secrets to be set, nothing is called upstream
+for name in ("GOOGLE_SEARCH_API_KEY", "GOOGLE_SEARCH_ENGINE_ID", "GROQ_API_KEY"):
+    os.environ.setdefault(name, "benchmark")
+os.environ.setdefault("CACHE_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="perplexed-bench-"), "cache.sqlite3"))
+
+import tokenizer  # noqa: E402
+from bench_extractors import DEFAULT_CORPUS_DIR, load_pages, synthetic_pages  # noqa: E402
+from extractors import EXTRACTORS  # noqa: E402
+from models import SearchAllStage, StreamSearchResponse  # noqa: E402
+from search import (  # noqa: E402
+    WEBSEARCH_CONTENT_LIMIT_TOKENS,
+    WEBSEARCH_READ_CHUNK_BYTES,
+    WebSearchDocument,
+    build_chatbot_messages,
+    prepare_chatbot_messages,
+    select_passages,
+)
+from stream_frames import FrameEncoder  # noqa: E402
+
+USER_PROMPT = "how do rust's ownership and borrowing rules prevent data races"
+NUM_DOCS = 8
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a benchmark: a function of the inputs returning the callable to time."""
+
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def cold_tokens(fn):
+    """Clear the token cache before each call, as every request sees new document texts."""
+
+    def call():
+        tokenizer.encode.cache_clear()
+        return fn()
+
+    return call
+
+
+class Inputs:
+    def __init__(self, pages):
+        self.pages = pages[:NUM_DOCS]
+        extractor = EXTRACTORS["lxml"]()
+        self.texts = [extractor.extract(page, WEBSEARCH_CONTENT_LIMIT_TOKENS) for page in self.pages]
+        self.docs = [
+            WebSearchDocument(id=i + 1, title=f"Result {i + 1} <b>title</b>", url=f"https://example.com/{i}", text=text)
+            for i, text in enumerate(self.texts)
+        ]
+        self.search_frame = StreamSearchResponse(
+            stage=SearchAllStage.SEARCH, data={"results": [doc.to_dict() for doc in self.docs]}
+        )
+        answer = " ".join(self.texts[0].split()[:400])
+        self.stream_frame = StreamSearchResponse(
+            stage=SearchAllStage.LLM_STREAM, data={"delta": answer[-80:], "response": answer}
+        )
+        self.final_frame = StreamSearchResponse(
+            stage=SearchAllStage.LLM,
+            data={"response": answer, "sources": [{"title": doc.title, "url": doc.url} for doc in self.docs]},
+            token_usage={"prompt_tokens": 4000, "completion_tokens": 400, "total_tokens": 4400},
+        )
+
+
+for extractor_name, extractor_cls in EXTRACTORS.items():
+
+    @benchmark(f"extract[{extractor_name}]")
+    def bench_extract(inputs, extractor=extractor_cls()):
+        return lambda: [extractor.extract(page, WEBSEARCH_CONTENT_LIMIT_TOKENS) for page in inputs.pages]
+
+
+@benchmark("extract[streamed session]")
+def bench_extract_session(inputs):
+    extractor = EXTRACTORS["lxml"]()
+    chunk_chars = WEBSEARCH_READ_CHUNK_BYTES
+
+    def run():
+        for page in inputs.pages:
+            session = extractor.session(WEBSEARCH_CONTENT_LIMIT_TOKENS)
+            for start in range(0, len(page), chunk_chars):
+                if session.feed(page[start : start + chunk_chars]):
+                    break
+            session.close()
+
+    return run
+
+
+@benchmark("html_escape[WebSearchDocument]")
+def bench_documents(inputs):
+    return lambda: [
+        WebSearchDocument(id=i + 1, title="Result title", url="https://example.com", text=text)
+        for i, text in enumerate(inputs.texts)
+    ]
+
+
+@benchmark("count_tokens[cold]")
+def bench_count_tokens(inputs):
+    return cold_tokens(lambda: [tokenizer.count_tokens(doc.text) for doc in inputs.docs])
+
+
+@benchmark("count_tokens[cached]")
+def bench_count_tokens_cached(inputs):
+    return lambda: [tokenizer.count_tokens(doc.text) for doc in inputs.docs]
+
+
+@benchmark("limit_tokens[cold]")
+def bench_limit_tokens(inputs):
+    return cold_tokens(lambda: [tokenizer.limit_tokens(doc.text, 500) for doc in inputs.docs])
+
+
+@benchmark("select_passages")
+def bench_select_passages(inputs):
+    return lambda: select_passages(USER_PROMPT, inputs.docs)
+
+
+@benchmark("build_chatbot_messages[cold]")
+def bench_build_messages(inputs):
+    return cold_tokens(lambda: build_chatbot_messages(USER_PROMPT, inputs.docs))
+
+
+@benchmark("prepare_chatbot_messages[cold]")
+def bench_prepare_messages(inputs):
+    return cold_tokens(lambda: prepare_chatbot_messages(USER_PROMPT, inputs.docs))
+
+
+def encode_frames(inputs, delta: bool, stage_response):
+    encoder = FrameEncoder(delta)
+    encoder.encode(inputs.search_frame)
+    encoder.encode(inputs.stream_frame)
+    return lambda: encoder.encode(stage_response)
+
+
+@benchmark("frontend_frame[llm_stream]")
+def bench_stream_frame(inputs):
+    return encode_frames(inputs, False, inputs.stream_frame)
+
+
+@benchmark("frontend_frame[llm_stream, delta]")
+def bench_stream_frame_delta(inputs):
+    return encode_frames(inputs, True, inputs.stream_frame)
+
+
+@benchmark("frontend_frame[llm]")
+def bench_final_frame(inputs):
+    return encode_frames(inputs, False, inputs.final_frame)
+
+
+def run_benchmark(fn, min_time_secs: float, min_round_secs: float) -> dict:
+    # Calibrate iterations per round so timer resolution is negligible
+    iterations = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_round_secs:
+            break
+        iterations *= 2 if elapsed == 0 else max(2, min(10, int(min_round_secs / elapsed) + 1))
+
+    timings = []
+    deadline = time.perf_counter() + min_time_secs
+    while len(timings) < 5 or time.perf_counter() < deadline:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        timings.append((time.perf_counter() - start) / iterations)
+    return {
+        "min_us": min(timings) * 1e6,
+        "median_us": statistics.median(timings) * 1e6,
+        "mean_us": statistics.mean(timings) * 1e6,
+        "stddev_us": statistics.stdev(timings) * 1e6,
+        "ops": 1 / statistics.mean(timings),
+        "rounds": len(timings),
+        "iterations": iterations,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS_DIR)
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--min-time", type=float, default=1.0, help="seconds of rounds per benchmark")
+    parser.add_argument("--min-round-ms", type=float, default=20, help="minimum duration of one round")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="results file of a previous run to compare against")
+    args = parser.parse_args()
+
+    pages = load_pages(args.corpus)
+    if not pages:
+        print(f"No pages in {args.corpus}, using synthetic pages")
+        pages = synthetic_pages()
+    inputs = Inputs(pages)
+    print(f"{len(inputs.pages)} pages, {sum(len(text) for text in inputs.texts)} chars of extracted text\n")
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    print(
+        f"{'benchmark':<34} {'min us':>10} {'median us':>10} {'mean us':>10} {'stddev':>8} {'ops/s':>10} {'change':>8}"
+    )
+    for name, setup in BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+        result = run_benchmark(setup(inputs), args.min_time, args.min_round_ms / 1000)
+        results[name] = result
+        change = ""
+        if name in baseline:
+            change = f"{(result['median_us'] / baseline[name]['median_us'] - 1) * 100:+.1f}%"
+        print(
+            f"{name:<34} {result['min_us']:>10.1f} {result['median_us']:>10.1f} {result['mean_us']:>10.1f} "
+            f"{result['stddev_us']:>8.1f} {result['ops']:>10.1f} {change:>8}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Local stand-ins for the backend's upstreams, for load tests that never touch the network:
+
+    GET  /customsearch/v1        Google Custom Search API, results link to the pages below
+    GET  /pages/{n}              webpages from the extractor benchmark corpus (or synthetic ones)
+    POST /v1/chat/completions    OpenAI-compatible streaming chat completions
+
+    python benchmarks/fake_upstreams.py [--port 30900] [--search-ms 300] [--page-ms 200] [--llm-ttft-ms 400] ...
+
+Latencies are log-normally distributed around the given medians (spread set by --sigma), and each
+upstream fails with its own probability. Result pages are spread over --page-hosts loopback
+addresses (127.0.0.N), so per-host connection caps behave as with real search results.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_extractors import DEFAULT_CORPUS_DIR, load_pages, synthetic_pages  # noqa: E402
+
+ANSWER_WORDS = (
+    "Here is a thorough answer drawn from the documents . 1. The first point is explained at length "
+    "with supporting details . 2. The second point follows with more context and examples ."
+).split()
+
+
+def sample_latency_secs(median_ms: float, sigma: float) -> float:
+    if median_ms <= 0:
+        return 0.0
+    return random.lognormvariate(math.log(median_ms / 1000), sigma)
+
+
+def failed(rate: float) -> bool:
+    return random.random() < rate
+
+
+def create_app(args) -> FastAPI:
+    app = FastAPI()
+    pages = load_pages(args.corpus) or synthetic_pages(num_pages=50)
+    stats = {"search": 0, "pages": 0, "llm": 0, "failures": 0}
+
+    def page_url(n: int) -> str:
+        return f"http://127.0.0.{n % args.page_hosts + 1}:{args.port}/pages/{n}"
+
+    @app.get("/customsearch/v1")
+    async def custom_search(q: str = ""):
+        stats["search"] += 1
+        await asyncio.sleep(sample_latency_secs(args.search_ms, args.sigma))
+        if failed(args.search_failure_rate):
+            stats["failures"] += 1
+            return JSONResponse({"error": {"code": 429, "message": "Quota exceeded"}}, status_code=429)
+        # Each query gets its own stable set of pages
+        first = random.Random(q).randrange(len(pages))
+        items = [
+            {"title": f"Result {i} for {q}", "link": page_url((first + i) % len(pages)), "snippet": "..."}
+            for i in range(args.results)
+        ]
+        return {"items": items}
+
+    @app.get("/pages/{n}")
+    async def page(n: int):
+        stats["pages"] += 1
+        await asyncio.sleep(sample_latency_secs(args.page_ms, args.sigma))
+        if failed(args.page_failure_rate):
+            stats["failures"] += 1
+            return Response(status_code=503)
+        return HTMLResponse(pages[n % len(pages)])
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        stats["llm"] += 1
+        body = await request.json()
+        await asyncio.sleep(sample_latency_secs(args.llm_ttft_ms, args.sigma))
+        if failed(args.llm_failure_rate):
+            stats["failures"] += 1
+            return JSONResponse({"error": {"message": "Service unavailable"}}, status_code=503)
+        num_tokens = min(args.llm_tokens, body.get("max_tokens") or args.llm_tokens)
+        prompt_tokens = sum(len(message["content"]) // 4 for message in body["messages"])
+
+        async def stream():
+            for i in range(num_tokens):
+                if i:
+                    await asyncio.sleep(args.llm_token_ms / 1000)
+                word = ANSWER_WORDS[i % len(ANSWER_WORDS)]
+                chunk = {"choices": [{"index": 0, "delta": {"content": word + " "}}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": num_tokens,
+                "total_tokens": prompt_tokens + num_tokens,
+            }
+            yield f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.get("/stats")
+    async def get_stats():
+        return {**stats, "uptime_secs": round(time.monotonic() - started_at, 1)}
+
+    started_at = time.monotonic()
+    return app
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=30900)
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS_DIR)
+    parser.add_argument("--results", type=int, default=10, help="search results per query")
+    parser.add_argument("--page-hosts", type=int, default=8, help="loopback addresses pages are spread over")
+    parser.add_argument("--sigma", type=float, default=0.5, help="log-normal spread of every latency")
+    parser.add_argument("--search-ms", type=float, default=300, help="median search API latency")
+    parser.add_argument("--page-ms", type=float, default=200, help="median webpage latency")
+    parser.add_argument("--llm-ttft-ms", type=float, default=400, help="median LLM time to first token")
+    parser.add_argument("--llm-token-ms", type=float, default=5, help="delay between streamed LLM tokens")
+    parser.add_argument("--llm-tokens", type=int, default=300, help="completion tokens per answer")
+    parser.add_argument("--search-failure-rate", type=float, default=0.0)
+    parser.add_argument("--page-failure-rate", type=float, default=0.05)
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0)
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    uvicorn.run(create_app(args), host="0.0.0.0", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
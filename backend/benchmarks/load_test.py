@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""
+Load test /stream_search end to end, offline, against the local upstream stand-ins in fake_upstreams.py.
+
+    python benchmarks/load_test.py [--workers 1 2 4] [--concurrency 16] [--requests 200] [--json results.json]
+    python benchmarks/load_test.py --target http://localhost:30001 --concurrency 8 --requests 50
+
+For each worker count, starts the fake upstreams and gunicorn serving fastapi_app:app with its search
+and LLM providers pointed at them, then drives /stream_search with `concurrency` clients and reports
+p50/p95/p99 time to first stage and time to answer, requests per second, errors and peak RSS per
+worker. With --target, load is sent to an already running server instead and RSS is not reported.
+Options after -- are passed to fake_upstreams.py to set upstream latencies and failure rates.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_UPSTREAMS = os.path.join(BACKEND_DIR, "benchmarks", "fake_upstreams.py")
+# Frame delimiters of each /stream_search format
+DELIMITERS = {"json": "[/PERPLEXED-SEPARATOR]", "sse": "\n\n", "ndjson": "\n"}
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[pct - 1]
+
+
+def rss_mb(pid: int) -> float:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def child_pids(parent_pid: int):
+    pids = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                # The command name may contain spaces, fields after it are space separated
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == parent_pid:
+            pids.append(int(name))
+    return pids
+
+
+async def wait_until_up(url: str, timeout_secs: float = 30):
+    deadline = time.monotonic() + timeout_secs
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url, timeout=1)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout_secs}s")
+
+
+def backend_env(upstream_url: str, tmp_dir: str) -> dict:
+    """Environment pointing the backend at the fake upstreams, with client and quota limits out of the way."""
+    return {
+        **os.environ,
+        "GOOGLE_SEARCH_API_KEY": "load-test",
+        "GOOGLE_SEARCH_ENGINE_ID": "load-test",
+        "GROQ_API_KEY": "load-test",
+        "SEARCH_PROVIDERS": json.dumps([{"type": "google", "base_url": f"{upstream_url}/customsearch/v1"}]),
+        "LLM_PROVIDERS": json.dumps([{"type": "openai", "base_url": f"{upstream_url}/v1", "model": "fake"}]),
+        "CACHE_DB_PATH": os.path.join(tmp_dir, "cache.sqlite3"),
+        "PROMETHEUS_MULTIPROC_DIR": os.path.join(tmp_dir, "metrics"),
+        "CLIENT_REQUESTS_PER_MINUTE": "1000000",
+        "CLIENT_BURST": "1000000",
+        "CLIENT_MAX_CONCURRENT_STREAMS": "100000",
+        "MAX_CONCURRENT_STREAMS": "100000",
+        "LLM_TOKENS_PER_MINUTE": "1000000000",
+        "TRACE_EXPORTER": "",
+        # Background refreshes would add load the run doesn't ask for
+        "ANSWER_REFRESH": "0",
+    }
+
+
+async def stream_search(client: httpx.AsyncClient, url: str, prompt: str, format: str = "json") -> dict:
+    start = time.perf_counter()
+    first_stage_secs = None
+    result = {"ok": False}
+    try:
+        async with client.stream(
+            "POST", f"{url}/stream_search", params={"format": format}, json={"user_prompt": prompt}
+        ) as response:
+            if response.status_code != 200:
+                return {"ok": False, "error": f"http_{response.status_code}"}
+            buffer = ""
+            async for text in response.aiter_text():
+                buffer += text
+                *frames, buffer = buffer.split(DELIMITERS[format])
+                for frame in frames:
+                    # Server-Sent Events heartbeats are comments
+                    if format == "sse":
+                        if frame.startswith(":"):
+                            continue
+                        frame = frame.removeprefix("data: ")
+                    if first_stage_secs is None:
+                        first_stage_secs = time.perf_counter() - start
+                    message = json.loads(frame)
+                    if message["stage"] == "Results ready":
+                        result = {"ok": message["success"], "error": message["message"] or None}
+    except httpx.HTTPError as e:
+        return {"ok": False, "error": type(e).__name__}
+    result["first_stage_secs"] = first_stage_secs
+    result["answer_secs"] = time.perf_counter() - start
+    return result
+
+
+async def run_load(
+    url: str, concurrency: int, num_requests: int, repeat_ratio: float, worker_pids, format: str = "json"
+) -> dict:
+    run_id = random.getrandbits(32)
+    prompts = []
+    for i in range(num_requests):
+        if prompts and random.random() < repeat_ratio:
+            prompts.append(random.choice(prompts))
+        else:
+            prompts.append(f"load test question {run_id} number {i}")
+
+    results = []
+    peak_rss = {pid: rss_mb(pid) for pid in worker_pids}
+    queue = iter(prompts)
+
+    async def client_loop(client):
+        for prompt in queue:
+            results.append(await stream_search(client, url, prompt, format))
+
+    async def sample_rss():
+        while True:
+            for pid in peak_rss:
+                peak_rss[pid] = max(peak_rss[pid], rss_mb(pid))
+            await asyncio.sleep(0.5)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        sampler = asyncio.create_task(sample_rss())
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        sampler.cancel()
+
+    ok = [result for result in results if result["ok"]]
+    errors = {}
+    for result in results:
+        if not result["ok"]:
+            errors[result.get("error")] = errors.get(result.get("error"), 0) + 1
+    first_stage = [result["first_stage_secs"] for result in ok if result["first_stage_secs"] is not None]
+    answer = [result["answer_secs"] for result in ok]
+    return {
+        "requests": len(results),
+        "concurrency": concurrency,
+        "elapsed_secs": round(elapsed, 2),
+        "rps": round(len(ok) / elapsed, 2),
+        "errors": errors,
+        "first_stage_ms": {f"p{p}": round(percentile(first_stage, p) * 1000, 1) for p in (50, 95, 99)},
+        "answer_ms": {f"p{p}": round(percentile(answer, p) * 1000, 1) for p in (50, 95, 99)},
+        "worker_peak_rss_mb": [round(rss, 1) for rss in peak_rss.values()],
+    }
+
+
+def start_process(args, env=None, log_path=None):
+    log = open(log_path, "w") if log_path else subprocess.DEVNULL
+    return subprocess.Popen(args, cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def stop_process(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def run_local(args, workers: int) -> dict:
+    upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+    backend_url = f"http://127.0.0.1:{args.port}"
+    with tempfile.TemporaryDirectory(prefix="perplexed-load-") as tmp_dir:
+        upstreams = start_process(
+            [sys.executable, FAKE_UPSTREAMS, "--port", str(args.upstream_port), *args.upstream_args],
+            log_path=os.path.join(tmp_dir, "upstreams.log"),
+        )
+        gunicorn = None
+        try:
+            await wait_until_up(f"{upstream_url}/stats")
+            gunicorn = start_process(
+                [
+                    sys.executable, "-m", "gunicorn",
+                    "--bind", f"127.0.0.1:{args.port}",
+                    "--workers", str(workers),
+                    "--worker-class", "uvicorn.workers.UvicornWorker",
+                    "fastapi_app:app",
+                ],
+                env=backend_env(upstream_url, tmp_dir),
+                log_path=args.backend_log,
+            )  # fmt: skip
+            await wait_until_up(f"{backend_url}/test")
+            # Let every worker finish importing before measuring
+            await asyncio.sleep(1)
+            await run_load(backend_url, min(workers, args.concurrency), args.warmup, 0.0, [])
+            result = await run_load(
+                backend_url, args.concurrency, args.requests, args.repeat_ratio, child_pids(gunicorn.pid), args.format
+            )
+        finally:
+            if gunicorn is not None:
+                stop_process(gunicorn)
+            stop_process(upstreams)
+    return {"workers": workers, **result}
+
+
+def print_result(result: dict):
+    first_stage, answer = result["first_stage_ms"], result["answer_ms"]
+    rss = result["worker_peak_rss_mb"]
+    print(
+        f"{result.get('workers', '-'):>7} {result['concurrency']:>5} {result['requests']:>6} {result['rps']:>8.2f} "
+        f"{first_stage['p50']:>8.0f} {first_stage['p95']:>8.0f} {first_stage['p99']:>8.0f} "
+        f"{answer['p50']:>8.0f} {answer['p95']:>8.0f} {answer['p99']:>8.0f} "
+        f"{(max(rss) if rss else 0):>8.0f} {sum(result['errors'].values()):>6}"
+    )
+    if result["errors"]:
+        print(f"        errors: {result['errors']}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="gunicorn worker counts to sweep")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=200, help="requests per run")
+    parser.add_argument("--warmup", type=int, default=8, help="requests before measuring")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="fraction of prompts repeating earlier ones")
+    parser.add_argument("--format", choices=sorted(DELIMITERS), default="json", help="/stream_search format")
+    parser.add_argument("--port", type=int, default=30801)
+    parser.add_argument("--upstream-port", type=int, default=30900)
+    parser.add_argument("--target", help="URL of a running server to load instead of starting one")
+    parser.add_argument("--backend-log", default=os.devnull, help="file for the started server's output")
+    parser.add_argument("--json", help="write results to this file, to compare runs")
+    parser.add_argument("upstream_args", nargs=argparse.REMAINDER, help="-- then options for fake_upstreams.py")
+    args = parser.parse_args()
+    if args.upstream_args[:1] == ["--"]:
+        args.upstream_args = args.upstream_args[1:]
+
+    print(
+        f"{'workers':>7} {'conc':>5} {'reqs':>6} {'rps':>8} "
+        f"{'first50':>8} {'first95':>8} {'first99':>8} {'ans50':>8} {'ans95':>8} {'ans99':>8} {'rss MB':>8} {'errs':>6}"
+    )
+    results = []
+    if args.target:
+        await run_load(args.target, args.concurrency, args.warmup, 0.0, [])
+        results.append(await run_load(args.target, args.concurrency, args.requests, args.repeat_ratio, [], args.format))
+        print_result(results[-1])
+    else:
+        for workers in args.workers:
+            results.append(await run_local(args, workers))
+            print_result(results[-1])
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
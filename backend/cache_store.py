@@ -0,0 +1,129 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional, Tuple
+
+from config import Cache
+
+
+def connect_database(path: str) -> sqlite3.Connection:
+    """Open the node-wide SQLite database in WAL mode, in autocommit mode so callers control transactions."""
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=5, isolation_level=None)
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SqliteCacheStore:
+    """
+    Cache store shared by every worker process on a node.
+
+    Entries live in a SQLite database in WAL mode, so readers never block the writer and the
+    cache survives worker recycles and restarts. Several caches can share one database file,
+    each under its own namespace. Methods block on disk I/O; call them from a worker thread.
+    """
+
+    # Prune expired and over-limit entries once every N writes rather than on every write
+    PRUNE_EVERY_N_SETS = 64
+    # Only rewrite an entry's access time when it is older than this, to keep reads cheap
+    TOUCH_INTERVAL_SECS = 60
+
+    def __init__(self, path: str, namespace: str, max_entries: int, max_bytes: int):
+        self.path = path
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._num_sets = 0
+        self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect_database(self.path)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "expires_at REAL NOT NULL, accessed_at REAL NOT NULL, PRIMARY KEY (namespace, key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_entries_accessed ON cache_entries (namespace, accessed_at)")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        """Return (value, expires_at) for a live entry, where expires_at is a wall-clock timestamp."""
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT value, expires_at, accessed_at FROM cache_entries WHERE namespace = ? AND key = ?",
+            (self.namespace, key),
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires_at, accessed_at = row
+        now = time.time()
+        if expires_at <= now:
+            return None
+        if now - accessed_at > self.TOUCH_INTERVAL_SECS:
+            conn.execute(
+                "UPDATE cache_entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                (now, self.namespace, key),
+            )
+        return json.loads(value), expires_at
+
+    def set(self, key: str, value: Any, expires_at: float):
+        encoded = json.dumps(value)
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache_entries (namespace, key, value, size, expires_at, accessed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (self.namespace, key, encoded, len(key) + len(encoded), expires_at, time.time()),
+        )
+        self._num_sets += 1
+        if self._num_sets % self.PRUNE_EVERY_N_SETS == 0:
+            self.prune()
+
+    def delete(self, key: str):
+        self._connect().execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (self.namespace, key))
+
+    def clear(self):
+        self._connect().execute("DELETE FROM cache_entries WHERE namespace = ?", (self.namespace,))
+
+    def prune(self):
+        """Drop expired entries, then least recently accessed ones until within limits."""
+        conn = self._connect()
+        conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND expires_at <= ?", (self.namespace, time.time()))
+        num_entries, num_bytes = conn.execute(
+            "SELECT COUNT(*), TOTAL(size) FROM cache_entries WHERE namespace = ?", (self.namespace,)
+        ).fetchone()
+        if num_entries <= self.max_entries and num_bytes <= self.max_bytes:
+            return
+        # Evict the oldest entries, plus a margin so the next few writes don't prune again
+        excess_entries = max(num_entries - self.max_entries, 0)
+        excess_fraction = max(num_bytes - self.max_bytes, 0) / num_bytes if num_bytes else 0
+        num_evict = max(excess_entries, int(num_entries * excess_fraction)) + num_entries // 10
+        conn.execute(
+            "DELETE FROM cache_entries WHERE namespace = ? AND key IN ("
+            "SELECT key FROM cache_entries WHERE namespace = ? ORDER BY accessed_at LIMIT ?)",
+            (self.namespace, self.namespace, num_evict),
+        )
+
+    def stats(self) -> dict:
+        num_entries, num_bytes = (
+            self._connect()
+            .execute("SELECT COUNT(*), TOTAL(size) FROM cache_entries WHERE namespace = ?", (self.namespace,))
+            .fetchone()
+        )
+        return {"entries": num_entries, "bytes": int(num_bytes)}
+
+
+def shared_store(namespace: str, max_entries: int, max_bytes: int) -> Optional[SqliteCacheStore]:
+    """Store for a cache namespace in the node-wide database, or None when Cache.CACHE_DB_PATH is unset."""
+    if not Cache.CACHE_DB_PATH:
+        return None
+    return SqliteCacheStore(Cache.CACHE_DB_PATH, namespace, max_entries=max_entries, max_bytes=max_bytes)
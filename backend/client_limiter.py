@@ -0,0 +1,147 @@
+import ipaddress
+import math
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Union
+
+from fastapi.responses import JSONResponse
+
+from rate_limiter import TokenBucket
+
+Network = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+class ClientLimiter:
+    """
+    Per-client request rate (token bucket) and concurrent stream caps, plus a cap on concurrent
+    streams across all clients. State is in-process and O(1) per request, so limits apply per worker.
+    """
+
+    # Retry-After sent when turned away for concurrency rather than rate
+    CONCURRENCY_RETRY_AFTER_SECS = 1
+
+    def __init__(
+        self,
+        requests_per_minute: float,
+        burst: int,
+        max_concurrent_per_client: int,
+        max_concurrent_total: int,
+        max_tracked_clients: int = 10_000,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.burst = burst
+        self.max_concurrent_per_client = max_concurrent_per_client
+        self.max_concurrent_total = max_concurrent_total
+        self.max_tracked_clients = max_tracked_clients
+        self.buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+        self.active: Dict[str, int] = {}
+        self.num_active = 0
+        self.rejected = 0
+
+    def admit(self, client: str) -> Optional[float]:
+        """Admit a request from client and count it as active, or return the seconds it should retry after."""
+        if self.num_active >= self.max_concurrent_total or self.active.get(client, 0) >= self.max_concurrent_per_client:
+            self.rejected += 1
+            return self.CONCURRENCY_RETRY_AFTER_SECS
+
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = TokenBucket(self.burst, self.requests_per_minute / 60)
+            self.buckets[client] = bucket
+            if len(self.buckets) > self.max_tracked_clients:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(client)
+        wait_secs = bucket.try_consume(1)
+        if wait_secs:
+            self.rejected += 1
+            return wait_secs
+
+        self.active[client] = self.active.get(client, 0) + 1
+        self.num_active += 1
+        return None
+
+    def release(self, client: str):
+        self.num_active -= 1
+        if self.active[client] <= 1:
+            del self.active[client]
+        else:
+            self.active[client] -= 1
+
+
+def parse_trusted_proxies(spec: str) -> List[Network]:
+    """Networks from a comma-separated list of addresses or CIDR ranges, e.g. "127.0.0.1,10.0.0.0/8"."""
+    return [ipaddress.ip_network(part.strip(), strict=False) for part in spec.split(",") if part.strip()]
+
+
+def is_trusted_proxy(address: str, trusted_proxies: Sequence[Network]) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in trusted_proxies)
+
+
+def client_key(scope, trusted_proxies: Sequence[Network] = (), client_ip_header: str = "") -> str:
+    """
+    Client address of a request. When the peer is a trusted proxy, the address in client_ip_header set by
+    the hosting platform's edge, else the one the bundled nginx set in X-Real-IP, else the last
+    X-Forwarded-For hop that is not itself a trusted proxy. Otherwise the peer address, forwarding headers
+    sent by clients themselves could otherwise dodge their limits.
+    """
+    peer = scope["client"][0] if scope.get("client") else ""
+    if not is_trusted_proxy(peer, trusted_proxies):
+        return peer
+    headers = dict(scope["headers"])
+    if client_ip_header:
+        edge_ip = headers.get(client_ip_header.lower().encode("latin-1"))
+        if edge_ip:
+            return edge_ip.decode("latin-1").strip()
+    real_ip = headers.get(b"x-real-ip")
+    if real_ip:
+        return real_ip.decode("latin-1").strip()
+    forwarded_for = headers.get(b"x-forwarded-for")
+    if forwarded_for:
+        # Proxies append the address they received from, so only the hops after the last untrusted one are reliable
+        hops = [hop.strip() for hop in forwarded_for.decode("latin-1").split(",") if hop.strip()]
+        for hop in reversed(hops):
+            if not is_trusted_proxy(hop, trusted_proxies):
+                return hop
+        if hops:
+            return hops[0]
+    return peer
+
+
+class ClientLimitMiddleware:
+    """
+    ASGI middleware applying a ClientLimiter to the given paths, answering 429 with Retry-After
+    when a client is over its limits. Streams count as active until their response finishes.
+    Clients are told apart by client_key, trusting forwarding headers only from trusted_proxies.
+    """
+
+    def __init__(self, app, limiter: ClientLimiter, paths, trusted_proxies: str = "", client_ip_header: str = ""):
+        self.app = app
+        self.limiter = limiter
+        self.paths = set(paths)
+        self.trusted_proxies = parse_trusted_proxies(trusted_proxies)
+        self.client_ip_header = client_ip_header
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        client = client_key(scope, self.trusted_proxies, self.client_ip_header)
+        retry_after = self.limiter.admit(client)
+        if retry_after is not None:
+            response = JSONResponse(
+                {"error": "Too many requests, please try again shortly."},
+                status_code=429,
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.limiter.release(client)
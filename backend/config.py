@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 
 class Secrets:
@@ -32,12 +33,138 @@ class Deployment:
         "GROQ_API_KEY": ellipsis_middle(Secrets.GROQ_API_KEY),
     }
 
+class ClientLimits:
+    # Per client IP and per worker: sustained request rate, burst size and concurrent streams
+    REQUESTS_PER_MINUTE = float(os.environ.get("CLIENT_REQUESTS_PER_MINUTE", 10))
+    BURST = int(os.environ.get("CLIENT_BURST", 5))
+    MAX_CONCURRENT_STREAMS = int(os.environ.get("CLIENT_MAX_CONCURRENT_STREAMS", 2))
+    # Per worker, across all clients
+    MAX_CONCURRENT_STREAMS_TOTAL = int(os.environ.get("MAX_CONCURRENT_STREAMS", 100))
+    # Peers whose X-Real-IP/X-Forwarded-For are believed, addresses or CIDR ranges. The bundled nginx runs
+    # on localhost, a deployment behind another proxy or load balancer must list it or clients share its limits
+    TRUSTED_PROXIES = os.environ.get("TRUSTED_PROXIES", "127.0.0.1,::1")
+    # Header in which the hosting platform's edge reports the client address, e.g. CF-Connecting-IP on
+    # Cloudflare or Fly-Client-IP on Fly.io, believed ahead of the others when the peer is trusted
+    CLIENT_IP_HEADER = os.environ.get("CLIENT_IP_HEADER", "")
+
+
 class Model:
+    # tiktoken encoding used to count and truncate prompt tokens
+    TOKENIZER_ENCODING = os.environ.get("TOKENIZER_ENCODING", "o200k_base")
+    # Total prompt tokens sent to the LLM, including the system prompt, documents and question
+    PROMPT_TOKEN_BUDGET = int(os.environ.get("LLM_PROMPT_TOKEN_BUDGET", 5000))
+    # Tokens per minute admitted to the LLM, the Groq account's TPM quota
+    TOKENS_PER_MINUTE = int(os.environ.get("LLM_TOKENS_PER_MINUTE", 30000))
+    # JSON list of provider specs (see llm_providers.create_provider), defaults to Groq alone
+    LLM_PROVIDERS = os.environ.get("LLM_PROVIDERS", "")
+    # Fire a second provider when the first has not streamed a token by its p95 time to first token
+    LLM_HEDGE = os.environ.get("LLM_HEDGE", "0") == "1"
+    LLM_HEDGE_MIN_DELAY_SECS = float(os.environ.get("LLM_HEDGE_MIN_DELAY_SECS", 0.5))
+    # Fraction of requests routed first to the least sampled provider, so untried and stale ones are measured
+    LLM_EXPLORE_RATE = float(os.environ.get("LLM_EXPLORE_RATE", 0.05))
+    # Seconds added to a provider's latency score at a 100% recent error rate, the cost of failing over
+    LLM_ERROR_PENALTY_SECS = float(os.environ.get("LLM_ERROR_PENALTY_SECS", 5))
+    LLM_CONNECT_TIMEOUT_SECS = float(os.environ.get("LLM_CONNECT_TIMEOUT_SECS", 5))
+    LLM_READ_TIMEOUT_SECS = float(os.environ.get("LLM_READ_TIMEOUT_SECS", 60))
     SYSTEM_PROMPT = "You are AI assistant for answering questions.  Using the provided documents, answer the user's question as thoroughly as possible.  Omit inconclusive documents.  Make the answer eloquent and well-written, and at least 2 paragraphs long. Use numbered lists as much as possible.  Format the answer as Markdown, make sure the formatting is beautiful, that there are numbers used at the beginning of each item of a list, and two full newlines between each point in the list.  DO NOT cite the Document or Document ID in the response."  # noqa: E501 fmt: off
 
 
+class Cache:
+    QUERY_CACHE_MAX_ENTRIES = int(os.environ.get("QUERY_CACHE_MAX_ENTRIES", 1024))
+    QUERY_CACHE_MAX_BYTES = int(os.environ.get("QUERY_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+    QUERY_CACHE_TTL_SECS = int(os.environ.get("QUERY_CACHE_TTL_SECS", 24 * 60 * 60))
+    # Shared on-disk tier for all workers on a node, set to "" to keep caches in-process only
+    CACHE_DB_PATH = os.environ.get("CACHE_DB_PATH", os.path.join(tempfile.gettempdir(), "perplexed-cache.sqlite3"))
+    QUERY_CACHE_DB_MAX_ENTRIES = int(os.environ.get("QUERY_CACHE_DB_MAX_ENTRIES", 100_000))
+    QUERY_CACHE_DB_MAX_BYTES = int(os.environ.get("QUERY_CACHE_DB_MAX_BYTES", 512 * 1024 * 1024))
+    # Extracted webpage text by URL, served without revalidation for PAGE_CACHE_FRESH_SECS
+    PAGE_CACHE_MAX_ENTRIES = int(os.environ.get("PAGE_CACHE_MAX_ENTRIES", 2048))
+    PAGE_CACHE_MAX_BYTES = int(os.environ.get("PAGE_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+    PAGE_CACHE_TTL_SECS = int(os.environ.get("PAGE_CACHE_TTL_SECS", 7 * 24 * 60 * 60))
+    PAGE_CACHE_FRESH_SECS = int(os.environ.get("PAGE_CACHE_FRESH_SECS", 60 * 60))
+    PAGE_CACHE_DB_MAX_ENTRIES = int(os.environ.get("PAGE_CACHE_DB_MAX_ENTRIES", 50_000))
+    PAGE_CACHE_DB_MAX_BYTES = int(os.environ.get("PAGE_CACHE_DB_MAX_BYTES", 512 * 1024 * 1024))
+    # Search results by normalized query, refreshed once older than SEARCH_CACHE_FRESH_SECS
+    SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", 4096))
+    SEARCH_CACHE_MAX_BYTES = int(os.environ.get("SEARCH_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+    SEARCH_CACHE_TTL_SECS = int(os.environ.get("SEARCH_CACHE_TTL_SECS", 7 * 24 * 60 * 60))
+    SEARCH_CACHE_FRESH_SECS = int(os.environ.get("SEARCH_CACHE_FRESH_SECS", 24 * 60 * 60))
+    # Serve stale search results immediately and refresh them in the background
+    SEARCH_CACHE_STALE_WHILE_REVALIDATE = os.environ.get("SEARCH_CACHE_STALE_WHILE_REVALIDATE", "1") == "1"
+    SEARCH_CACHE_DB_MAX_ENTRIES = int(os.environ.get("SEARCH_CACHE_DB_MAX_ENTRIES", 100_000))
+    SEARCH_CACHE_DB_MAX_BYTES = int(os.environ.get("SEARCH_CACHE_DB_MAX_BYTES", 128 * 1024 * 1024))
+    # Serve the answer of a cached prompt whose estimated word-shingle Jaccard similarity is at least this, 0 disables
+    QUERY_SIMILARITY_THRESHOLD = float(os.environ.get("QUERY_SIMILARITY_THRESHOLD", 0))
+
+
+class Refresh:
+    # Background pre-warming and refreshing of popular answers, off by default as it spends search and LLM
+    # quota on its own, needs Cache.CACHE_DB_PATH to track popularity
+    ENABLED = os.environ.get("ANSWER_REFRESH", "0") == "1"
+    # The most popular prompts kept warm, popularity being hits decayed with this half-life
+    TOP_N = int(os.environ.get("ANSWER_REFRESH_TOP_N", 50))
+    MIN_HITS = float(os.environ.get("ANSWER_REFRESH_MIN_HITS", 2))
+    POPULARITY_HALF_LIFE_SECS = float(os.environ.get("QUERY_POPULARITY_HALF_LIFE_SECS", 24 * 60 * 60))
+    POPULARITY_MAX_ENTRIES = int(os.environ.get("QUERY_POPULARITY_MAX_ENTRIES", 10_000))
+    # Answers are refreshed once they are within this of expiring (Cache.QUERY_CACHE_TTL_SECS)
+    AHEAD_SECS = float(os.environ.get("ANSWER_REFRESH_AHEAD_SECS", 60 * 60))
+    INTERVAL_SECS = float(os.environ.get("ANSWER_REFRESH_INTERVAL_SECS", 5 * 60))
+    # Budgets for background work, apart from the LLM quota headroom required before each refresh
+    TOKENS_PER_HOUR = int(os.environ.get("ANSWER_REFRESH_TOKENS_PER_HOUR", 100_000))
+    SEARCHES_PER_HOUR = int(os.environ.get("ANSWER_REFRESH_SEARCHES_PER_HOUR", 50))
+    MIN_LLM_HEADROOM = float(os.environ.get("ANSWER_REFRESH_MIN_LLM_HEADROOM", 0.5))
+    # Prompts whose refresh failed are left alone for this long, doubling with each consecutive failure
+    FAILURE_BACKOFF_SECS = float(os.environ.get("ANSWER_REFRESH_FAILURE_BACKOFF_SECS", 60 * 60))
+    MAX_FAILURE_BACKOFF_SECS = float(os.environ.get("ANSWER_REFRESH_MAX_FAILURE_BACKOFF_SECS", 24 * 60 * 60))
+
+
+class Tracing:
+    # "" disables tracing, "file" appends spans as JSON lines to FILE_PATH, "otlp" posts them to OTLP_ENDPOINT
+    EXPORTER = os.environ.get("TRACE_EXPORTER", "")
+    # Fraction of requests traced, decided from the request ID so every service samples the same requests
+    SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.1))
+    FILE_PATH = os.environ.get("TRACE_FILE_PATH", "/var/log/app/traces.jsonl")
+    OTLP_ENDPOINT = os.environ.get("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+    SERVICE_NAME = os.environ.get("TRACE_SERVICE_NAME", "perplexed-backend")
+
+
+class Streaming:
+    # Comment sent on idle Server-Sent Events streams, so proxies don't time them out during slow stages
+    HEARTBEAT_SECS = float(os.environ.get("STREAM_HEARTBEAT_SECS", 15))
+    # Compress streams with gzip, or brotli when installed, if the client accepts it
+    COMPRESSION = os.environ.get("STREAM_COMPRESSION", "1") == "1"
+    GZIP_LEVEL = int(os.environ.get("STREAM_GZIP_LEVEL", 6))
+    BROTLI_QUALITY = int(os.environ.get("STREAM_BROTLI_QUALITY", 5))
+
+
+class Profiling:
+    # Enables the /debug/profile endpoint and SIGUSR2 profiling of live workers, off by default
+    ENABLED = os.environ.get("PROFILING", "0") == "1"
+    INTERVAL_SECS = float(os.environ.get("PROFILING_INTERVAL_SECS", 0.01))
+    # Shortest sampling interval accepted, sampling every thread in a tighter loop would stall the worker
+    MIN_INTERVAL_SECS = 0.001
+    MAX_SECS = float(os.environ.get("PROFILING_MAX_SECS", 120))
+    SIGNAL_SECS = float(os.environ.get("PROFILING_SIGNAL_SECS", 30))
+    OUTPUT_DIR = os.environ.get("PROFILING_OUTPUT_DIR", os.path.join(tempfile.gettempdir(), "perplexed-profiles"))
+
+
+class Http:
+    HTTP2 = os.environ.get("HTTP2", "1") == "1"
+    KEEPALIVE_EXPIRY_SECS = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY_SECS", 30))
+    SEARCH_MAX_CONNECTIONS = int(os.environ.get("HTTP_SEARCH_MAX_CONNECTIONS", 20))
+    SCRAPE_MAX_CONNECTIONS = int(os.environ.get("HTTP_SCRAPE_MAX_CONNECTIONS", 100))
+    SCRAPE_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("HTTP_SCRAPE_MAX_KEEPALIVE_CONNECTIONS", 40))
+    SCRAPE_MAX_CONNECTIONS_PER_HOST = int(os.environ.get("HTTP_SCRAPE_MAX_CONNECTIONS_PER_HOST", 4))
+    LLM_MAX_CONNECTIONS = int(os.environ.get("HTTP_LLM_MAX_CONNECTIONS", 20))
+
+
 class Search:
     DEFAULT_HEADERS = {
         'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36'  # noqa: E501 fmt: off
     }
     JSON_STREAM_SEPARATOR = "[/PERPLEXED-SEPARATOR]"
+    # JSON list of provider specs (see search_providers.create_search_provider), defaults to Google alone
+    PROVIDERS = os.environ.get("SEARCH_PROVIDERS", "")
+    # "fallback" tries providers in order, "fanout" queries all of them and merges the results
+    MODE = os.environ.get("SEARCH_MODE", "fallback")
+    PROVIDER_TIMEOUT_SECS = float(os.environ.get("SEARCH_PROVIDER_TIMEOUT_SECS", 3))
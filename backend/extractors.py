@@ -0,0 +1,130 @@
+from typing import Dict, List, Type
+
+from bs4 import BeautifulSoup
+from lxml import etree
+
+
+class ExtractionSession:
+    """
+    Incremental extraction of one page: feed HTML text in pieces, then close to get the main text.
+    A session must be created, fed and closed on one thread, lxml parsers cannot move between threads.
+    """
+
+    def feed(self, html: str) -> bool:
+        """Feed the next piece of the page, returns True once enough text has been collected."""
+        raise NotImplementedError
+
+    def close(self) -> str:
+        raise NotImplementedError
+
+
+class HtmlExtractor:
+    """Extracts the main text of a webpage, i.e. the text of its <p> elements."""
+
+    # Size of the slices extract() feeds, so that parsing can stop early
+    FEED_CHARS = 16 * 1024
+
+    def session(self, limit_tokens: int) -> ExtractionSession:
+        raise NotImplementedError
+
+    def extract(self, html: str, limit_tokens: int) -> str:
+        session = self.session(limit_tokens)
+        for start in range(0, len(html), self.FEED_CHARS):
+            if session.feed(html[start : start + self.FEED_CHARS]):
+                break
+        return session.close()
+
+
+class _SoupSession(ExtractionSession):
+    def __init__(self):
+        self.parts: List[str] = []
+
+    def feed(self, html: str) -> bool:
+        self.parts.append(html)
+        return False
+
+    def close(self) -> str:
+        soup = BeautifulSoup("".join(self.parts), 'html.parser')
+
+        # Remove script and style elements
+        for script in soup(["script", "style"]):
+            script.decompose()
+
+        return ' '.join([p.text for p in soup.find_all('p')])
+
+
+class SoupExtractor(HtmlExtractor):
+    """Builds a full BeautifulSoup tree with html.parser, always parses the whole page."""
+
+    def session(self, limit_tokens: int) -> ExtractionSession:
+        return _SoupSession()
+
+
+class _LxmlSession(ExtractionSession):
+    SKIP_TAGS = {"script", "style"}
+
+    def __init__(self, limit_tokens: int):
+        self.limit_tokens = limit_tokens
+        self.parser = etree.HTMLPullParser(
+            events=("start", "end"), no_network=True, recover=True, remove_comments=True, remove_pis=True
+        )
+        self.paragraphs: List[str] = []
+        self.num_tokens = 0
+        self.p_depth = 0
+        self.done = False
+
+    def feed(self, html: str) -> bool:
+        if self.done:
+            return True
+        self.parser.feed(html)
+        self._read_events()
+        return self.done
+
+    def _read_events(self):
+        for event, element in self.parser.read_events():
+            tag = element.tag
+            if event == "start":
+                if tag == "p":
+                    self.p_depth += 1
+                continue
+
+            if tag in self.SKIP_TAGS:
+                element.clear(keep_tail=True)
+            elif tag == "p" and self.p_depth:
+                self.p_depth -= 1
+                if self.p_depth == 0:
+                    text = "".join(element.itertext())
+                    self.paragraphs.append(text)
+                    self.num_tokens += len(text.split())
+                    if self.num_tokens >= self.limit_tokens:
+                        self.done = True
+                        return
+            # Free finished elements unless they belong to a paragraph still being collected
+            if self.p_depth == 0:
+                element.clear(keep_tail=True)
+
+    def close(self) -> str:
+        if not self.done:
+            try:
+                self.parser.close()
+                self._read_events()
+            except etree.LxmlError:
+                pass
+        return ' '.join(self.paragraphs)
+
+
+class LxmlExtractor(HtmlExtractor):
+    """Streams the page through libxml2's HTML parser and stops once limit_tokens words are collected."""
+
+    def session(self, limit_tokens: int) -> ExtractionSession:
+        return _LxmlSession(limit_tokens)
+
+
+EXTRACTORS: Dict[str, Type[HtmlExtractor]] = {
+    "lxml": LxmlExtractor,
+    "soup": SoupExtractor,
+}
+
+
+def get_extractor(name: str) -> HtmlExtractor:
+    return EXTRACTORS[name]()
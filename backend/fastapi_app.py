@@ -1,23 +1,84 @@
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from contextlib import asynccontextmanager
+import asyncio
 import logging
+import os
 import time
-from typing import AsyncGenerator, Dict, List
-import json
-
-from config import Deployment
+from typing import AsyncGenerator, Dict, Literal, Optional
+
+from answer_refresher import create_answer_refresher
+from cache_store import shared_store
+from client_limiter import ClientLimiter, ClientLimitMiddleware
+from config import Cache, ClientLimits, Deployment, Profiling
+from http_clients import HTTP_CLIENTS
+from metrics import CACHE_LOOKUPS, REQUEST_SECONDS, render_metrics
+import profiler
 from models import SearchRequest, StreamSearchResponse, SearchAllStage
 from query_cache import QueryCache
-from search import search_all_async
+from query_keys import MinHashIndex, normalize_query
+from search import (
+    LLM_EXPECTED_COMPLETION_TOKENS,
+    LLM_RATE_LIMITER,
+    LLM_ROUTER,
+    has_fresh_websearch_async,
+    page_cache,
+    search_all_async,
+    search_cache,
+)
+from single_flight import SingleFlight
+from stream_frames import (
+    FrameEncoder,
+    cached_answer_frame,
+    encode_json,
+    frontend_frame,
+    negotiate_compression,
+    negotiate_transport,
+    write_stream,
+)
+import tracing
+from tracing import TracingMiddleware
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if Profiling.ENABLED:
+        profiler.install_signal_handler()
+    if answer_refresher is not None:
+        answer_refresher.start()
+    yield
+    if answer_refresher is not None:
+        await answer_refresher.aclose()
+    # Close the pooled HTTP clients shared by every request in this worker
+    await HTTP_CLIENTS.aclose()
+    await tracing.EXPORTER.aclose()
+
+
 # Initialize FastAPI app
 app = FastAPI(
-    title="Perplexed API", version="2.0.0", description="A search aggregation service with LLM-powered responses"
+    title="Perplexed API",
+    version="2.0.0",
+    description="A search aggregation service with LLM-powered responses",
+    lifespan=lifespan,
+)
+
+# Throttle clients on the search endpoint, added before CORS so that 429s still carry CORS headers
+app.add_middleware(
+    ClientLimitMiddleware,
+    limiter=ClientLimiter(
+        requests_per_minute=ClientLimits.REQUESTS_PER_MINUTE,
+        burst=ClientLimits.BURST,
+        max_concurrent_per_client=ClientLimits.MAX_CONCURRENT_STREAMS,
+        max_concurrent_total=ClientLimits.MAX_CONCURRENT_STREAMS_TOTAL,
+    ),
+    paths=["/stream_search"],
+    trusted_proxies=ClientLimits.TRUSTED_PROXIES,
+    client_ip_header=ClientLimits.CLIENT_IP_HEADER,
 )
 
 # Configure CORS
@@ -30,18 +91,57 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize query cache
-query_cache = QueryCache()
+# Initialize query cache, shared across workers through the on-disk store when configured
+query_cache = QueryCache(
+    store=shared_store("answers", Cache.QUERY_CACHE_DB_MAX_ENTRIES, Cache.QUERY_CACHE_DB_MAX_BYTES),
+)
+# Optional near-duplicate lookup over the normalized prompts cached by this worker
+query_index = MinHashIndex(Cache.QUERY_SIMILARITY_THRESHOLD) if Cache.QUERY_SIMILARITY_THRESHOLD > 0 else None
+# Concurrent requests for the same normalized prompt share one pipeline run
+search_flights: SingleFlight[StreamSearchResponse] = SingleFlight()
+
+
+class RequestLogMiddleware:
+    """
+    Logs and records the latency of each request until its response body has been fully sent,
+    so streamed searches are timed to their last frame rather than to their first byte.
+    """
 
+    def __init__(self, app):
+        self.app = app
+        self.route_paths = None
 
-# Middleware for request logging
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    logger.info(f"{request.method} {request.url.path} - {response.status_code} - {process_time:.3f}s")
-    return response
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if self.route_paths is None:
+            self.route_paths = {route.path for route in scope["app"].routes}
+
+        start_time = time.time()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            process_time = time.time() - start_time
+            # Unknown paths share one label, so scanners cannot blow up the metric's cardinality
+            path = scope["path"] if scope["path"] in self.route_paths else "other"
+            REQUEST_SECONDS.labels(scope["method"], path, str(status_code)).observe(process_time)
+            request_id = tracing.current_request_id()
+            logger.info(f"{scope['method']} {scope['path']} - {status_code} - {process_time:.3f}s - {request_id}")
+
+
+# Outermost, so it also times requests turned away by the client limiter
+app.add_middleware(RequestLogMiddleware)
+# Outside the request log, so its log lines carry the request's trace context
+app.add_middleware(TracingMiddleware)
 
 
 @app.get("/test", response_model=str)
@@ -56,156 +156,170 @@ async def env_report():
     return Deployment.ENV_REPORT
 
 
-def transform_backend_to_frontend_response(
-    stage_response: StreamSearchResponse, websearch_docs: List[Dict] = None
-) -> str:
-    """Transform backend response format to match frontend expectations."""
-    # Initialize websearch_docs list to persist across stages
-    if websearch_docs is None:
-        websearch_docs = []
-
-    frontend_response = {
-        "success": stage_response.error is None,
-        "stage": None,
-        "num_tokens_used": 0,
-        "websearch_docs": websearch_docs,
-        "answer": "",
-        "message": stage_response.error or "",
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics, aggregated across gunicorn workers. Not routed by nginx, scrape the backend port."""
+    content, content_type = render_metrics()
+    return Response(content, media_type=content_type)
+
+
+@app.get("/stats", response_model=Dict)
+async def stats_report():
+    """Hit rates and sizes of this worker's caches, how its searches were shared and its LLM routing."""
+    return {
+        "answers": query_cache.stats(),
+        "similar_answers": query_index.stats() if query_index is not None else None,
+        "search": search_cache.stats(),
+        "pages": page_cache.stats(),
+        "flights": search_flights.stats(),
+        "llm": LLM_ROUTER.stats(),
+        "refresh": answer_refresher.stats() if answer_refresher is not None else None,
     }
 
-    # Map backend stages to frontend stages
-    if stage_response.stage == SearchAllStage.SEARCH:
-        frontend_response["stage"] = "Querying Google"
-        if stage_response.data and "results" in stage_response.data:
-            # Convert search results to websearch_docs format
-            for idx, result in enumerate(stage_response.data["results"]):
-                url = result.get("link", "")
-                # Skip invalid URLs
-                if not url or not url.startswith(("http://", "https://")):
-                    continue
-                frontend_response["websearch_docs"].append(
-                    {
-                        "id": idx + 1,
-                        "title": result.get("title", "Untitled"),
-                        "url": url,
-                        "text": result.get("snippet", ""),
-                    }
-                )
 
-    elif stage_response.stage == SearchAllStage.SCRAPE:
-        frontend_response["stage"] = "Downloading Webpages"
-        # Keep existing websearch_docs
+@app.get("/debug/profile", response_class=PlainTextResponse)
+async def profile(seconds: float = Query(10, gt=0), interval_ms: float = Query(Profiling.INTERVAL_SECS * 1000, gt=0)):
+    """
+    Sample this worker's stacks for a while and return them as collapsed stacks for a flame graph,
+    e.g. `curl localhost:30001/debug/profile?seconds=30 | flamegraph.pl > flame.svg`. Only served when
+    PROFILING=1, and like /metrics not routed by nginx. Each request profiles whichever worker serves it.
+    Intervals shorter than Profiling.MIN_INTERVAL_SECS are raised to it.
+    """
+    if not Profiling.ENABLED:
+        return PlainTextResponse("Not Found", status_code=404)
+    sampler = profiler.start_profile(seconds, interval_ms / 1000)
+    if sampler is None:
+        return PlainTextResponse("A profile is already running in this worker", status_code=409)
+    try:
+        while sampler.is_running():
+            await asyncio.sleep(0.1)
+    finally:
+        sampler.stop()
+    return PlainTextResponse(
+        sampler.collapsed(), headers={"X-Profile-Pid": str(os.getpid()), "X-Profile-Samples": str(sampler.num_samples)}
+    )
 
-    elif stage_response.stage == SearchAllStage.LLM:
-        frontend_response["stage"] = "Results ready"
-        if stage_response.data and "response" in stage_response.data:
-            frontend_response["answer"] = stage_response.data["response"]
-        if stage_response.token_usage:
-            frontend_response["num_tokens_used"] = stage_response.token_usage.get("total_tokens", 0)
-        # Update websearch_docs with sources from LLM response if available
-        if stage_response.data and "sources" in stage_response.data:
-            # Update the websearch_docs with scraped content
-            for idx, source in enumerate(stage_response.data["sources"]):
-                if idx < len(frontend_response["websearch_docs"]):
-                    frontend_response["websearch_docs"][idx]["title"] = source.get(
-                        "title", frontend_response["websearch_docs"][idx]["title"]
-                    )
 
-    return json.dumps(frontend_response) + "[/PERPLEXED-SEPARATOR]"
+async def lookup_cached_response(cache_key: str):
+    """Look up a cached answer by normalized prompt, falling back to the most similar cached prompt."""
+    cached_response = await query_cache.aget(cache_key)
+    if query_index is None:
+        return cached_response
+    if cached_response:
+        query_index.add(cache_key)
+        return cached_response
+
+    match = query_index.lookup(cache_key)
+    if match is None:
+        return None
+    similar_key, similarity = match
+    cached_response = await query_cache.aget(similar_key)
+    if not cached_response:
+        query_index.remove(similar_key)
+        return None
+    logger.info(f"Similar cache hit for query: {cache_key!r} ~ {similar_key!r} ({similarity:.2f})")
+    return cached_response
+
+
+async def run_search_pipeline(user_prompt: str, cache_key: str) -> AsyncGenerator[StreamSearchResponse, None]:
+    """Run the search pipeline for a prompt and cache its final answer."""
+    async for stage_response in search_all_async(user_prompt):
+        yield stage_response
+
+        # Cache the final LLM response, with the frame answering it encoded once for every later hit
+        if stage_response.stage == SearchAllStage.LLM and stage_response.data:
+            cached_response = {
+                "data": stage_response.data,
+                "token_usage": stage_response.token_usage,
+                "cached_at": time.time(),
+            }
+            cached_response["frame_json"] = encode_json(cached_answer_frame(cached_response)).decode()
+            await query_cache.aset(cache_key, cached_response)
+            if query_index is not None:
+                query_index.add(cache_key)
+
+
+async def refresh_answer(user_prompt: str, cache_key: str) -> Optional[StreamSearchResponse]:
+    """
+    Rerun the pipeline for a prompt in the background to refresh its cached answer, returning the
+    final stage. Joins the run for the prompt already in flight if there is one, and vice versa.
+    """
+    final_response = None
+    async for stage_response in search_flights.subscribe(
+        cache_key, lambda: run_search_pipeline(user_prompt, cache_key)
+    ):
+        if stage_response.stage == SearchAllStage.LLM:
+            final_response = stage_response
+    return final_response
+
+
+# Keeps the answers to popular prompts warm, None when disabled
+answer_refresher = create_answer_refresher(
+    query_cache, refresh_answer, has_fresh_websearch_async, LLM_RATE_LIMITER, LLM_EXPECTED_COMPLETION_TOKENS
+)
 
 
 @app.post("/stream_search")
-async def stream_search(request: SearchRequest) -> StreamingResponse:
+async def stream_search(
+    request: SearchRequest, http_request: Request, format: Optional[Literal["json", "sse", "ndjson"]] = None
+) -> StreamingResponse:
     """
     Stream search results with multi-stage processing:
     1. Search stage - Google Custom Search
     2. Scrape stage - Web content extraction
-    3. LLM stage - AI-powered response generation
+    3. LLM stage - AI-powered response generation, streamed as it is generated
+
+    Frames are separated by [/PERPLEXED-SEPARATOR] by default, or sent as Server-Sent Events or
+    NDJSON when the format query parameter or the Accept header asks for text/event-stream or
+    application/x-ndjson. The stream is compressed when Accept-Encoding allows it.
     """
     user_prompt = request.user_prompt
+    cache_key = normalize_query(user_prompt)
+    transport = negotiate_transport(format, http_request.headers.get("accept", ""))
+    compressor = negotiate_compression(http_request.headers.get("accept-encoding", ""))
 
-    async def generate() -> AsyncGenerator[str, None]:
+    async def generate() -> AsyncGenerator[bytes, None]:
         """Generate streaming responses for each stage."""
-        websearch_docs = []  # Persist websearch_docs across stages
+        encoder = FrameEncoder(delta=request.delta, transport=transport)
 
         try:
             # Check cache first
-            cached_response = query_cache.get(user_prompt)
+            cached_response = await lookup_cached_response(cache_key)
+            CACHE_LOOKUPS.labels("answers", "hit" if cached_response else "miss").inc()
+            if answer_refresher is not None:
+                answer_refresher.record_hit(cache_key, user_prompt)
             if cached_response:
                 logger.info(f"Cache hit for query: {user_prompt}")
-                # Create a response that matches frontend expectations
-                frontend_cache_response = {
-                    "success": True,
-                    "stage": "Results ready",
-                    "num_tokens_used": cached_response.get("token_usage", {}).get("total_tokens", 0),
-                    "websearch_docs": [],
-                    "answer": cached_response["data"].get("response", ""),
-                    "message": "",
-                }
-
-                # Add sources as websearch_docs if available
-                if "sources" in cached_response["data"]:
-                    for idx, source in enumerate(cached_response["data"]["sources"]):
-                        url = source.get("url", "")
-                        # Skip invalid URLs
-                        if not url or not url.startswith(("http://", "https://")):
-                            continue
-                        frontend_cache_response["websearch_docs"].append(
-                            {"id": idx + 1, "title": source.get("title", "Untitled"), "url": url, "text": ""}
-                        )
-
-                yield json.dumps(frontend_cache_response) + "[/PERPLEXED-SEPARATOR]"
+                # Answers cached with their encoded frame are streamed as is, a single frame is the same in delta mode
+                frame_json = cached_response.get("frame_json")
+                yield transport.frame(
+                    frame_json.encode() if frame_json else encode_json(cached_answer_frame(cached_response))
+                )
                 return
 
             logger.info(f"Processing new query: {user_prompt}")
 
-            # Execute search pipeline
-            async for stage_response in search_all_async(user_prompt):
-                # Update websearch_docs from search stage
-                if (
-                    stage_response.stage == SearchAllStage.SEARCH
-                    and stage_response.data
-                    and "results" in stage_response.data
-                ):
-                    websearch_docs = []
-                    for idx, result in enumerate(stage_response.data["results"]):
-                        url = result.get("link", "")
-                        # Ensure URL is valid
-                        if not url or not url.startswith(("http://", "https://")):
-                            continue
-                        websearch_docs.append(
-                            {
-                                "id": idx + 1,
-                                "title": result.get("title", "Untitled"),
-                                "url": url,
-                                "text": result.get("snippet", ""),
-                            }
-                        )
-
-                yield transform_backend_to_frontend_response(stage_response, websearch_docs)
-
-                # Cache the final LLM response
-                if stage_response.stage == SearchAllStage.LLM and stage_response.data:
-                    query_cache.set(
-                        user_prompt, {"data": stage_response.data, "token_usage": stage_response.token_usage}
-                    )
+            # Execute search pipeline, or join the run already in flight for this prompt
+            async for stage_response in search_flights.subscribe(
+                cache_key, lambda: run_search_pipeline(user_prompt, cache_key)
+            ):
+                yield encoder.encode(stage_response)
 
         except Exception as e:
             logger.error(f"Error in stream_search: {str(e)}")
-            error_response = {
-                "success": False,
-                "stage": None,
-                "num_tokens_used": 0,
-                "websearch_docs": [],
-                "answer": "",
-                "message": f"An error occurred: {str(e)}",
-            }
-            yield json.dumps(error_response) + "[/PERPLEXED-SEPARATOR]"
-
+            yield encoder.encode_frame(frontend_frame(None, [], error=f"An error occurred: {str(e)}"))
+
+    headers = {
+        "X-Content-Type-Options": "nosniff",
+        "Cache-Control": "no-cache",
+        # Tells nginx not to buffer the stream, so every frame reaches the client as it is sent
+        "X-Accel-Buffering": "no",
+        "Vary": "Accept, Accept-Encoding",
+    }
+    if compressor is not None:
+        headers["Content-Encoding"] = compressor.encoding
     return StreamingResponse(
-        generate(),
-        media_type="application/json",
-        headers={"X-Content-Type-Options": "nosniff", "Cache-Control": "no-cache"},
+        write_stream(generate(), transport, compressor), media_type=transport.media_type, headers=headers
     )
 
 
@@ -0,0 +1,20 @@
+# Loaded by gunicorn from the working directory, alongside the command line flags in docker/
+import os
+import shutil
+
+# Workers write Prometheus samples here so /metrics can aggregate them, set before any worker imports the app
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/perplexed-metrics")
+
+# Imported up front, child_exit runs in the arbiter's SIGCHLD handler where a first import can be interrupted
+from prometheus_client import multiprocess  # noqa: E402
+
+
+def on_starting(server):
+    # Samples left by a previous run's workers would otherwise be summed in
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
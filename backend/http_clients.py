@@ -0,0 +1,80 @@
+import asyncio
+import urllib.parse
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import httpx
+
+from config import Http
+
+
+class HttpClients:
+    """
+    Process-wide pooled HTTP clients, so connections and TLS sessions to the search API, popular
+    webpage hosts and the LLM API are reused across requests. Clients are created lazily and
+    closed from the FastAPI lifespan.
+    """
+
+    # Upper bound on hosts tracked for per-host connection caps, least recently used are dropped
+    MAX_TRACKED_HOSTS = 1024
+
+    def __init__(self):
+        self._search = None
+        self._scrape = None
+        self._llm = None
+        self._host_semaphores: OrderedDict[str, asyncio.Semaphore] = OrderedDict()
+
+    @staticmethod
+    def _create(max_connections: int, max_keepalive_connections: int) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            http2=Http.HTTP2,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=Http.KEEPALIVE_EXPIRY_SECS,
+            ),
+        )
+
+    @property
+    def search(self) -> httpx.AsyncClient:
+        """Client for the web search API."""
+        if self._search is None or self._search.is_closed:
+            self._search = self._create(Http.SEARCH_MAX_CONNECTIONS, Http.SEARCH_MAX_CONNECTIONS)
+        return self._search
+
+    @property
+    def scrape(self) -> httpx.AsyncClient:
+        """Client for downloading webpages, use together with host_slot()."""
+        if self._scrape is None or self._scrape.is_closed:
+            self._scrape = self._create(Http.SCRAPE_MAX_CONNECTIONS, Http.SCRAPE_MAX_KEEPALIVE_CONNECTIONS)
+        return self._scrape
+
+    @property
+    def llm(self) -> httpx.AsyncClient:
+        """Client for the LLM API."""
+        if self._llm is None or self._llm.is_closed:
+            self._llm = self._create(Http.LLM_MAX_CONNECTIONS, Http.LLM_MAX_CONNECTIONS)
+        return self._llm
+
+    @asynccontextmanager
+    async def host_slot(self, url: str):
+        """Hold one of the Http.SCRAPE_MAX_CONNECTIONS_PER_HOST slots for the host of url."""
+        host = urllib.parse.urlsplit(url).hostname or ""
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(Http.SCRAPE_MAX_CONNECTIONS_PER_HOST)
+            self._host_semaphores[host] = semaphore
+            if len(self._host_semaphores) > self.MAX_TRACKED_HOSTS:
+                self._host_semaphores.popitem(last=False)
+        else:
+            self._host_semaphores.move_to_end(host)
+        async with semaphore:
+            yield
+
+    async def aclose(self):
+        for client in (self._search, self._scrape, self._llm):
+            if client is not None:
+                await client.aclose()
+
+
+HTTP_CLIENTS = HttpClients()
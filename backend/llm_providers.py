@@ -0,0 +1,355 @@
+import asyncio
+import contextlib
+import json
+import os
+import random
+import time
+from typing import AsyncGenerator, List, Optional
+
+import groq
+import httpx
+
+from config import Model, Secrets
+from http_clients import HTTP_CLIENTS
+from models import TokenUsage
+import tracing
+from tracing import print_log
+
+
+class LLMUnavailableError(Exception):
+    pass
+
+
+class ProviderStats:
+    """Exponentially weighted moving averages of a provider's time to first token and error rate."""
+
+    ALPHA = 0.2
+    # Assumed time to first token before a provider has any samples, optimistic so new providers get tried
+    INITIAL_TTFT_SECS = 1.0
+
+    def __init__(self):
+        self.ttft_secs = self.INITIAL_TTFT_SECS
+        self.ttft_dev_secs = self.INITIAL_TTFT_SECS / 2
+        self.error_rate = 0.0
+        self.num_requests = 0
+
+    def record_success(self, ttft_secs: float):
+        self.ttft_dev_secs += self.ALPHA * (abs(ttft_secs - self.ttft_secs) - self.ttft_dev_secs)
+        self.ttft_secs += self.ALPHA * (ttft_secs - self.ttft_secs)
+        self.error_rate *= 1 - self.ALPHA
+        self.num_requests += 1
+
+    def record_censored(self, elapsed_secs: float):
+        """Record an attempt abandoned before its first token, whose time to first token exceeded elapsed_secs."""
+        ttft_secs = max(elapsed_secs, self.ttft_secs)
+        self.ttft_dev_secs += self.ALPHA * (abs(ttft_secs - self.ttft_secs) - self.ttft_dev_secs)
+        self.ttft_secs += self.ALPHA * (ttft_secs - self.ttft_secs)
+        self.num_requests += 1
+
+    def record_error(self):
+        self.error_rate += self.ALPHA * (1 - self.error_rate)
+        self.num_requests += 1
+
+    def p95_ttft_secs(self) -> float:
+        """Rough p95 of time to first token, assuming roughly normal latencies."""
+        return self.ttft_secs + 2 * self.ttft_dev_secs
+
+    def score(self) -> float:
+        """Expected cost of routing to this provider, lower is better."""
+        return self.ttft_secs + Model.LLM_ERROR_PENALTY_SECS * self.error_rate
+
+    def to_dict(self) -> dict:
+        return {
+            "ttft_secs": round(self.ttft_secs, 3),
+            "p95_ttft_secs": round(self.p95_ttft_secs(), 3),
+            "error_rate": round(self.error_rate, 3),
+            "requests": self.num_requests,
+        }
+
+
+class LLMProvider:
+    """A chat completion endpoint and model, streaming answers as text chunks."""
+
+    def __init__(self, name: str, model: str):
+        self.name = name
+        self.model = model
+        self.stats = ProviderStats()
+
+    def stream_chat(self, messages: List[dict], max_tokens: int, token_usage: TokenUsage) -> AsyncGenerator[str, None]:
+        """Stream the answer as text chunks, adding the reported token usage to token_usage."""
+        raise NotImplementedError
+
+
+class GroqProvider(LLMProvider):
+    def __init__(self, name: str, model: str, api_key: str):
+        super().__init__(name, model)
+        # Workaround for groq/httpx compatibility issue, also shares the pooled client lifecycle
+        self.client = groq.AsyncGroq(api_key=api_key, http_client=HTTP_CLIENTS.llm)
+
+    async def stream_chat(self, messages, max_tokens, token_usage):
+        stream = await self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            stream=True,
+        )
+
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+            # Groq reports usage on the final chunk, under x_groq for its own API
+            usage = chunk.usage or (chunk.x_groq.usage if chunk.x_groq else None)
+            if usage:
+                token_usage.add(
+                    TokenUsage(
+                        prompt_tokens=usage.prompt_tokens,
+                        completion_tokens=usage.completion_tokens,
+                        total_tokens=usage.total_tokens,
+                    )
+                )
+
+
+class OpenAICompatibleProvider(LLMProvider):
+    """Any endpoint speaking the OpenAI chat completions API with server-sent events."""
+
+    def __init__(self, name: str, model: str, base_url: str, api_key: str):
+        super().__init__(name, model)
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+
+    async def stream_chat(self, messages, max_tokens, token_usage):
+        async with HTTP_CLIENTS.llm.stream(
+            "POST",
+            f"{self.base_url}/chat/completions",
+            json={
+                "model": self.model,
+                "messages": messages,
+                "max_tokens": max_tokens,
+                "stream": True,
+                "stream_options": {"include_usage": True},
+            },
+            # Local endpoints such as vLLM or Ollama may not need a key
+            headers={"Authorization": f"Bearer {self.api_key}"} if self.api_key else None,
+            timeout=httpx.Timeout(Model.LLM_READ_TIMEOUT_SECS, connect=Model.LLM_CONNECT_TIMEOUT_SECS),
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:") :].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                choices = chunk.get("choices") or []
+                if choices and choices[0].get("delta", {}).get("content"):
+                    yield choices[0]["delta"]["content"]
+                usage = chunk.get("usage") or (chunk.get("x_groq") or {}).get("usage")
+                if usage:
+                    token_usage.add(TokenUsage(**{k: usage.get(k, 0) for k in TokenUsage.model_fields}))
+
+
+class FakeProvider(LLMProvider):
+    """Local stand-in that streams a canned answer, with configurable latency and failure rate, for tests."""
+
+    def __init__(
+        self,
+        name: str = "fake",
+        model: str = "fake",
+        answer: str = "This is a fake answer from the local test provider.",
+        ttft_secs: float = 0.05,
+        chunk_delay_secs: float = 0.01,
+        failure_rate: float = 0.0,
+    ):
+        super().__init__(name, model)
+        self.answer = answer
+        self.ttft_secs = ttft_secs
+        self.chunk_delay_secs = chunk_delay_secs
+        self.failure_rate = failure_rate
+
+    async def stream_chat(self, messages, max_tokens, token_usage):
+        await asyncio.sleep(self.ttft_secs)
+        if random.random() < self.failure_rate:
+            raise LLMUnavailableError(f"{self.name} failed")
+        words = self.answer.split(" ")
+        for i, word in enumerate(words[:max_tokens]):
+            if i:
+                await asyncio.sleep(self.chunk_delay_secs)
+            yield word if i == 0 else " " + word
+        prompt_tokens = sum(len(message["content"].split()) for message in messages)
+        completion_tokens = min(len(words), max_tokens)
+        token_usage.add(
+            TokenUsage(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            )
+        )
+
+
+class _Attempt:
+    """One provider's stream, with its first chunk being awaited in a task so attempts can race."""
+
+    def __init__(self, provider: LLMProvider, messages: List[dict], max_tokens: int):
+        self.provider = provider
+        self.token_usage = TokenUsage()
+        self.started_at = time.monotonic()
+        self.stream = provider.stream_chat(messages, max_tokens, self.token_usage)
+        self.first_chunk = asyncio.ensure_future(anext(self.stream, ""))
+
+    def discarded_usage(self, estimated_prompt_tokens: int) -> TokenUsage:
+        """Tokens spent by an abandoned attempt, as reported if it got that far, else its prompt as estimated."""
+        if self.token_usage.total_tokens:
+            return self.token_usage
+        return TokenUsage(prompt_tokens=estimated_prompt_tokens, total_tokens=estimated_prompt_tokens)
+
+    async def aclose(self):
+        self.first_chunk.cancel()
+        with contextlib.suppress(BaseException):
+            await self.first_chunk
+        with contextlib.suppress(Exception):
+            await self.stream.aclose()
+
+
+class LLMRouter:
+    """
+    Routes each chat completion to the provider with the best latency and error EWMAs, failing over
+    to the next provider when one errors before its first token. With hedging on, a second provider
+    is started when the first has not produced a token within its p95 time to first token, and
+    whichever answers first wins while the other is cancelled, its wait counted as a lower bound
+    on its latency. A fraction explore_rate of requests goes first to the least sampled provider.
+    """
+
+    def __init__(
+        self,
+        providers: List[LLMProvider],
+        hedge: bool = False,
+        hedge_min_delay_secs: float = 0.5,
+        explore_rate: float = 0.0,
+    ):
+        self.providers = providers
+        self.hedge = hedge
+        self.hedge_min_delay_secs = hedge_min_delay_secs
+        self.explore_rate = explore_rate
+        self.num_hedges = 0
+
+    def ranked(self) -> List[LLMProvider]:
+        ranked = sorted(self.providers, key=lambda provider: provider.stats.score())
+        if len(ranked) > 1 and random.random() < self.explore_rate:
+            least_sampled = min(ranked[1:], key=lambda provider: provider.stats.num_requests)
+            ranked.remove(least_sampled)
+            ranked.insert(0, least_sampled)
+        return ranked
+
+    async def stream_chat(
+        self,
+        messages: List[dict],
+        max_tokens: int,
+        token_usage: TokenUsage,
+        discarded_usage: Optional[TokenUsage] = None,
+        estimated_prompt_tokens: int = 0,
+    ) -> AsyncGenerator[str, None]:
+        """
+        Stream the answer from the winning provider, adding its reported token usage to token_usage.
+        Attempts abandoned after their request was sent, hedging losers or all of them when the caller
+        goes away, add what they spent to discarded_usage, their prompt as estimated unless reported.
+        """
+        candidates = self.ranked()
+        attempts: List[_Attempt] = []
+        winner: Optional[_Attempt] = None
+        first_chunk = ""
+        try:
+            while winner is None:
+                if not attempts:
+                    if not candidates:
+                        raise LLMUnavailableError("All LLM providers failed")
+                    attempts.append(_Attempt(candidates.pop(0), messages, max_tokens))
+
+                hedge_delay = None
+                if self.hedge and candidates and len(attempts) == 1:
+                    elapsed = time.monotonic() - attempts[0].started_at
+                    hedge_delay = max(attempts[0].provider.stats.p95_ttft_secs(), self.hedge_min_delay_secs) - elapsed
+                done, _ = await asyncio.wait(
+                    [attempt.first_chunk for attempt in attempts],
+                    timeout=max(hedge_delay, 0) if hedge_delay is not None else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    self.num_hedges += 1
+                    attempts.append(_Attempt(candidates.pop(0), messages, max_tokens))
+                    continue
+
+                for attempt in list(attempts):
+                    if not attempt.first_chunk.done():
+                        continue
+                    if attempt.first_chunk.exception() is None:
+                        winner = attempt
+                        first_chunk = attempt.first_chunk.result()
+                        break
+                    print_log(f"LLM provider {attempt.provider.name} failed: {attempt.first_chunk.exception()}")
+                    attempt.provider.stats.record_error()
+                    attempts.remove(attempt)
+        finally:
+            for attempt in attempts:
+                if attempt is not winner:
+                    # Cancelled before its first token, but the prompt was already sent. A hedging loser
+                    # took at least this long, so a stalled provider loses its rank
+                    if winner is not None:
+                        attempt.provider.stats.record_censored(time.monotonic() - attempt.started_at)
+                    await attempt.aclose()
+                    if discarded_usage is not None:
+                        discarded_usage.add(attempt.discarded_usage(estimated_prompt_tokens))
+
+        winner.provider.stats.record_success(time.monotonic() - winner.started_at)
+        span = tracing.current_span()
+        span.set_attribute("llm.provider", winner.provider.name)
+        span.set_attribute("llm.model", winner.provider.model)
+        span.set_attribute("llm.attempts", len(self.providers) - len(candidates))
+        try:
+            if first_chunk:
+                yield first_chunk
+            async for chunk in winner.stream:
+                yield chunk
+        except Exception:
+            winner.provider.stats.record_error()
+            raise
+        finally:
+            token_usage.add(winner.token_usage)
+            await winner.stream.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "hedges": self.num_hedges,
+            "providers": {provider.name: provider.stats.to_dict() for provider in self.providers},
+        }
+
+
+def create_provider(spec: dict) -> LLMProvider:
+    """
+    Create a provider from its LLM_PROVIDERS entry, e.g.
+    {"name": "groq", "type": "groq", "model": "openai/gpt-oss-20b"} or
+    {"name": "together", "type": "openai", "base_url": "https://api.together.xyz/v1",
+     "api_key_env": "TOGETHER_API_KEY", "model": "openai/gpt-oss-20b"}
+    """
+    provider_type = spec.get("type", "openai")
+    name = spec.get("name", provider_type)
+    if provider_type == "groq":
+        api_key = os.environ[spec["api_key_env"]] if "api_key_env" in spec else Secrets.GROQ_API_KEY
+        return GroqProvider(name, spec["model"], api_key)
+    if provider_type == "openai":
+        api_key = os.environ.get(spec["api_key_env"], "") if "api_key_env" in spec else ""
+        return OpenAICompatibleProvider(name, spec["model"], spec["base_url"], api_key)
+    if provider_type == "fake":
+        return FakeProvider(name=name, **{k: v for k, v in spec.items() if k not in ("name", "type")})
+    raise ValueError(f"Unknown LLM provider type: {provider_type}")
+
+
+def create_router(default_groq_model: str) -> LLMRouter:
+    """Router over the providers in Model.LLM_PROVIDERS, or just Groq with default_groq_model when unset."""
+    specs = json.loads(Model.LLM_PROVIDERS) if Model.LLM_PROVIDERS else [{"type": "groq", "model": default_groq_model}]
+    return LLMRouter(
+        [create_provider(spec) for spec in specs],
+        hedge=Model.LLM_HEDGE,
+        hedge_min_delay_secs=Model.LLM_HEDGE_MIN_DELAY_SECS,
+        explore_rate=Model.LLM_EXPLORE_RATE,
+    )
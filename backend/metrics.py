@@ -0,0 +1,62 @@
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Under gunicorn each worker writes its samples to PROMETHEUS_MULTIPROC_DIR, which must be set
+# before prometheus_client is imported (see gunicorn.conf.py), and /metrics aggregates them
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 30, 60)
+
+STAGE_SECONDS = Histogram(
+    "perplexed_stage_seconds",
+    "Latency of each search pipeline stage: search, scrape (per page), extract (per page), prompt, "
+    "llm_ttft and llm_total",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    "perplexed_http_request_seconds",
+    "HTTP request latency until the response body has been fully sent, streams included",
+    ["method", "path", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+CACHE_LOOKUPS = Counter(
+    "perplexed_cache_lookups_total", "Cache lookups by cache and result (hit, stale or miss)", ["cache", "result"]
+)
+SCRAPE_FAILURES = Counter("perplexed_scrape_failures_total", "Webpages that yielded no text, by reason", ["reason"])
+LLM_TOKENS = Counter("perplexed_llm_tokens_total", "Tokens used by LLM calls, by kind (prompt or completion)", ["kind"])
+ANSWER_REFRESHES = Counter(
+    "perplexed_answer_refreshes_total",
+    "Background answer refreshes by result (refreshed, failed, over_budget or busy)",
+    ["result"],
+)
+
+
+@contextmanager
+def time_stage(stage: str):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start_time)
+
+
+def render_metrics():
+    """Exposition of every metric, summed across gunicorn workers in multiprocess mode, and its content type."""
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -5,11 +5,16 @@ from enum import Enum
 
 class SearchRequest(BaseModel):
     user_prompt: str = Field(..., min_length=1, description="Search query")
+    delta: bool = Field(False, description="Send only what changed since the previous frame, answers as appended text")
 
 
 class SearchAllStage(str, Enum):
     SEARCH = "search"
     SCRAPE = "scrape"
+    # Waiting for LLM token quota, data has the "timeout_secs" before giving up
+    BUSY = "busy"
+    # Partial answer while the LLM is still generating, data has the new "delta" and the "response" so far
+    LLM_STREAM = "llm_stream"
     LLM = "llm"
 
 
@@ -38,9 +43,9 @@ class TokenUsage(BaseModel):
 
 
 class SearchResult(BaseModel):
-    """Model for search result from Google Custom Search API."""
+    """Model for a web search result, as returned by the Google Custom Search API."""
 
     title: str
     link: str
-    snippet: str
+    snippet: str = ""
     displayLink: Optional[str] = None
@@ -0,0 +1,97 @@
+import re
+from typing import List, Tuple
+
+import numpy as np
+
+term_regex = re.compile(r"\w+")
+sentence_end_regex = re.compile(r"(?<=[.!?])\s+")
+
+# Question words and glue that say nothing about which passage answers the question
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i", "in", "is",
+    "it", "of", "on", "or", "that", "the", "this", "to", "was", "what", "when", "where", "which", "who", "why",
+    "will", "with", "you",
+}  # fmt: skip
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def split_passages(text: str, passage_words: int) -> List[str]:
+    """Split text into passages of whole sentences, each around passage_words words."""
+    passages = []
+    current: List[str] = []
+    num_words = 0
+    for sentence in sentence_end_regex.split(text):
+        sentence_words = len(sentence.split())
+        if current and num_words + sentence_words > passage_words:
+            passages.append(" ".join(current))
+            current, num_words = [], 0
+        current.append(sentence)
+        num_words += sentence_words
+    if current:
+        passages.append(" ".join(current))
+    return passages
+
+
+def query_terms(query: str) -> List[str]:
+    terms = [term for term in term_regex.findall(query.casefold()) if term not in STOPWORDS]
+    # Keep every term when the query is nothing but stopwords
+    return list(dict.fromkeys(terms or term_regex.findall(query.casefold())))
+
+
+def bm25_scores(query: str, passages: List[str]) -> np.ndarray:
+    """
+    Okapi BM25 score of each passage against the query, with IDF computed over the passages
+    themselves. Only query terms are counted, so cost is linear in the passage text.
+    """
+    terms = query_terms(query)
+    if not terms or not passages:
+        return np.zeros(len(passages))
+    term_index = {term: i for i, term in enumerate(terms)}
+
+    lengths = np.empty(len(passages))
+    hit_passages = []
+    hit_terms = []
+    for p, passage in enumerate(passages):
+        words = term_regex.findall(passage.casefold())
+        lengths[p] = len(words)
+        for word in words:
+            t = term_index.get(word)
+            if t is not None:
+                hit_passages.append(p)
+                hit_terms.append(t)
+
+    tf = np.zeros((len(passages), len(terms)))
+    np.add.at(tf, (np.array(hit_passages, dtype=np.intp), np.array(hit_terms, dtype=np.intp)), 1)
+
+    doc_freq = np.count_nonzero(tf, axis=0)
+    idf = np.log1p((len(passages) - doc_freq + 0.5) / (doc_freq + 0.5))
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / max(lengths.mean(), 1))
+    return (tf * (BM25_K1 + 1) / (tf + norm[:, None])) @ idf
+
+
+def rank_documents(query: str, texts: List[str], passage_words: int, top_passages: int) -> List[Tuple[str, float]]:
+    """
+    Rank the passages of each document against the query.
+
+    Returns, for each document, its text rebuilt from its matching passages ordered best first
+    (so truncation drops the weakest ones), and its relevance: the sum of its top_passages passage
+    scores. Documents without any matching passage keep their text and get zero relevance.
+    """
+    doc_passages = [split_passages(text, passage_words) for text in texts]
+    flat = [passage for passages in doc_passages for passage in passages]
+    scores = bm25_scores(query, flat)
+
+    ranked = []
+    start = 0
+    for passages in doc_passages:
+        doc_scores = scores[start : start + len(passages)]
+        start += len(passages)
+        order = [i for i in np.argsort(-doc_scores, kind="stable") if doc_scores[i] > 0]
+        if not order:
+            ranked.append((" ".join(passages), 0.0))
+            continue
+        text = "\n...\n".join(passages[i] for i in order)
+        ranked.append((text, float(doc_scores[order[:top_passages]].sum())))
+    return ranked
@@ -0,0 +1,123 @@
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, Optional
+
+from config import Profiling
+from tracing import print_log
+
+
+class SamplingProfiler:
+    """
+    Samples the Python stack of every thread at a fixed interval from a background thread, and
+    aggregates the samples as collapsed stacks ("thread;outer;...;inner count" per line), the input
+    format of flamegraph.pl, speedscope and most flame graph viewers. Sampling takes the GIL for a
+    moment per sample, so overhead stays small at the default 100 samples per second.
+    """
+
+    def __init__(self, interval_secs: float = Profiling.INTERVAL_SECS):
+        self.interval_secs = interval_secs
+        self.samples = Counter()
+        self.num_samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._frame_names = {}
+
+    def _frame_name(self, code) -> str:
+        name = self._frame_names.get(code)
+        if name is None:
+            filename = code.co_filename
+            # Shortest path relative to sys.path, so stacks read as module paths
+            for path in sorted(filter(None, sys.path), key=len, reverse=True):
+                if filename.startswith(path + os.sep):
+                    filename = filename[len(path) + 1 :]
+                    break
+            name = f"{code.co_name} ({filename}:{code.co_firstlineno})"
+            self._frame_names[code] = name
+        return name
+
+    def sample(self):
+        threads = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == threading.get_ident():
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.append(threads.get(thread_id, str(thread_id)))
+            self.samples[";".join(reversed(stack))] += 1
+        self.num_samples += 1
+
+    def _run(self, duration_secs: float, on_done: Optional[Callable[["SamplingProfiler"], None]]):
+        deadline = time.monotonic() + duration_secs
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            self.sample()
+            self._stop.wait(self.interval_secs)
+        if on_done is not None:
+            on_done(self)
+
+    def start(self, duration_secs: float, on_done: Optional[Callable[["SamplingProfiler"], None]] = None):
+        self._thread = threading.Thread(target=self._run, args=(duration_secs, on_done), name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+# One profile at a time per worker, started from the endpoint or the signal
+_active: Optional[SamplingProfiler] = None
+_lock = threading.Lock()
+
+
+def start_profile(duration_secs: float, interval_secs: float = Profiling.INTERVAL_SECS, on_done=None):
+    """
+    Start profiling this worker for duration_secs, at most Profiling.MAX_SECS, returns None when a
+    profile is already running. The interval is kept between Profiling.MIN_INTERVAL_SECS and the duration.
+    """
+    global _active
+    duration_secs = min(duration_secs, Profiling.MAX_SECS)
+    interval_secs = min(max(interval_secs, Profiling.MIN_INTERVAL_SECS), duration_secs)
+    with _lock:
+        if _active is not None and _active.is_running():
+            return None
+        _active = SamplingProfiler(interval_secs)
+        _active.start(duration_secs, on_done)
+        return _active
+
+
+def _write_profile(profiler: SamplingProfiler):
+    path = os.path.join(Profiling.OUTPUT_DIR, f"perplexed-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+    os.makedirs(Profiling.OUTPUT_DIR, exist_ok=True)
+    with open(path, "w") as f:
+        f.write(profiler.collapsed())
+    print_log(f"Wrote profile of {profiler.num_samples} samples to {path}")
+
+
+def _start_signal_profile():
+    if start_profile(Profiling.SIGNAL_SECS, on_done=_write_profile) is None:
+        print_log("Profile already running, ignoring signal")
+
+
+def _handle_signal(signum, frame):
+    # Runs between bytecodes on the main thread, which may be inside start_profile holding _lock, so the
+    # profile is started from a thread of its own rather than here
+    threading.Thread(target=_start_signal_profile, name="profiler-signal", daemon=True).start()
+
+
+def install_signal_handler():
+    """
+    Profile the worker for Profiling.SIGNAL_SECS on SIGUSR2 and write the collapsed stacks to
+    Profiling.OUTPUT_DIR, e.g. `kill -USR2 <worker pid>`. Gunicorn leaves SIGUSR2 unhandled in workers
+    (it only upgrades the binary on the master's), so the app can take it over.
+    """
+    signal.signal(signal.SIGUSR2, _handle_signal)
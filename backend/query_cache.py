@@ -1,25 +1,151 @@
-import threading
+import asyncio
+import sys
+import time
+from collections import OrderedDict
+
+from config import Cache
+
+
+def approx_size(value) -> int:
+    """Approximate the memory footprint of a cached value in bytes."""
+    if isinstance(value, str):
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(approx_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class _CacheEntry:
+    __slots__ = ("value", "size", "expires_at")
+
+    def __init__(self, value, size, expires_at):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
 
 
 class QueryCache:
-    def __init__(self):
-        self.cache = {}
-        self.lock = threading.Lock()
+    """
+    Size- and byte-bounded LRU cache with per-entry TTL.
+
+    Meant to be used from a single asyncio event loop, so no lock is taken:
+    every synchronous method runs to completion without awaiting.
+
+    An optional shared store (see cache_store.py) acts as a second tier behind the in-process
+    LRU. The async methods consult it only on a local miss, off the event loop, and copy what
+    they find into the local tier so hot keys never touch disk.
+    """
+
+    def __init__(
+        self,
+        max_entries=Cache.QUERY_CACHE_MAX_ENTRIES,
+        max_bytes=Cache.QUERY_CACHE_MAX_BYTES,
+        ttl_secs=Cache.QUERY_CACHE_TTL_SECS,
+        store=None,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_secs = ttl_secs
+        self.cache: OrderedDict[str, _CacheEntry] = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.store = store
+        self.store_hits = 0
+        # Hits on entries past their freshness window, see record_stale_hit
+        self.stale_hits = 0
 
     def get(self, key):
-        value = None
-        with self.lock:
-            value = self.cache.get(key)
-        return value
+        entry = self.cache.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.cache.move_to_end(key)
+        self.hits += 1
+        return entry.value
 
-    def set(self, key, value):
-        with self.lock:
-            self.cache[key] = value
+    def set(self, key, value, ttl_secs=None):
+        size = approx_size(key) + approx_size(value)
+        if size > self.max_bytes:
+            return
+        self._remove(key)
+        ttl_secs = self.ttl_secs if ttl_secs is None else ttl_secs
+        self.cache[key] = _CacheEntry(value, size, time.monotonic() + ttl_secs)
+        self.num_bytes += size
+        while len(self.cache) > self.max_entries or self.num_bytes > self.max_bytes:
+            oldest_key = next(iter(self.cache))
+            self._remove(oldest_key)
+            self.evictions += 1
 
     def delete(self, key):
-        with self.lock:
-            self.cache.pop(key, None)
+        self._remove(key)
+
+    def record_stale_hit(self):
+        """Count a hit on an entry past its freshness window, for callers that revalidate it."""
+        self.stale_hits += 1
 
     def clear(self):
-        with self.lock:
-            self.cache = {}
+        self.cache = OrderedDict()
+        self.num_bytes = 0
+
+    async def aget(self, key):
+        """Look up the local tier, falling back to the shared store."""
+        value = self.get(key)
+        if value is not None or self.store is None:
+            return value
+        found = await asyncio.to_thread(self.store.get, key)
+        if found is None:
+            return None
+        value, expires_at = found
+        self.set(key, value, ttl_secs=expires_at - time.time())
+        self.store_hits += 1
+        return value
+
+    async def apeek(self, key):
+        """Look up both tiers like aget, for background checks: no stats, recency or local copies."""
+        entry = self.cache.get(key)
+        if entry is not None and entry.expires_at > time.monotonic():
+            return entry.value
+        if self.store is None:
+            return None
+        found = await asyncio.to_thread(self.store.get, key)
+        return found[0] if found is not None else None
+
+    async def aset(self, key, value, ttl_secs=None):
+        """Write through to both the local tier and the shared store."""
+        self.set(key, value, ttl_secs=ttl_secs)
+        if self.store is not None:
+            ttl_secs = self.ttl_secs if ttl_secs is None else ttl_secs
+            await asyncio.to_thread(self.store.set, key, value, time.time() + ttl_secs)
+
+    async def adelete(self, key):
+        self.delete(key)
+        if self.store is not None:
+            await asyncio.to_thread(self.store.delete, key)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.cache),
+            "bytes": self.num_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "store_hits": self.store_hits,
+            "stale_hits": self.stale_hits,
+            "hit_rate": round(self.hits / (self.hits + self.misses), 3) if self.hits + self.misses else 0.0,
+        }
+
+    def _remove(self, key):
+        entry = self.cache.pop(key, None)
+        if entry is not None:
+            self.num_bytes -= entry.size
@@ -0,0 +1,117 @@
+import hashlib
+import random
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+# Punctuation that changes what a query means, e.g. "c#" or "100%"
+KEEP_PUNCTUATION = {"#", "%", "&", "@"}
+
+
+def normalize_query(query: str) -> str:
+    """
+    Canonicalize a prompt into a cache key.
+
+    Applies Unicode NFKC normalization and case folding, drops punctuation (keeping it inside
+    words such as "node.js" or "3.14") and collapses whitespace, so that "What is Rust?",
+    "what is rust" and "what is  rust ?" share a key.
+    """
+    text = unicodedata.normalize("NFKC", query).casefold()
+    chars = []
+    for i, char in enumerate(text):
+        if char.isspace():
+            chars.append(" ")
+        elif unicodedata.category(char).startswith("P") and char not in KEEP_PUNCTUATION:
+            inside_word = 0 < i < len(text) - 1 and text[i - 1].isalnum() and text[i + 1].isalnum()
+            chars.append(char if inside_word else " ")
+        else:
+            chars.append(char)
+    return " ".join("".join(chars).split())
+
+
+def shingles(normalized_query: str) -> set:
+    """Word unigrams and bigrams, so that swapping a single word changes most of the set."""
+    words = normalized_query.split()
+    return set(words) | {f"{a} {b}" for a, b in zip(words, words[1:])}
+
+
+class MinHashIndex:
+    """
+    Approximate nearest-key lookup over normalized queries using MinHash signatures of word
+    shingles, bucketed with LSH banding. CPU-only and bounded in size, oldest keys are evicted first.
+    """
+
+    MERSENNE_PRIME = (1 << 61) - 1
+
+    def __init__(self, threshold: float, num_perm: int = 64, num_bands: int = 16, max_entries: int = 10_000):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.num_bands = num_bands
+        self.rows_per_band = num_perm // num_bands
+        self.max_entries = max_entries
+        rng = random.Random(0)
+        self.perms = [
+            (rng.randrange(1, self.MERSENNE_PRIME), rng.randrange(0, self.MERSENNE_PRIME)) for _ in range(num_perm)
+        ]
+        self.signatures: OrderedDict[str, List[int]] = OrderedDict()
+        self.buckets: dict = {}
+        self.lookups = 0
+        self.hits = 0
+
+    def signature(self, normalized_query: str) -> List[int]:
+        hashes = [
+            int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "little")
+            for s in shingles(normalized_query)
+        ]
+        if not hashes:
+            return [self.MERSENNE_PRIME] * self.num_perm
+        p = self.MERSENNE_PRIME
+        return [min((a * h + b) % p for h in hashes) for a, b in self.perms]
+
+    def _bands(self, signature: List[int]):
+        r = self.rows_per_band
+        for band in range(self.num_bands):
+            yield band, tuple(signature[band * r : (band + 1) * r])
+
+    def add(self, key: str):
+        if key in self.signatures:
+            self.signatures.move_to_end(key)
+            return
+        signature = self.signature(key)
+        self.signatures[key] = signature
+        for band in self._bands(signature):
+            self.buckets.setdefault(band, set()).add(key)
+        while len(self.signatures) > self.max_entries:
+            self.remove(next(iter(self.signatures)))
+
+    def remove(self, key: str):
+        signature = self.signatures.pop(key, None)
+        if signature is None:
+            return
+        for band in self._bands(signature):
+            bucket = self.buckets.get(band)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self.buckets[band]
+
+    def lookup(self, key: str) -> Optional[Tuple[str, float]]:
+        """Return the most similar indexed key and its estimated Jaccard similarity, if above threshold."""
+        self.lookups += 1
+        signature = self.signature(key)
+        candidates = set()
+        for band in self._bands(signature):
+            candidates |= self.buckets.get(band, set())
+        best_key, best_score = None, 0.0
+        for candidate in candidates:
+            other = self.signatures[candidate]
+            score = sum(x == y for x, y in zip(signature, other)) / self.num_perm
+            if score > best_score:
+                best_key, best_score = candidate, score
+        if best_key is None or best_score < self.threshold:
+            return None
+        self.hits += 1
+        return best_key, best_score
+
+    def stats(self) -> dict:
+        return {"entries": len(self.signatures), "lookups": self.lookups, "hits": self.hits}
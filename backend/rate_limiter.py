@@ -1,43 +1,181 @@
-import time
-from collections import deque
+import asyncio
 import threading
+import time
+
+from cache_store import connect_database
+from config import Cache
+
+
+class TokenBucket:
+    """
+    In-process token bucket: holds up to `capacity` tokens and refills at `refill_per_sec`.
+    Every operation is O(1). The level may go negative to record usage beyond what was reserved.
+    """
+
+    def __init__(self, capacity: float, refill_per_sec: float):
+        self.capacity = capacity
+        self.refill_per_sec = refill_per_sec
+        self.level = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.refill_per_sec)
+        self.updated_at = now
+
+    def try_consume(self, amount: float) -> float:
+        """Take amount tokens if available and return 0, else return the seconds until they will be."""
+        self._refill()
+        # Amounts beyond capacity are admitted once the bucket is full, rather than never
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            self.level -= amount
+            return 0.0
+        return (amount - self.level) / self.refill_per_sec
+
+    def consume(self, amount: float):
+        """Take (or, when negative, give back) tokens unconditionally."""
+        self._refill()
+        self.level = min(self.capacity, self.level - amount)
+
+    def available(self) -> float:
+        self._refill()
+        return self.level
+
+
+class SqliteTokenBucket:
+    """
+    Token bucket shared by every worker process on a node, kept as a single row of the node-wide
+    SQLite database and updated in an immediate transaction, so each operation is O(1).
+    Methods block on disk I/O; call them from a worker thread.
+    """
+
+    def __init__(self, path: str, name: str, capacity: float, refill_per_sec: float):
+        self.path = path
+        self.name = name
+        self.capacity = capacity
+        self.refill_per_sec = refill_per_sec
+        self._local = threading.local()
+        self._connect()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect_database(self.path)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS token_buckets ("
+                "name TEXT PRIMARY KEY, level REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def _update(self, amount: float, conditional: bool) -> float:
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = conn.execute("SELECT level, updated_at FROM token_buckets WHERE name = ?", (self.name,)).fetchone()
+            level = self.capacity if row is None else min(self.capacity, row[0] + (now - row[1]) * self.refill_per_sec)
+            wait_secs = 0.0
+            if conditional:
+                amount = min(amount, self.capacity)
+                if level < amount:
+                    wait_secs = (amount - level) / self.refill_per_sec
+                    amount = 0
+            level = min(self.capacity, level - amount)
+            conn.execute("INSERT OR REPLACE INTO token_buckets VALUES (?, ?, ?)", (self.name, level, now))
+            conn.execute("COMMIT")
+            return wait_secs
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def try_consume(self, amount: float) -> float:
+        return self._update(amount, conditional=True)
+
+    def consume(self, amount: float):
+        self._update(amount, conditional=False)
+
+    def available(self) -> float:
+        row = (
+            self._connect()
+            .execute("SELECT level, updated_at FROM token_buckets WHERE name = ?", (self.name,))
+            .fetchone()
+        )
+        if row is None:
+            return self.capacity
+        return min(self.capacity, row[0] + (time.time() - row[1]) * self.refill_per_sec)
 
 
 class RateLimiter:
-    def __init__(self, limit_tokens_per_minute):
+    """
+    Admission control for a tokens-per-minute quota, e.g. the LLM provider's TPM limit.
+
+    Callers reserve an estimate with acquire() before using the quota, queueing in FIFO order for
+    up to a deadline, then report the difference from actual usage with record(). The bucket is
+    shared across workers through the node-wide database when Cache.CACHE_DB_PATH is set.
+    """
+
+    # Upper bound on a single sleep while queued, so waiters notice capacity freed by other workers
+    MAX_POLL_SECS = 1.0
+
+    def __init__(self, limit_tokens_per_minute: int, name: str = "default"):
         self.limit_tokens_per_minute = limit_tokens_per_minute
-        self.tokens = deque()
-        self.lock = threading.Lock()
+        refill_per_sec = limit_tokens_per_minute / 60
+        if Cache.CACHE_DB_PATH:
+            self.bucket = SqliteTokenBucket(Cache.CACHE_DB_PATH, name, limit_tokens_per_minute, refill_per_sec)
+        else:
+            self.bucket = TokenBucket(limit_tokens_per_minute, refill_per_sec)
+        self._queue = asyncio.Lock()
 
-    def record(self, num_tokens):
-        cur_time = time.time()
-        with self.lock:
-            self.tokens.append((cur_time, num_tokens))
+    async def _call(self, method, *args):
+        if isinstance(self.bucket, SqliteTokenBucket):
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
 
-    def is_over_limit(self):
-        cur_time = time.time()
-        with self.lock:
-            # Remove tokens older than one minute
-            while self.tokens and cur_time - self.tokens[0][0] > 60:
-                _, num_tokens = self.tokens.popleft()
+    async def try_acquire(self, num_tokens: int) -> bool:
+        """Reserve num_tokens without waiting, unless other callers are already queued."""
+        if self._queue.locked():
+            return False
+        return await self._call(self.bucket.try_consume, num_tokens) == 0
 
-            tokens_last_minute = 0
-            # check how many tokens have been used in the last minute
-            for _, num_tokens in self.tokens:
-                tokens_last_minute += num_tokens
+    async def acquire(self, num_tokens: int, timeout_secs: float) -> bool:
+        """Reserve num_tokens, waiting in line for up to timeout_secs. Returns False if the deadline passes."""
+        deadline = time.monotonic() + timeout_secs
+        try:
+            async with asyncio.timeout(timeout_secs):
+                async with self._queue:
+                    while True:
+                        wait_secs = await self._call(self.bucket.try_consume, num_tokens)
+                        if wait_secs == 0:
+                            return True
+                        if time.monotonic() + wait_secs > deadline:
+                            return False
+                        await asyncio.sleep(min(wait_secs, self.MAX_POLL_SECS))
+        except TimeoutError:
+            return False
 
-            return tokens_last_minute >= self.limit_tokens_per_minute
+    async def record(self, num_tokens: int):
+        """Record usage beyond what was reserved, or give back unused tokens when negative."""
+        await self._call(self.bucket.consume, num_tokens)
+
+    async def headroom(self) -> float:
+        """Fraction of the quota currently available, 0 when callers are queued for it."""
+        if self._queue.locked():
+            return 0.0
+        return max(await self._call(self.bucket.available), 0) / self.limit_tokens_per_minute
 
 
 if __name__ == "__main__":
-    rate_limiter = RateLimiter(100)
-
-    print(f"is over limit 1: {rate_limiter.is_over_limit()}")
-    rate_limiter.record(90)
-    print(f"is over limit 2: {rate_limiter.is_over_limit()}")
-    rate_limiter.record(10)
-    print(f"is over limit 3: {rate_limiter.is_over_limit()}")
-    rate_limiter.record(10)
-    print(f"is over limit 4: {rate_limiter.is_over_limit()}")
-    time.sleep(61)
-    print(f"is over limit 5: {rate_limiter.is_over_limit()}")
+
+    async def main():
+        rate_limiter = RateLimiter(100)
+        print(f"acquire 90: {await rate_limiter.try_acquire(90)}")
+        print(f"acquire 20: {await rate_limiter.try_acquire(20)}")
+        await rate_limiter.record(-50)
+        print(f"acquire 20 after refunding 50: {await rate_limiter.try_acquire(20)}")
+        start = time.monotonic()
+        print(f"acquire 60 waiting up to 30s: {await rate_limiter.acquire(60, 30)}")
+        print(f"waited {time.monotonic() - start:.1f}s")
+
+    asyncio.run(main())
@@ -1,44 +1,108 @@
 import asyncio
+import codecs
+import concurrent.futures
+import contextvars
+import copy
 import html
 import httpx
-import sys
+import itertools
 import re
+import time
 import urllib.parse
-from typing import List, AsyncGenerator
-from bs4 import BeautifulSoup
-import datetime
-import groq
-
-from config import Model, Search, Secrets
-from models import StreamSearchResponse, SearchAllStage, TokenUsage
+from typing import Callable, Dict, List, AsyncGenerator, Optional, Tuple
+
+from cache_store import shared_store
+from config import Cache, Model, Search
+from extractors import ExtractionSession, get_extractor
+from http_clients import HTTP_CLIENTS
+from llm_providers import create_router
+from metrics import CACHE_LOOKUPS, LLM_TOKENS, SCRAPE_FAILURES, STAGE_SECONDS, time_stage
+from models import SearchResult, StreamSearchResponse, SearchAllStage, TokenUsage
+from passage_ranker import rank_documents
 from query_cache import QueryCache
-
-# Initialize clients
-# Workaround for groq/httpx compatibility issue
-
-http_client = httpx.AsyncClient()
-GROQ_CLIENT = groq.AsyncGroq(api_key=Secrets.GROQ_API_KEY, http_client=http_client)
+from query_keys import normalize_query
+from rate_limiter import RateLimiter
+from search_providers import SearchUnavailableError, create_web_search
+from tokenizer import allocate_budget, count_tokens, limit_tokens
+import tracing
+from tracing import print_log
+
+# Default model when Model.LLM_PROVIDERS does not configure providers
 GROQ_MODEL = 'openai/gpt-oss-20b'
-GROQ_LIMIT_TOKENS_PER_MINUTE = 30000
+GROQ_LIMIT_TOKENS_PER_MINUTE = Model.TOKENS_PER_MINUTE
+# Completion tokens reserved up front for each LLM call, settled against the reported usage afterwards
+LLM_EXPECTED_COMPLETION_TOKENS = 1000
+# How long a request may queue for TPM quota before being turned away
+LLM_ADMISSION_TIMEOUT_SECS = 10
+LLM_MAX_TOKENS = 4096
 WEBSEARCH_DOMAINS_BLACKLIST = ["quora.com", "www.quora.com"]
 WEBSEARCH_RESULT_MIN_TOKENS = 50
 WEBSEARCH_NUM_RESULTS_SLICE = 4
 WEBSEARCH_READ_TIMEOUT_SECS = 5
 WEBSEARCH_CONNECT_TIMEOUT_SECS = 3
-WEBSEARCH_CONTENT_LIMIT_TOKENS = 1000
-
-# Token character limit for scraping
-TOKEN_CHAR_LIMIT = WEBSEARCH_CONTENT_LIMIT_TOKENS * 5  # Approximate chars per token
-
-query_cache = QueryCache()
+WEBSEARCH_CONTENT_LIMIT_TOKENS = 3000
+# Scraped text is split into passages of about this many words, ranked against the prompt with BM25
+PASSAGE_WORDS = 120
+PASSAGE_TOP_K_FOR_RELEVANCE = 3
+# HTML extractor from extractors.EXTRACTORS, run in a bounded thread pool so parsing never blocks the event loop
+WEBSEARCH_HTML_EXTRACTOR = 'lxml'
+WEBSEARCH_EXTRACT_WORKERS = 4
+# Webpages are streamed in chunks and abandoned past this size, only HTML bodies are read
+WEBSEARCH_MAX_PAGE_BYTES = 2 * 1024 * 1024
+WEBSEARCH_READ_CHUNK_BYTES = 32 * 1024
+WEBSEARCH_HTML_CONTENT_TYPES = {"text/html", "application/xhtml+xml"}
+# Start the LLM stage once any of these is met, instead of waiting for the slowest webpage
+WEBSEARCH_SCRAPE_QUORUM = 3
+# Scraped tokens that fill the prompt (Model.PROMPT_TOKEN_BUDGET) with room for ranking to drop passages
+WEBSEARCH_SCRAPE_TOKEN_BUDGET = 6000
+WEBSEARCH_SCRAPE_DEADLINE_SECS = 3
+# Result pages fetched speculatively as soon as any search provider returns their links, 0 disables
+WEBSEARCH_PREFETCH_PAGES = WEBSEARCH_NUM_RESULTS_SLICE
+LLM_STREAM_FLUSH_SECS = 0.1
+# Tokens the chat template adds around the messages, on top of their content
+CHAT_FORMAT_OVERHEAD_TOKENS = 16
+
+LLM_RATE_LIMITER = RateLimiter(GROQ_LIMIT_TOKENS_PER_MINUTE, name="groq")
+LLM_ROUTER = create_router(GROQ_MODEL)
+WEB_SEARCH = create_web_search()
+
+HTML_EXTRACTOR = get_extractor(WEBSEARCH_HTML_EXTRACTOR)
+EXTRACT_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=WEBSEARCH_EXTRACT_WORKERS, thread_name_prefix="extract"
+)
+# Extraction sessions must stay on one thread, so each page is pinned to one of these single-threaded executors
+PAGE_EXTRACT_EXECUTORS = [
+    concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"extract-page-{i}")
+    for i in range(WEBSEARCH_EXTRACT_WORKERS)
+]
+page_extract_executors = itertools.cycle(PAGE_EXTRACT_EXECUTORS)
+
+# Search results by normalized query, so repeated questions skip the search API and its paid quota
+search_cache = QueryCache(
+    max_entries=Cache.SEARCH_CACHE_MAX_ENTRIES,
+    max_bytes=Cache.SEARCH_CACHE_MAX_BYTES,
+    ttl_secs=Cache.SEARCH_CACHE_TTL_SECS,
+    store=shared_store("search", Cache.SEARCH_CACHE_DB_MAX_ENTRIES, Cache.SEARCH_CACHE_DB_MAX_BYTES),
+)
+# Background refreshes of stale search results in progress, by cache key
+search_refreshes: Dict[str, asyncio.Task] = {}
+
+# Extracted webpage text by URL, with validators for conditional revalidation once stale
+page_cache = QueryCache(
+    max_entries=Cache.PAGE_CACHE_MAX_ENTRIES,
+    max_bytes=Cache.PAGE_CACHE_MAX_BYTES,
+    ttl_secs=Cache.PAGE_CACHE_TTL_SECS,
+    store=shared_store("pages", Cache.PAGE_CACHE_DB_MAX_ENTRIES, Cache.PAGE_CACHE_DB_MAX_BYTES),
+)
 
 
 class WebSearchDocument:
-    def __init__(self, id, title, url, text=''):
+    def __init__(self, id, title, url, text='', num_tokens=0):
         self.id = id
         self.title = html.escape(title)
         self.url = url
         self.text = html.escape(text)
+        self.num_tokens = num_tokens
 
     def __str__(self) -> str:
         return f"{self.title}\n{self.url}\n{self.text[:100]}"
@@ -52,115 +116,386 @@ class WebSearchDocument:
         }
 
 
-def print_log(*args, **kwargs):
-    datestr = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    print('[' + datestr + ']', *args, file=sys.stderr, **kwargs)
+def select_results(results: List[SearchResult]) -> List[SearchResult]:
+    """The results to scrape: the first WEBSEARCH_NUM_RESULTS_SLICE outside blacklisted domains."""
+    selected = []
+    for result in results:
+        link_parsed = urllib.parse.urlparse(result.link)
 
+        if link_parsed.netloc in WEBSEARCH_DOMAINS_BLACKLIST:
+            continue
 
-def limit_tokens(input_string: str, N: int) -> str:
-    tokens = input_string.split()
-    limited_tokens = tokens[:N]
-    return ' '.join(limited_tokens)
+        selected.append(result)
+        if len(selected) >= WEBSEARCH_NUM_RESULTS_SLICE:
+            break
+    return selected
 
 
-def count_tokens(input_string: str) -> int:
-    tokens = input_string.split()
-    return len(tokens)
+async def fetch_websearch_async(
+    query: str, client: httpx.AsyncClient, on_links: Optional[Callable[[List[str]], None]] = None
+) -> List[WebSearchDocument]:
+    """
+    Query the configured search providers asynchronously, raising SearchUnavailableError if all of them fail.
+    on_links is called with the links to scrape as soon as any provider has answered.
+    """
+    on_results = None
+    if on_links is not None:
 
+        def on_results(results: List[SearchResult]):
+            on_links([result.link for result in select_results(results)])
 
-async def query_websearch_async(query: str, client: httpx.AsyncClient) -> List[WebSearchDocument]:
-    """Query Google Custom Search API asynchronously."""
-    url = "https://www.googleapis.com/customsearch/v1"
-    params = {"key": Secrets.GOOGLE_SEARCH_API_KEY, "cx": Secrets.GOOGLE_SEARCH_ENGINE_ID, "q": query}
+    results = await WEB_SEARCH.search(query, client, on_results=on_results)
+    return [
+        WebSearchDocument(id=id, title=result.title, url=result.link)
+        for id, result in enumerate(select_results(results), start=1)
+    ]
 
+
+async def cache_websearch_async(cache_key: str, docs: List[WebSearchDocument]):
+    # Titles are stored unescaped, WebSearchDocument escapes them again when the entry is read
+    entry = {
+        "docs": [{"id": doc.id, "title": html.unescape(doc.title), "url": doc.url} for doc in docs],
+        "fetched_at": time.time(),
+    }
+    await search_cache.aset(cache_key, entry)
+
+
+async def has_fresh_websearch_async(query: str) -> bool:
+    """Whether query_websearch_async would answer query from search_cache without searching upstream."""
+    entry = await search_cache.apeek(normalize_query(query))
+    return entry is not None and time.time() - entry["fetched_at"] < Cache.SEARCH_CACHE_FRESH_SECS
+
+
+async def refresh_websearch_async(query: str, cache_key: str, client: httpx.AsyncClient):
     try:
-        response = await client.get(url, params=params)
-        response.raise_for_status()
-        blob = response.json()
+        docs = await fetch_websearch_async(query, client)
+        if docs:
+            await cache_websearch_async(cache_key, docs)
+    except Exception as e:
+        print_log(f"Error refreshing search results for: {query}: {e}")
+    finally:
+        search_refreshes.pop(cache_key, None)
 
-        if 'items' not in blob:
-            print(f"Error querying Google: {blob}")
-            return []
 
-        results = blob['items']
-        ret: List[WebSearchDocument] = []
-        id = 0
+async def query_websearch_async(
+    query: str, client: httpx.AsyncClient, on_links: Optional[Callable[[List[str]], None]] = None
+) -> List[WebSearchDocument]:
+    """
+    Search results for query, served from search_cache by normalized query when possible.
+    Results older than SEARCH_CACHE_FRESH_SECS are refreshed, in the background when
+    SEARCH_CACHE_STALE_WHILE_REVALIDATE is set, otherwise before returning unless the search fails.
+    """
+    cache_key = normalize_query(query)
+    entry = await search_cache.aget(cache_key)
+    if entry is None:
+        CACHE_LOOKUPS.labels("search", "miss").inc()
+    else:
+        if time.time() - entry["fetched_at"] < Cache.SEARCH_CACHE_FRESH_SECS:
+            CACHE_LOOKUPS.labels("search", "hit").inc()
+            return [WebSearchDocument(**doc) for doc in entry["docs"]]
+        CACHE_LOOKUPS.labels("search", "stale").inc()
+        search_cache.record_stale_hit()
+        if Cache.SEARCH_CACHE_STALE_WHILE_REVALIDATE:
+            if cache_key not in search_refreshes:
+                search_refreshes[cache_key] = asyncio.create_task(refresh_websearch_async(query, cache_key, client))
+            return [WebSearchDocument(**doc) for doc in entry["docs"]]
 
-        for result in results:
-            link = result['link']
-            title = result['title']
-            link_parsed = urllib.parse.urlparse(link)
+    try:
+        docs = await fetch_websearch_async(query, client, on_links)
+    except SearchUnavailableError:
+        if entry is None:
+            raise
+        print_log(f"Search failed, serving stale results for: {query}")
+        return [WebSearchDocument(**doc) for doc in entry["docs"]]
+    # Empty results may be a provider hiccup, so they are not cached
+    if docs:
+        await cache_websearch_async(cache_key, docs)
+    return docs
+
+
+meta_charset_regex = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+
+
+def sniff_encoding(response: httpx.Response, head: bytes) -> str:
+    """Encoding from the Content-Type header, else a <meta charset> near the top of the page, else UTF-8."""
+    candidates = [response.charset_encoding]
+    match = meta_charset_regex.search(head[:2048])
+    if match:
+        candidates.append(match.group(1).decode("ascii"))
+    for encoding in candidates:
+        if encoding:
+            try:
+                return codecs.lookup(encoding).name
+            except LookupError:
+                pass
+    return "utf-8"
+
+
+def is_html(content_type: str, head: bytes) -> bool:
+    """Whether a response looks like HTML, from its Content-Type or, when missing, its first bytes."""
+    if content_type:
+        return content_type.split(";")[0].strip().lower() in WEBSEARCH_HTML_CONTENT_TYPES
+    return not head.startswith(b"%PDF") and b"\x00" not in head[:512]
+
+
+def finish_extraction(session: ExtractionSession) -> Tuple[str, int]:
+    """Close an extraction session, returning its text cut to WEBSEARCH_CONTENT_LIMIT_TOKENS and its token count."""
+    text = limit_tokens(session.close(), WEBSEARCH_CONTENT_LIMIT_TOKENS)
+    return text, count_tokens(text)
+
+
+async def extract_streamed_html_async(response: httpx.Response) -> Optional[Tuple[str, int]]:
+    """
+    Stream a response body into the HTML extractor, decoding incrementally, and return the extracted
+    text with its token count. Parsing, truncation and tokenizing all run on the extract executor.
 
-            if link_parsed.netloc in WEBSEARCH_DOMAINS_BLACKLIST:
-                continue
+    Non-HTML bodies are skipped after their first chunk, returning None, and reading stops once the
+    extractor has enough text or WEBSEARCH_MAX_PAGE_BYTES have been read, which bounds memory and
+    time per page.
+    """
+    loop = asyncio.get_running_loop()
+    executor = next(page_extract_executors)
+    session = None
+    decoder = None
+    num_bytes = 0
+    extract_secs = 0.0
 
-            id += 1
-            if id > WEBSEARCH_NUM_RESULTS_SLICE:
+    try:
+        async for chunk in response.aiter_bytes(chunk_size=WEBSEARCH_READ_CHUNK_BYTES):
+            if decoder is None:
+                if not is_html(response.headers.get("content-type", ""), chunk):
+                    print_log(f"Skipping non-HTML content from {response.url}")
+                    return None
+                decoder = codecs.getincrementaldecoder(sniff_encoding(response, chunk))(errors="replace")
+                session = await loop.run_in_executor(executor, HTML_EXTRACTOR.session, WEBSEARCH_CONTENT_LIMIT_TOKENS)
+            num_bytes += len(chunk)
+            start_time = time.perf_counter()
+            done = await loop.run_in_executor(executor, session.feed, decoder.decode(chunk))
+            extract_secs += time.perf_counter() - start_time
+            if done:
+                break
+            if num_bytes >= WEBSEARCH_MAX_PAGE_BYTES:
+                print_log(f"Stopped reading {response.url} at {num_bytes} bytes")
                 break
 
-            ret.append(
-                WebSearchDocument(
-                    id=id,
-                    title=title,
-                    url=link,
-                )
+        tracing.current_span().set_attribute("http.response.bytes", num_bytes)
+        if session is None:
+            return "", 0
+        start_time = time.perf_counter()
+        closing, session = session, None
+        extracted = await loop.run_in_executor(executor, finish_extraction, closing)
+        # Time spent extracting, excluding the network time between chunks
+        STAGE_SECONDS.labels("extract").observe(extract_secs + time.perf_counter() - start_time)
+        return extracted
+    finally:
+        if session is not None:
+            # Abandoned mid-page by an error or cancellation, release the parser on its own thread
+            executor.submit(session.close)
+
+
+async def scrape_webpage_async(url: str, client: httpx.AsyncClient) -> Tuple[str, int]:
+    """
+    Scrape webpage content asynchronously, returning its text and the text's token count.
+
+    Extracted text is cached by URL. Within Cache.PAGE_CACHE_FRESH_SECS it is served as is,
+    after that the page is revalidated with a conditional GET and a 304 keeps the cached text.
+    """
+    with tracing.span("scrape", **{"url": url, "server.address": urllib.parse.urlsplit(url).hostname}) as span:
+        text, num_tokens = await _scrape_webpage_async(url, client, span)
+        span.set_attribute("text.chars", len(text))
+        return text, num_tokens
+
+
+async def cached_page_text_async(cached_page: dict) -> Tuple[str, int]:
+    text = cached_page["text"]
+    if "num_tokens" in cached_page:
+        return text, cached_page["num_tokens"]
+    # Cached before token counts were stored, counted off the event loop
+    return text, await asyncio.get_running_loop().run_in_executor(EXTRACT_EXECUTOR, count_tokens, text)
+
+
+async def _scrape_webpage_async(url: str, client: httpx.AsyncClient, span) -> Tuple[str, int]:
+    try:
+        cached_page = await page_cache.aget(url)
+        if cached_page and time.time() - cached_page["fetched_at"] < Cache.PAGE_CACHE_FRESH_SECS:
+            CACHE_LOOKUPS.labels("pages", "hit").inc()
+            span.set_attribute("cache", "hit")
+            return await cached_page_text_async(cached_page)
+        CACHE_LOOKUPS.labels("pages", "stale" if cached_page else "miss").inc()
+        span.set_attribute("cache", "stale" if cached_page else "miss")
+
+        headers = Search.DEFAULT_HEADERS
+        if cached_page:
+            page_cache.record_stale_hit()
+            headers = dict(headers)
+            if cached_page["etag"]:
+                headers["If-None-Match"] = cached_page["etag"]
+            if cached_page["last_modified"]:
+                headers["If-Modified-Since"] = cached_page["last_modified"]
+
+        with time_stage("scrape"):
+            async with client.stream(
+                "GET",
+                url,
+                timeout=httpx.Timeout(WEBSEARCH_READ_TIMEOUT_SECS, connect=WEBSEARCH_CONNECT_TIMEOUT_SECS),
+                headers=headers,
+                follow_redirects=True,
+            ) as response:
+                span.set_attribute("http.status_code", response.status_code)
+                if cached_page and response.status_code == 304:
+                    await page_cache.aset(url, {**cached_page, "fetched_at": time.time()})
+                    return await cached_page_text_async(cached_page)
+                response.raise_for_status()
+
+                extracted = await extract_streamed_html_async(response)
+
+        if extracted is None:
+            SCRAPE_FAILURES.labels("non_html").inc()
+            span.set_error("non_html")
+            return "", 0
+        main_text, num_tokens = extracted
+        if not main_text:
+            SCRAPE_FAILURES.labels("empty").inc()
+            span.set_error("empty")
+
+        if main_text and "no-store" not in response.headers.get("cache-control", ""):
+            await page_cache.aset(
+                url,
+                {
+                    "text": main_text,
+                    "num_tokens": num_tokens,
+                    "etag": response.headers.get("etag"),
+                    "last_modified": response.headers.get("last-modified"),
+                    "fetched_at": time.time(),
+                },
             )
-        return ret
+
+        return main_text, num_tokens
 
     except Exception as e:
-        print(f"Error in query_websearch_async: {e}")
-        return []
+        print_log(f"Error scraping {url}: {e}")
+        reason = scrape_failure_reason(e)
+        SCRAPE_FAILURES.labels(reason).inc()
+        span.set_error(f"{reason}: {e}")
+        return "", 0
 
 
-async def scrape_webpage_async(url: str, client: httpx.AsyncClient) -> str:
-    """Scrape webpage content asynchronously."""
-    try:
-        response = await client.get(
-            url,
-            timeout=httpx.Timeout(WEBSEARCH_READ_TIMEOUT_SECS, connect=WEBSEARCH_CONNECT_TIMEOUT_SECS),
-            headers=Search.DEFAULT_HEADERS,
-            follow_redirects=True,
-        )
-        response.raise_for_status()
+def scrape_failure_reason(e: Exception) -> str:
+    if isinstance(e, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(e, httpx.HTTPStatusError):
+        return f"http_{e.response.status_code}"
+    if isinstance(e, httpx.TransportError):
+        return "network"
+    return "error"
+
+
+async def fetch_page_async(url: str) -> Tuple[str, int]:
+    """Scrape a webpage with the pooled client, within its host's connection cap."""
+    async with HTTP_CLIENTS.host_slot(url):
+        return await scrape_webpage_async(url, HTTP_CLIENTS.scrape)
 
-        soup = BeautifulSoup(response.text, 'html.parser')
 
-        # Remove script and style elements
-        for script in soup(["script", "style"]):
-            script.decompose()
+class PagePrefetcher:
+    """
+    Page fetches started speculatively as soon as result links are known, so DNS resolution,
+    connection setup and the download itself overlap the rest of the search stage.
+    scrape_webpages_async takes over the fetches for the links it ends up scraping, the rest
+    are cancelled by retain() or aclose().
+    """
 
-        # Extract main text from the webpage
-        main_text = ' '.join([p.text for p in soup.find_all('p')])
-        main_text = limit_tokens(main_text, WEBSEARCH_CONTENT_LIMIT_TOKENS)
+    def __init__(self, max_pages: int = WEBSEARCH_PREFETCH_PAGES):
+        self.max_pages = max_pages
+        self.tasks: Dict[str, asyncio.Task] = {}
+        # Fetches run in the pipeline's context rather than that of the search stage that started them
+        self.context = contextvars.copy_context()
 
-        return main_text
+    def prefetch(self, urls: List[str]):
+        for url in urls:
+            if len(self.tasks) >= self.max_pages:
+                break
+            if url not in self.tasks:
+                self.tasks[url] = asyncio.create_task(fetch_page_async(url), context=self.context.copy())
 
-    except Exception as e:
-        print(f"Error scraping {url}: {e}")
-        return ""
+    def take(self, url: str) -> Optional[asyncio.Task]:
+        return self.tasks.pop(url, None)
 
+    def retain(self, urls: List[str]):
+        """Cancel prefetches of links that will not be scraped."""
+        for url in list(self.tasks):
+            if url not in urls:
+                self.tasks.pop(url).cancel()
 
-async def scrape_webpages_async(
-    websearch_docs: List[WebSearchDocument], max_workers: int = 5
-) -> List[WebSearchDocument]:
-    """Concurrently scrape multiple webpages with rate limiting."""
-    # Configure client with connection pooling
-    limits = httpx.Limits(max_keepalive_connections=20, max_connections=50)
-    timeout = httpx.Timeout(WEBSEARCH_READ_TIMEOUT_SECS, connect=WEBSEARCH_CONNECT_TIMEOUT_SECS)
+    async def aclose(self):
+        tasks = list(self.tasks.values())
+        self.tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
-        # Use semaphore to limit concurrent requests
-        semaphore = asyncio.Semaphore(max_workers)
 
-        async def limited_scrape(doc: WebSearchDocument):
-            async with semaphore:
-                doc.text = await scrape_webpage_async(doc.url, client)
-                return doc
+async def scrape_webpages_async(
+    websearch_docs: List[WebSearchDocument],
+    max_workers: int = 5,
+    quorum: Optional[int] = None,
+    token_budget: Optional[int] = None,
+    deadline_secs: Optional[float] = None,
+    prefetcher: Optional[PagePrefetcher] = None,
+) -> List[WebSearchDocument]:
+    """
+    Concurrently scrape multiple webpages with rate limiting.
 
-        # Gather results, preserving order
-        results = await asyncio.gather(*[limited_scrape(doc) for doc in websearch_docs], return_exceptions=False)
+    Consumes scrapes as they complete and returns once all of them are done, or earlier once
+    `quorum` usable documents or `token_budget` tokens of usable text have arrived, or once
+    `deadline_secs` has passed. Unfinished scrapes are cancelled and left out of the result.
+    Pages already being fetched by `prefetcher` are awaited instead of fetched again.
+    """
+    # Pooled client shared across requests, with per-host connection caps
+    client = HTTP_CLIENTS.scrape
+    deadline = None if deadline_secs is None else time.monotonic() + deadline_secs
+
+    # Use semaphore to limit concurrent requests
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def limited_scrape(doc: WebSearchDocument):
+        prefetch = prefetcher.take(doc.url) if prefetcher is not None else None
+        if prefetch is not None:
+            doc.text, doc.num_tokens = await prefetch
+            return doc
+        async with semaphore, HTTP_CLIENTS.host_slot(doc.url):
+            doc.text, doc.num_tokens = await scrape_webpage_async(doc.url, client)
+            return doc
+
+    pending = {asyncio.create_task(limited_scrape(doc)) for doc in websearch_docs}
+    results = []
+    num_usable_docs = 0
+    num_usable_tokens = 0
+    try:
+        while pending:
+            wait_secs = None if deadline is None else max(deadline - time.monotonic(), 0)
+            done, pending = await asyncio.wait(pending, timeout=wait_secs, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                print_log(f"Scrape deadline reached, dropping {len(pending)} unfinished webpages")
+                SCRAPE_FAILURES.labels("deadline").inc(len(pending))
+                break
+            for task in done:
+                doc = task.result()
+                results.append(doc)
+                if doc.num_tokens >= WEBSEARCH_RESULT_MIN_TOKENS:
+                    num_usable_docs += 1
+                    num_usable_tokens += doc.num_tokens
+            if (quorum is not None and num_usable_docs >= quorum) or (
+                token_budget is not None and num_usable_tokens >= token_budget
+            ):
+                break
+    finally:
+        # Cancel stragglers, their connections return to the pool
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
 
-    return results
+    # Preserve search result order
+    return sorted(results, key=lambda doc: doc.id)
 
 
 doc_id_regex = re.compile(r'DOCUMENT ID:(\d+)', re.IGNORECASE)
@@ -170,23 +505,62 @@ def replace_documents_with_markdown(text: str) -> str:
     return doc_id_regex.sub(r'**\[\1\]**', text)
 
 
-async def query_chatbot_async(user_prompt: str, websearch_docs: List[WebSearchDocument]) -> tuple[str, TokenUsage]:
-    """Query the LLM asynchronously and return response with token usage."""
-    content_docs = ""
-    for doc in websearch_docs:
-        num_tokens = count_tokens(doc.text)
-        if num_tokens < WEBSEARCH_RESULT_MIN_TOKENS:
-            continue
-        content_docs += (
-            f"====\nDOCUMENT ID:{doc.id}\n"
-            f"DOCUMENT TITLE:{doc.title}\n"
-            f"DOCUMENT URL:{doc.url}\n"
-            f"DOCUMENT TEXT:{doc.text}\n"
+def build_chatbot_messages(
+    user_prompt: str, websearch_docs: List[WebSearchDocument], relevance: Optional[List[float]] = None
+) -> List[dict]:
+    """
+    Build the chat messages for the LLM from the user prompt and scraped documents.
+
+    Documents share whatever is left of Model.PROMPT_TOKEN_BUDGET after the system prompt, question
+    and document headers, in proportion to their relevance (search rank by default), so the prompt
+    fills the budget without overflowing it.
+    """
+    if relevance is None:
+        relevance = [1 / doc.id for doc in websearch_docs]
+    ranked = [
+        (doc, weight)
+        for doc, weight in zip(websearch_docs, relevance)
+        if count_tokens(doc.text) >= WEBSEARCH_RESULT_MIN_TOKENS
+    ]
+    ranked.sort(key=lambda pair: -pair[1])
+
+    system_prefix = f"====SYSTEM PROMPT:{Model.SYSTEM_PROMPT}\n"
+    system_suffix = f"\n====QUESTION: {user_prompt}"
+    doc_headers = [
+        f"====\nDOCUMENT ID:{doc.id}\nDOCUMENT TITLE:{doc.title}\nDOCUMENT URL:{doc.url}\nDOCUMENT TEXT:"
+        for doc, _ in ranked
+    ]
+    budget = (
+        Model.PROMPT_TOKEN_BUDGET
+        - CHAT_FORMAT_OVERHEAD_TOKENS
+        - count_tokens(system_prefix)
+        - count_tokens(system_suffix)
+        - count_tokens(user_prompt)
+    )
+    header_tokens = [count_tokens(header + "\n") for header in doc_headers]
+    # Drop the least relevant documents when even their headers don't fit
+    while ranked and sum(header_tokens) > budget:
+        ranked.pop()
+        doc_headers.pop()
+        header_tokens.pop()
+
+    allocations = allocate_budget(
+        [count_tokens(doc.text) for doc, _ in ranked],
+        [weight for _, weight in ranked],
+        budget - sum(header_tokens),
+    )
+    # Keep documents in search order in the prompt
+    content_docs = "".join(
+        f"{header}{limit_tokens(doc.text, num_tokens)}\n"
+        for (doc, _), header, num_tokens in sorted(
+            zip(ranked, doc_headers, allocations), key=lambda item: item[0][0].id
         )
+        if num_tokens > 0
+    )
 
-    system_content = f"====SYSTEM PROMPT:{Model.SYSTEM_PROMPT}\n{content_docs}\n====QUESTION: {user_prompt}"
+    system_content = f"{system_prefix}{content_docs}{system_suffix}"
 
-    messages = [
+    return [
         {"role": "system", "content": system_content},
         {
             "role": "user",
@@ -194,22 +568,52 @@ async def query_chatbot_async(user_prompt: str, websearch_docs: List[WebSearchDo
         },
     ]
 
-    response = await GROQ_CLIENT.chat.completions.create(
-        model=GROQ_MODEL,
-        messages=messages,
-        max_tokens=4096,
+
+def select_passages(
+    user_prompt: str, websearch_docs: List[WebSearchDocument]
+) -> Tuple[List[WebSearchDocument], Optional[List[float]]]:
+    """
+    Rebuild each document from its passages that best match the prompt, best first, and score the
+    documents for prompt packing. Falls back to the documents as is when no passage matches.
+    """
+    ranked = rank_documents(
+        user_prompt, [doc.text for doc in websearch_docs], PASSAGE_WORDS, PASSAGE_TOP_K_FOR_RELEVANCE
     )
+    if not any(score for _, score in ranked):
+        return websearch_docs, None
 
-    response_message = response.choices[0].message.content
+    selected_docs = []
+    for doc, (text, _) in zip(websearch_docs, ranked):
+        # Copy rather than construct, the text is already escaped
+        selected_doc = copy.copy(doc)
+        selected_doc.text = text
+        selected_docs.append(selected_doc)
+    return selected_docs, [score for _, score in ranked]
 
-    # Extract token usage
-    token_usage = TokenUsage(
-        prompt_tokens=response.usage.prompt_tokens,
-        completion_tokens=response.usage.completion_tokens,
-        total_tokens=response.usage.total_tokens,
-    )
 
-    return response_message, token_usage
+def prepare_chatbot_messages(user_prompt: str, websearch_docs: List[WebSearchDocument]) -> Tuple[List[dict], int]:
+    """Pack the passages most relevant to the prompt into LLM messages, returning them with their token count."""
+    ranked_docs, relevance = select_passages(user_prompt, websearch_docs)
+    messages = build_chatbot_messages(user_prompt, ranked_docs, relevance)
+    num_tokens = sum(count_tokens(message["content"]) for message in messages) + CHAT_FORMAT_OVERHEAD_TOKENS
+    return messages, num_tokens
+
+
+async def stream_chatbot_async(
+    messages: List[dict], token_usage: TokenUsage, discarded_usage: TokenUsage, num_prompt_tokens: int
+) -> AsyncGenerator[str, None]:
+    """
+    Stream the LLM answer as incremental text chunks, adding the reported token usage to token_usage
+    and the tokens spent by abandoned hedged attempts to discarded_usage.
+    """
+    async for chunk in LLM_ROUTER.stream_chat(
+        messages,
+        LLM_MAX_TOKENS,
+        token_usage,
+        discarded_usage=discarded_usage,
+        estimated_prompt_tokens=num_prompt_tokens,
+    ):
+        yield chunk
 
 
 async def search_all_async(user_prompt: str) -> AsyncGenerator[StreamSearchResponse, None]:
@@ -218,13 +622,24 @@ async def search_all_async(user_prompt: str) -> AsyncGenerator[StreamSearchRespo
     Yields StreamSearchResponse objects for each stage.
     """
     total_token_usage = TokenUsage()
+    prefetcher = PagePrefetcher()
 
     try:
         # Stage 1: Search
         print_log(f"Starting search for: {user_prompt}")
 
-        async with httpx.AsyncClient() as client:
-            search_results = await query_websearch_async(user_prompt, client)
+        try:
+            with time_stage("search"), tracing.span("search") as span:
+                search_results = await query_websearch_async(user_prompt, HTTP_CLIENTS.search, prefetcher.prefetch)
+                span.set_attribute("results", len(search_results))
+        except SearchUnavailableError as e:
+            print_log(f"Search failed for: {user_prompt}: {e}")
+            yield StreamSearchResponse(stage=SearchAllStage.LLM, error="Web search is unavailable, try again later")
+            return
+
+        # Start on the result pages before reporting them, cached results skip the early callback
+        prefetcher.retain([doc.url for doc in search_results])
+        prefetcher.prefetch([doc.url for doc in search_results])
 
         yield StreamSearchResponse(
             stage=SearchAllStage.SEARCH,
@@ -238,7 +653,13 @@ async def search_all_async(user_prompt: str) -> AsyncGenerator[StreamSearchRespo
         # Stage 2: Scrape
         print_log(f"Scraping {len(search_results)} webpages")
 
-        scraped_docs = await scrape_webpages_async(search_results)
+        scraped_docs = await scrape_webpages_async(
+            search_results,
+            quorum=WEBSEARCH_SCRAPE_QUORUM,
+            token_budget=WEBSEARCH_SCRAPE_TOKEN_BUDGET,
+            deadline_secs=WEBSEARCH_SCRAPE_DEADLINE_SECS,
+            prefetcher=prefetcher,
+        )
 
         # Filter out empty results
         valid_docs = [doc for doc in scraped_docs if doc.text]
@@ -250,8 +671,58 @@ async def search_all_async(user_prompt: str) -> AsyncGenerator[StreamSearchRespo
         # Stage 3: LLM
         print_log(f"Querying LLM with {len(valid_docs)} documents")
 
-        response_text, token_usage = await query_chatbot_async(user_prompt, valid_docs)
-        total_token_usage.add(token_usage)
+        # Keep only the passages relevant to the prompt, ranking runs off the event loop
+        with time_stage("prompt"):
+            messages, num_prompt_tokens = await asyncio.get_running_loop().run_in_executor(
+                EXTRACT_EXECUTOR, prepare_chatbot_messages, user_prompt, valid_docs
+            )
+
+        # Reserve the expected tokens against the TPM quota, queueing briefly when it is exhausted
+        num_reserved_tokens = num_prompt_tokens + LLM_EXPECTED_COMPLETION_TOKENS
+        if not await LLM_RATE_LIMITER.try_acquire(num_reserved_tokens):
+            yield StreamSearchResponse(stage=SearchAllStage.BUSY, data={"timeout_secs": LLM_ADMISSION_TIMEOUT_SECS})
+            if not await LLM_RATE_LIMITER.acquire(num_reserved_tokens, LLM_ADMISSION_TIMEOUT_SECS):
+                print_log(f"LLM token quota exhausted, rejecting query: {user_prompt}")
+                yield StreamSearchResponse(
+                    stage=SearchAllStage.LLM,
+                    error="We're experiencing a high volume of requests at the moment. Please try again in a minute.",
+                )
+                return
+
+        # Stream partial answers, batching chunks that arrive within LLM_STREAM_FLUSH_SECS of each other
+        response_text = ""
+        pending_text = ""
+        last_flush = 0.0
+        discarded_usage = TokenUsage()
+        llm_start_time = time.perf_counter()
+        try:
+            with tracing.span("llm", **{"llm.prompt_tokens.estimated": num_prompt_tokens}) as span:
+                async for delta in stream_chatbot_async(
+                    messages, total_token_usage, discarded_usage, num_prompt_tokens
+                ):
+                    if not response_text:
+                        ttft_secs = time.perf_counter() - llm_start_time
+                        STAGE_SECONDS.labels("llm_ttft").observe(ttft_secs)
+                        span.set_attribute("llm.ttft_ms", round(ttft_secs * 1000, 1))
+                    response_text += delta
+                    pending_text += delta
+                    now = time.monotonic()
+                    if now - last_flush >= LLM_STREAM_FLUSH_SECS:
+                        yield StreamSearchResponse(
+                            stage=SearchAllStage.LLM_STREAM, data={"delta": pending_text, "response": response_text}
+                        )
+                        pending_text = ""
+                        last_flush = now
+                span.set_attribute("llm.prompt_tokens", total_token_usage.prompt_tokens)
+                span.set_attribute("llm.completion_tokens", total_token_usage.completion_tokens)
+        finally:
+            # Settle the reservation against the usage the LLM reported, and what abandoned hedges spent
+            await LLM_RATE_LIMITER.record(
+                total_token_usage.total_tokens + discarded_usage.total_tokens - num_reserved_tokens
+            )
+            LLM_TOKENS.labels("prompt").inc(total_token_usage.prompt_tokens)
+            LLM_TOKENS.labels("completion").inc(total_token_usage.completion_tokens)
+        STAGE_SECONDS.labels("llm_total").observe(time.perf_counter() - llm_start_time)
 
         yield StreamSearchResponse(
             stage=SearchAllStage.LLM,
@@ -262,3 +733,5 @@ async def search_all_async(user_prompt: str) -> AsyncGenerator[StreamSearchRespo
     except Exception as e:
         print_log(f"Error in search_all_async: {str(e)}")
         yield StreamSearchResponse(stage=SearchAllStage.LLM, error=f"Search pipeline error: {str(e)}")
+    finally:
+        await prefetcher.aclose()
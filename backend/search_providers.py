@@ -0,0 +1,248 @@
+import asyncio
+import json
+import os
+import urllib.parse
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+from config import Search, Secrets
+from models import SearchResult
+import tracing
+from tracing import print_log
+
+
+class SearchUnavailableError(Exception):
+    pass
+
+
+class SearchProvider:
+    """A web search backend. search() raises on errors and quota exhaustion, so callers can fall back."""
+
+    def __init__(self, name: str, timeout_secs: float = Search.PROVIDER_TIMEOUT_SECS):
+        self.name = name
+        self.timeout_secs = timeout_secs
+
+    async def search(self, query: str, client: httpx.AsyncClient) -> List[SearchResult]:
+        """Results for query, best first."""
+        raise NotImplementedError
+
+
+class GoogleSearchProvider(SearchProvider):
+    def __init__(
+        self,
+        name: str,
+        api_key: str,
+        engine_id: str,
+        base_url: str = "https://www.googleapis.com/customsearch/v1",
+        **kwargs,
+    ):
+        super().__init__(name, **kwargs)
+        self.api_key = api_key
+        self.engine_id = engine_id
+        self.base_url = base_url
+
+    async def search(self, query, client):
+        params = {"key": self.api_key, "cx": self.engine_id, "q": query}
+        response = await client.get(self.base_url, params=params, timeout=self.timeout_secs)
+        response.raise_for_status()
+        blob = response.json()
+        if "error" in blob:
+            raise SearchUnavailableError(f"Error querying Google: {blob['error']}")
+        # Google leaves out 'items' when nothing matched
+        return [SearchResult(**item) for item in blob.get("items", [])]
+
+
+class BraveSearchProvider(SearchProvider):
+    def __init__(
+        self, name: str, api_key: str, base_url: str = "https://api.search.brave.com/res/v1/web/search", **kwargs
+    ):
+        super().__init__(name, **kwargs)
+        self.api_key = api_key
+        self.base_url = base_url
+
+    async def search(self, query, client):
+        response = await client.get(
+            self.base_url,
+            params={"q": query},
+            headers={"Accept": "application/json", "X-Subscription-Token": self.api_key},
+            timeout=self.timeout_secs,
+        )
+        response.raise_for_status()
+        results = response.json().get("web", {}).get("results", [])
+        return [
+            SearchResult(title=result["title"], link=result["url"], snippet=result.get("description", ""))
+            for result in results
+        ]
+
+
+class SearxngSearchProvider(SearchProvider):
+    """A self-hosted SearXNG instance, with the json format enabled in its settings."""
+
+    def __init__(self, name: str, base_url: str, **kwargs):
+        super().__init__(name, **kwargs)
+        self.base_url = base_url.rstrip("/")
+
+    async def search(self, query, client):
+        response = await client.get(
+            f"{self.base_url}/search", params={"q": query, "format": "json"}, timeout=self.timeout_secs
+        )
+        response.raise_for_status()
+        return [
+            SearchResult(title=result["title"], link=result["url"], snippet=result.get("content", ""))
+            for result in response.json().get("results", [])
+        ]
+
+
+class StaticSearchProvider(SearchProvider):
+    """
+    Local stand-in serving results from a JSON file, for tests, benchmarks and offline development.
+    The file maps queries to result lists, with the "*" entry answering any other query.
+    """
+
+    def __init__(self, name: str, path: str, latency_secs: float = 0.0, **kwargs):
+        super().__init__(name, **kwargs)
+        with open(path) as f:
+            self.results: Dict[str, List[dict]] = json.load(f)
+        self.latency_secs = latency_secs
+
+    async def search(self, query, client):
+        if self.latency_secs:
+            await asyncio.sleep(self.latency_secs)
+        return [SearchResult(**result) for result in self.results.get(query, self.results.get("*", []))]
+
+
+# Query parameters that only track where a click came from
+TRACKING_PARAMS = {"fbclid", "gclid", "mc_cid", "mc_eid", "ref", "ref_src"}
+
+
+def normalize_url(url: str) -> str:
+    """Key under which different spellings of the same page's URL are deduplicated."""
+    parsed = urllib.parse.urlsplit(url.strip())
+    host = (parsed.hostname or "").lower().removeprefix("www.")
+    if parsed.port and parsed.port not in (80, 443):
+        host = f"{host}:{parsed.port}"
+    params = sorted(
+        (key, value)
+        for key, value in urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+        if not key.startswith("utm_") and key not in TRACKING_PARAMS
+    )
+    path = parsed.path.rstrip("/")
+    # Scheme is left out, http and https links to the same page are the same result
+    return f"{host}{path}" + (f"?{urllib.parse.urlencode(params)}" if params else "")
+
+
+def merge_results(result_lists: List[List[SearchResult]], rrf_k: int = 60) -> List[SearchResult]:
+    """
+    Merge ranked result lists with reciprocal rank fusion, scoring each page by the sum of
+    1 / (rrf_k + rank) over the lists it appears in, deduplicated by normalized URL.
+    Each page keeps the result from the list where it ranked best.
+    """
+    scores: Dict[str, float] = {}
+    best: Dict[str, tuple] = {}
+    for results in result_lists:
+        for rank, result in enumerate(results, start=1):
+            key = normalize_url(result.link)
+            scores[key] = scores.get(key, 0.0) + 1 / (rrf_k + rank)
+            if key not in best or rank < best[key][0]:
+                best[key] = (rank, result)
+    # Ties keep first-seen order, so a single list merges to itself
+    return [best[key][1] for key in sorted(scores, key=lambda key: -scores[key])]
+
+
+class WebSearch:
+    """
+    Queries search providers in one of two modes, each provider bounded by its own timeout:
+    "fallback" tries them in order until one returns results, "fanout" queries all of them
+    concurrently and merges the results with rank fusion. Failing providers are logged and
+    skipped, SearchUnavailableError is raised only when every provider failed.
+    """
+
+    MODES = ("fallback", "fanout")
+
+    def __init__(self, providers: List[SearchProvider], mode: str = "fallback"):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown search mode: {mode}")
+        self.providers = providers
+        self.mode = mode
+        self.failures: Dict[str, int] = {provider.name: 0 for provider in providers}
+
+    async def _search_provider(
+        self,
+        provider: SearchProvider,
+        query: str,
+        client: httpx.AsyncClient,
+        on_results: Optional[Callable[[List[SearchResult]], None]],
+    ):
+        with tracing.span("search.provider", **{"search.provider": provider.name}) as span:
+            try:
+                async with asyncio.timeout(provider.timeout_secs):
+                    results = await provider.search(query, client)
+            except Exception as e:
+                self.failures[provider.name] += 1
+                print_log(f"Search provider {provider.name} failed: {type(e).__name__} {e}")
+                span.set_error(e)
+                return None
+            span.set_attribute("results", len(results))
+        if on_results is not None and results:
+            on_results(results)
+        return results
+
+    async def search(
+        self,
+        query: str,
+        client: httpx.AsyncClient,
+        on_results: Optional[Callable[[List[SearchResult]], None]] = None,
+    ) -> List[SearchResult]:
+        """
+        Results for query. on_results is called with each provider's results as they arrive,
+        before slower providers finish, so callers can start work on the links early.
+        """
+        if self.mode == "fanout":
+            result_lists = await asyncio.gather(
+                *(self._search_provider(provider, query, client, on_results) for provider in self.providers)
+            )
+            succeeded = [results for results in result_lists if results is not None]
+            if not succeeded:
+                raise SearchUnavailableError("All search providers failed")
+            return merge_results(succeeded)
+
+        any_succeeded = False
+        for provider in self.providers:
+            results = await self._search_provider(provider, query, client, on_results)
+            if results:
+                return results
+            any_succeeded = any_succeeded or results is not None
+        if not any_succeeded:
+            raise SearchUnavailableError("All search providers failed")
+        return []
+
+
+def create_search_provider(spec: dict) -> SearchProvider:
+    """
+    Create a provider from its SEARCH_PROVIDERS entry, e.g.
+    {"type": "google"}, {"type": "brave", "api_key_env": "BRAVE_SEARCH_API_KEY"},
+    {"type": "searxng", "base_url": "http://localhost:8888"} or {"type": "static", "path": "results.json"}.
+    Any entry may set "name" and "timeout_secs".
+    """
+    spec = dict(spec)
+    provider_type = spec.pop("type")
+    spec.setdefault("name", provider_type)
+    api_key_env = spec.pop("api_key_env", None)
+    if provider_type == "google":
+        spec.setdefault("api_key", os.environ[api_key_env] if api_key_env else Secrets.GOOGLE_SEARCH_API_KEY)
+        spec.setdefault("engine_id", Secrets.GOOGLE_SEARCH_ENGINE_ID)
+        return GoogleSearchProvider(**spec)
+    if provider_type == "brave":
+        return BraveSearchProvider(api_key=os.environ[api_key_env or "BRAVE_SEARCH_API_KEY"], **spec)
+    if provider_type == "searxng":
+        return SearxngSearchProvider(**spec)
+    if provider_type == "static":
+        return StaticSearchProvider(**spec)
+    raise ValueError(f"Unknown search provider type: {provider_type}")
+
+
+def create_web_search() -> WebSearch:
+    """WebSearch over the providers in Search.PROVIDERS, or Google alone when unset."""
+    specs = json.loads(Search.PROVIDERS) if Search.PROVIDERS else [{"type": "google"}]
+    return WebSearch([create_search_provider(spec) for spec in specs], mode=Search.MODE)
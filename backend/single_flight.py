@@ -0,0 +1,80 @@
+import asyncio
+from typing import AsyncGenerator, AsyncIterator, Callable, Dict, Generic, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class _Flight(Generic[T]):
+    """One shared run of an async iterator, recording every item so late subscribers can replay them."""
+
+    def __init__(self, source: AsyncIterator[T]):
+        self.source = source
+        self.items: List[T] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    async def run(self):
+        try:
+            async for item in self.source:
+                self.items.append(item)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    def _notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def replay(self) -> AsyncGenerator[T, None]:
+        i = 0
+        while True:
+            while i < len(self.items):
+                yield self.items[i]
+                i += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self.changed.wait()
+
+
+class SingleFlight(Generic[T]):
+    """
+    Deduplicate concurrent runs of an async generator by key.
+
+    The first caller for a key starts the generator in a background task, and every caller that
+    arrives while it is still running subscribes to the same run, receiving all items from the
+    start. The run is detached from its subscribers, so it completes (and fills caches) even if
+    the client that started it disconnects.
+    """
+
+    def __init__(self):
+        self.flights: Dict[str, _Flight[T]] = {}
+        self.started = 0
+        self.joined = 0
+
+    async def subscribe(self, key: str, factory: Callable[[], AsyncIterator[T]]) -> AsyncGenerator[T, None]:
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = _Flight(factory())
+            self.flights[key] = flight
+            flight.task = asyncio.create_task(flight.run())
+            flight.task.add_done_callback(lambda _: self._finish(key, flight))
+            self.started += 1
+        else:
+            self.joined += 1
+
+        async for item in flight.replay():
+            yield item
+
+    def _finish(self, key: str, flight: _Flight[T]):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self.flights), "started": self.started, "joined": self.joined}
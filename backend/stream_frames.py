@@ -0,0 +1,293 @@
+import asyncio
+import zlib
+from typing import AsyncGenerator, AsyncIterator, Dict, List, Optional
+
+import pydantic_core
+
+from config import Search, Streaming
+from models import SearchAllStage, StreamSearchResponse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SEPARATOR = Search.JSON_STREAM_SEPARATOR.encode()
+
+FRONTEND_STAGES = {
+    SearchAllStage.SEARCH: "Querying Google",
+    SearchAllStage.SCRAPE: "Downloading Webpages",
+    SearchAllStage.BUSY: "Waiting for capacity",
+    SearchAllStage.LLM_STREAM: "Querying LLM",
+    SearchAllStage.LLM: "Results ready",
+}
+
+
+def encode_json(frame: dict) -> bytes:
+    """
+    Encode a frame for the frontend straight to UTF-8 JSON bytes with pydantic-core's encoder,
+    several times faster than json.dumps on frames carrying documents and long answers.
+    """
+    return pydantic_core.to_json(frame)
+
+
+class Transport:
+    """How frames are delimited on the wire, by default JSON objects each followed by the stream separator."""
+
+    name = "json"
+    media_type = "application/json"
+    # Sent when no frame has been sent for a while, for transports that have a no-op message
+    heartbeat: Optional[bytes] = None
+
+    def frame(self, payload: bytes) -> bytes:
+        return payload + SEPARATOR
+
+
+class SseTransport(Transport):
+    """Server-Sent Events, one "data:" event per frame, encoded JSON never contains a raw newline."""
+
+    name = "sse"
+    media_type = "text/event-stream"
+    heartbeat = b": heartbeat\n\n"
+
+    def frame(self, payload: bytes) -> bytes:
+        return b"data: " + payload + b"\n\n"
+
+
+class NdjsonTransport(Transport):
+    """Newline-delimited JSON, one frame per line."""
+
+    name = "ndjson"
+    media_type = "application/x-ndjson"
+
+    def frame(self, payload: bytes) -> bytes:
+        return payload + b"\n"
+
+
+TRANSPORTS: Dict[str, Transport] = {
+    transport.name: transport for transport in (Transport(), SseTransport(), NdjsonTransport())
+}
+ACCEPT_TRANSPORTS = {
+    "text/event-stream": "sse",
+    "application/x-ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+}
+
+
+def negotiate_transport(name: Optional[str], accept: str) -> Transport:
+    """The transport named by the request, or else the first one its Accept header lists, or else the default."""
+    if name:
+        return TRANSPORTS[name]
+    for media_range in accept.split(","):
+        transport_name = ACCEPT_TRANSPORTS.get(media_range.split(";")[0].strip().lower())
+        if transport_name:
+            return TRANSPORTS[transport_name]
+    return TRANSPORTS["json"]
+
+
+class GzipStream:
+    """Compresses a stream as one gzip member, flushed at every frame so no frame waits on the next."""
+
+    encoding = "gzip"
+
+    def __init__(self):
+        self._compressor = zlib.compressobj(Streaming.GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class BrotliStream:
+    """Compresses a stream with brotli, flushed at every frame so no frame waits on the next."""
+
+    encoding = "br"
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=Streaming.BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+def negotiate_compression(accept_encoding: str):
+    """
+    A compressor for the best encoding the Accept-Encoding header allows, brotli when the brotli
+    package is installed, then gzip, or None to send the stream uncompressed.
+    """
+    if not Streaming.COMPRESSION:
+        return None
+    accepted = set()
+    for coding in accept_encoding.split(","):
+        name, *params = [part.strip() for part in coding.split(";")]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(name.lower())
+    if brotli is not None and "br" in accepted:
+        return BrotliStream()
+    if "gzip" in accepted:
+        return GzipStream()
+    return None
+
+
+async def with_heartbeats(
+    chunks: AsyncIterator[bytes], interval_secs: float, heartbeat: bytes
+) -> AsyncGenerator[bytes, None]:
+    """
+    Yield the chunks, and the heartbeat whenever none has come for interval_secs, so proxies and
+    clients don't time out streams waiting on a slow stage. The chunks are read in one background
+    task rather than a task per chunk, so they are produced in a single context as usual.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def produce():
+        try:
+            async for chunk in chunks:
+                queue.put_nowait(chunk)
+        finally:
+            queue.put_nowait(None)
+
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(queue.get(), interval_secs)
+            except asyncio.TimeoutError:
+                yield heartbeat
+                continue
+            if chunk is None:
+                break
+            yield chunk
+        # Raises what the chunks raised, if anything
+        await task
+    finally:
+        task.cancel()
+
+
+async def write_stream(
+    chunks: AsyncIterator[bytes], transport: Transport, compressor=None
+) -> AsyncGenerator[bytes, None]:
+    """The response body for framed chunks: with the transport's heartbeats, compressed if negotiated."""
+    if transport.heartbeat is not None:
+        chunks = with_heartbeats(chunks, Streaming.HEARTBEAT_SECS, transport.heartbeat)
+    async for chunk in chunks:
+        yield compressor.compress(chunk) if compressor is not None else chunk
+    if compressor is not None:
+        yield compressor.finish()
+
+
+def frontend_frame(
+    stage: Optional[str], websearch_docs: List[Dict], answer: str = "", num_tokens_used: int = 0, error: str = None
+) -> dict:
+    return {
+        "success": error is None,
+        "stage": stage,
+        "num_tokens_used": num_tokens_used,
+        "websearch_docs": websearch_docs,
+        "answer": answer,
+        "message": error or "",
+    }
+
+
+def is_valid_url(url: str) -> bool:
+    return bool(url) and url.startswith(("http://", "https://"))
+
+
+def cached_answer_frame(cached_response: dict) -> dict:
+    """The single frame answering a prompt from the query cache, its sources listed as documents."""
+    sources = cached_response["data"].get("sources", [])
+    websearch_docs = [
+        {"id": idx + 1, "title": source.get("title", "Untitled"), "url": source["url"], "text": ""}
+        for idx, source in enumerate(sources)
+        if is_valid_url(source.get("url", ""))
+    ]
+    return frontend_frame(
+        FRONTEND_STAGES[SearchAllStage.LLM],
+        websearch_docs,
+        answer=cached_response["data"].get("response", ""),
+        num_tokens_used=(cached_response.get("token_usage") or {}).get("total_tokens", 0),
+    )
+
+
+class FrameEncoder:
+    """
+    Turns the stage responses of one stream into encoded frontend frames, keeping the search results
+    across stages. Every frame is the full frontend response by default. In delta mode, frames after
+    the first only carry the fields that changed, and a grown answer is sent as "answer_delta", the
+    text appended since the previous frame, so streamed answers are not re-sent in full every time.
+    """
+
+    def __init__(self, delta: bool = False, transport: Transport = TRANSPORTS["json"]):
+        self.delta = delta
+        self.transport = transport
+        self.websearch_docs: List[Dict] = []
+        self._sent: Optional[dict] = None
+
+    def frame(self, stage_response: StreamSearchResponse) -> dict:
+        data = stage_response.data or {}
+        answer = ""
+        num_tokens_used = 0
+
+        if stage_response.stage == SearchAllStage.SEARCH and "results" in data:
+            self.websearch_docs = [
+                {
+                    "id": result.get("id", idx + 1),
+                    "title": result.get("title", "Untitled"),
+                    "url": result["url"],
+                    "text": result.get("text", ""),
+                }
+                for idx, result in enumerate(data["results"])
+                if is_valid_url(result.get("url", ""))
+            ]
+        elif stage_response.stage in (SearchAllStage.LLM_STREAM, SearchAllStage.LLM):
+            answer = data.get("response", "")
+        if stage_response.stage == SearchAllStage.LLM:
+            if stage_response.token_usage:
+                num_tokens_used = stage_response.token_usage.get("total_tokens", 0)
+            # Titles of the scraped pages, matched by URL as failed pages have no source
+            titles = {source.get("url"): source.get("title") for source in data.get("sources", [])}
+            for doc in self.websearch_docs:
+                doc["title"] = titles.get(doc["url"]) or doc["title"]
+
+        return frontend_frame(
+            FRONTEND_STAGES[stage_response.stage],
+            self.websearch_docs,
+            answer=answer,
+            num_tokens_used=num_tokens_used,
+            error=stage_response.error,
+        )
+
+    def encode(self, stage_response: StreamSearchResponse) -> bytes:
+        return self.encode_frame(self.frame(stage_response))
+
+    def encode_frame(self, frame: dict) -> bytes:
+        if not self.delta:
+            return self.transport.frame(encode_json(frame))
+        if self._sent is None:
+            self._sent = {**frame, "websearch_docs": [dict(doc) for doc in frame["websearch_docs"]]}
+            return self.transport.frame(encode_json(frame))
+
+        changes = {}
+        for key, value in frame.items():
+            previous = self._sent[key]
+            if value == previous:
+                continue
+            if key == "answer" and previous and value.startswith(previous):
+                changes["answer_delta"] = value[len(previous) :]
+            else:
+                changes[key] = value
+        # Copies, the documents are updated in place between frames
+        self._sent = {**frame, "websearch_docs": [dict(doc) for doc in frame["websearch_docs"]]}
+        return self.transport.frame(encode_json(changes))
@@ -0,0 +1,32 @@
+import os
+import sys
+import tempfile
+
+# Modules import config, which requires the secrets, and are imported from the backend directory
+for name in ("GOOGLE_SEARCH_API_KEY", "GOOGLE_SEARCH_ENGINE_ID", "GROQ_API_KEY"):
+    os.environ.setdefault(name, "test")
+# A database of its own, so shared caches and token buckets start empty on every run
+os.environ["CACHE_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="perplexed-test-"), "cache.sqlite3")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, secs: float):
+        self.now += secs
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces time.monotonic and time.time with a clock that only moves when advanced."""
+    fake = FakeClock()
+    monkeypatch.setattr("time.monotonic", fake)
+    monkeypatch.setattr("time.time", fake)
+    return fake
@@ -0,0 +1,134 @@
+import asyncio
+import time
+
+import pytest
+
+from answer_refresher import AnswerRefresher, QueryPopularity
+from config import Refresh
+from models import SearchAllStage, StreamSearchResponse
+from query_cache import QueryCache
+from rate_limiter import RateLimiter, TokenBucket
+
+HOUR_SECS = 60 * 60
+
+
+@pytest.fixture
+def popularity(tmp_path):
+    return QueryPopularity(str(tmp_path / "popularity.sqlite3"), half_life_secs=HOUR_SECS, max_entries=100)
+
+
+class FakePipeline:
+    """Refresh and search cache callbacks, answering every prompt or failing them all."""
+
+    def __init__(self, fail: bool = False, search_cached: bool = False):
+        self.fail = fail
+        self.cached = search_cached
+        self.refreshed = []
+
+    async def refresh(self, user_prompt, cache_key):
+        self.refreshed.append(user_prompt)
+        if self.fail:
+            return StreamSearchResponse(stage=SearchAllStage.LLM, error="No search results found")
+        return StreamSearchResponse(
+            stage=SearchAllStage.LLM, data={"response": "..."}, token_usage={"total_tokens": 800}
+        )
+
+    async def search_cached(self, user_prompt):
+        return self.cached
+
+
+@pytest.fixture
+def make_refresher(popularity):
+    def make(pipeline, searches=10):
+        refresher = AnswerRefresher(
+            QueryCache(max_entries=100, max_bytes=1024 * 1024, ttl_secs=HOUR_SECS),
+            pipeline.refresh,
+            pipeline.search_cached,
+            RateLimiter(1_000_000, name="refresher-test"),
+            expected_tokens=1000,
+        )
+        refresher.popularity = popularity
+        refresher.search_budget = TokenBucket(searches, searches / HOUR_SECS)
+        return refresher
+
+    return make
+
+
+def test_popularity_decays_with_the_half_life(popularity, clock):
+    popularity.record({"old": ("Old?", 8)})
+    clock.advance(2 * HOUR_SECS)
+    popularity.record({"new": ("New?", 3)})
+
+    # 8 hits two half-lives ago count as 2
+    assert [(key, round(hits, 3)) for key, _, hits in popularity.top(10, min_hits=1)] == [("new", 3), ("old", 2)]
+    assert [key for key, _, _ in popularity.top(10, min_hits=2.5)] == ["new"]
+
+    popularity.record({"old": ("Old again?", 2)})
+    assert popularity.top(10, min_hits=1)[0] == ("old", "Old again?", pytest.approx(4))
+
+
+def test_refresh_failures_back_off_exponentially(popularity, clock):
+    popularity.record({"key": ("Prompt?", 2)})
+
+    assert popularity.record_failure("key", 60, 150) == clock.now + 60
+    assert popularity.record_failure("key", 60, 150) == clock.now + 120
+    assert popularity.record_failure("key", 60, 150) == clock.now + 150
+    popularity.clear_failures("key")
+    assert popularity.failures() == {}
+
+
+def test_popular_prompts_are_refreshed_until_the_search_budget_runs_out(make_refresher):
+    pipeline = FakePipeline()
+    refresher = make_refresher(pipeline, searches=2)
+    refresher.popularity.record({"a": ("A?", 5), "b": ("B?", 4), "c": ("C?", 3), "rare": ("Rare?", 1)})
+
+    asyncio.run(refresher.refresh_popular())
+
+    assert pipeline.refreshed == ["A?", "B?"]
+    assert (refresher.refreshed, refresher.skipped) == (2, 1)
+    # Token budget settled against the reported usage
+    assert refresher.token_budget.available() == pytest.approx(Refresh.TOKENS_PER_HOUR - 1600, abs=1)
+
+
+def test_refreshes_served_by_the_search_cache_are_not_charged_a_search(make_refresher):
+    pipeline = FakePipeline(search_cached=True)
+    refresher = make_refresher(pipeline, searches=1)
+    refresher.popularity.record({"a": ("A?", 5), "b": ("B?", 4)})
+
+    asyncio.run(refresher.refresh_popular())
+
+    assert pipeline.refreshed == ["A?", "B?"]
+    assert refresher.search_budget.available() == pytest.approx(1)
+
+
+def test_answers_still_fresh_are_left_alone(make_refresher):
+    pipeline = FakePipeline()
+    refresher = make_refresher(pipeline)
+    refresher.popularity.record({"a": ("A?", 5), "b": ("B?", 4)})
+    refresher.query_cache.set("a", {"data": {}, "cached_at": time.time()})
+
+    asyncio.run(refresher.refresh_popular())
+
+    assert pipeline.refreshed == ["B?"]
+
+
+def test_failed_refreshes_back_off_until_retry(make_refresher):
+    pipeline = FakePipeline(fail=True)
+    refresher = make_refresher(pipeline)
+    refresher.popularity.record({"a": ("A?", 5)})
+
+    asyncio.run(refresher.refresh_popular())
+    asyncio.run(refresher.refresh_popular())
+
+    assert pipeline.refreshed == ["A?"]
+    assert refresher.failed == 1
+    assert list(refresher.popularity.failures()) == ["a"]
+
+    # Once the backoff has passed the prompt is retried, and a success forgets the failures
+    refresher.popularity.clear_failures("a")
+    refresher.popularity.record_failure("a", backoff_secs=0, max_backoff_secs=0)
+    pipeline.fail = False
+    asyncio.run(refresher.refresh_popular())
+
+    assert pipeline.refreshed == ["A?", "A?"]
+    assert refresher.popularity.failures() == {}
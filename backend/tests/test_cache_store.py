@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from cache_store import SqliteCacheStore
+from query_cache import QueryCache
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SqliteCacheStore(str(tmp_path / "cache.sqlite3"), "answers", max_entries=100, max_bytes=1_000_000)
+
+
+def test_values_round_trip_through_json(store):
+    store.set("a", {"answer": "x", "sources": [1, 2]}, expires_at=1e12)
+
+    assert store.get("a") == ({"answer": "x", "sources": [1, 2]}, 1e12)
+
+
+def test_expired_entries_are_not_returned_and_are_pruned(store, clock):
+    store.set("a", "x", expires_at=clock() + 10)
+    store.set("b", "y", expires_at=clock() + 100)
+
+    clock.advance(10)
+    assert store.get("a") is None
+    store.prune()
+    assert store.stats()["entries"] == 1
+
+
+def test_prune_evicts_least_recently_accessed_entries(tmp_path, clock):
+    store = SqliteCacheStore(str(tmp_path / "cache.sqlite3"), "answers", max_entries=3, max_bytes=1_000_000)
+    for key in ("a", "b", "c", "d"):
+        store.set(key, key, expires_at=clock() + 1000)
+        clock.advance(SqliteCacheStore.TOUCH_INTERVAL_SECS + 1)
+    # Reading "a" refreshes its access time, so "b" is now the oldest
+    store.get("a")
+    store.prune()
+
+    assert store.get("b") is None
+    assert store.get("a") is not None
+    assert store.stats()["entries"] <= 3
+
+
+def test_namespaces_share_a_database_without_seeing_each_other(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    answers = SqliteCacheStore(path, "answers", max_entries=100, max_bytes=1_000_000)
+    pages = SqliteCacheStore(path, "pages", max_entries=100, max_bytes=1_000_000)
+    answers.set("a", "answer", expires_at=1e12)
+
+    assert pages.get("a") is None
+    pages.clear()
+    assert answers.get("a") is not None
+
+
+def test_query_cache_falls_back_to_the_store_and_copies_locally(store):
+    async def run():
+        writer = QueryCache(max_entries=10, max_bytes=1_000_000, ttl_secs=60, store=store)
+        reader = QueryCache(max_entries=10, max_bytes=1_000_000, ttl_secs=60, store=store)
+        await writer.aset("a", {"answer": "x"})
+
+        assert await reader.aget("a") == {"answer": "x"}
+        assert reader.store_hits == 1
+        assert reader.get("a") == {"answer": "x"}
+
+    asyncio.run(run())
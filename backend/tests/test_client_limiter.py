@@ -0,0 +1,89 @@
+import asyncio
+
+from client_limiter import ClientLimiter, ClientLimitMiddleware, client_key, parse_trusted_proxies
+
+TRUSTED = parse_trusted_proxies("127.0.0.1,::1,10.0.0.0/8")
+
+
+def scope(peer, **headers):
+    return {
+        "client": (peer, 50000),
+        "headers": [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()],
+    }
+
+
+def test_forwarding_headers_from_untrusted_peers_are_ignored():
+    assert client_key(scope("203.0.113.7", x_real_ip="198.51.100.1"), TRUSTED) == "203.0.113.7"
+    assert client_key(scope("203.0.113.7", x_forwarded_for="198.51.100.1"), TRUSTED) == "203.0.113.7"
+
+
+def test_x_real_ip_from_a_trusted_proxy_is_used():
+    assert client_key(scope("127.0.0.1", x_real_ip="198.51.100.1"), TRUSTED) == "198.51.100.1"
+
+
+def test_the_last_untrusted_forwarded_for_hop_is_the_client():
+    # The client claimed to be 192.0.2.1, a load balancer in 10/8 appended the real address
+    headers = {"x_forwarded_for": "192.0.2.1, 198.51.100.1, 10.0.0.5"}
+
+    assert client_key(scope("::1", **headers), TRUSTED) == "198.51.100.1"
+
+
+def test_requests_without_forwarding_headers_use_the_peer():
+    assert client_key(scope("127.0.0.1"), TRUSTED) == "127.0.0.1"
+    assert client_key(scope("198.51.100.1", x_real_ip="192.0.2.1")) == "198.51.100.1"
+
+
+def test_the_platform_client_ip_header_wins_behind_a_trusted_edge():
+    # A client behind Cloudflare forged X-Real-IP, the edge set CF-Connecting-IP
+    request = scope("10.1.2.3", x_real_ip="192.0.2.1", cf_connecting_ip="198.51.100.1")
+
+    assert client_key(request, TRUSTED, "CF-Connecting-IP") == "198.51.100.1"
+    assert (
+        client_key(scope("203.0.113.7", cf_connecting_ip="198.51.100.1"), TRUSTED, "CF-Connecting-IP") == "203.0.113.7"
+    )
+    # Without a platform header configured it is just another client supplied header
+    assert client_key(scope("127.0.0.1", cf_connecting_ip="198.51.100.1"), TRUSTED) == "127.0.0.1"
+
+
+def test_clients_behind_one_proxy_get_their_own_limits():
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    limiter = ClientLimiter(requests_per_minute=1, burst=1, max_concurrent_per_client=1, max_concurrent_total=10)
+    middleware = ClientLimitMiddleware(app, limiter, ["/stream_search"], "0.0.0.0/0,::/0", "CF-Connecting-IP")
+
+    def status(client_ip):
+        request = scope("10.1.2.3", cf_connecting_ip=client_ip) | {
+            "type": "http",
+            "path": "/stream_search",
+            "method": "POST",
+        }
+        statuses = []
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                statuses.append(message["status"])
+
+        asyncio.run(middleware(request, None, send))
+        return statuses[0]
+
+    assert status("198.51.100.1") == 200
+    assert status("198.51.100.2") == 200
+    assert status("198.51.100.1") == 429
+
+
+def test_clients_are_limited_by_rate_and_concurrency():
+    limiter = ClientLimiter(requests_per_minute=60, burst=2, max_concurrent_per_client=5, max_concurrent_total=10)
+
+    assert limiter.admit("a") is None
+    assert limiter.admit("a") is None
+    # Burst spent, the next token comes in a second
+    assert 0 < limiter.admit("a") <= 1
+    assert limiter.admit("b") is None
+
+    limiter = ClientLimiter(requests_per_minute=600, burst=10, max_concurrent_per_client=1, max_concurrent_total=10)
+    assert limiter.admit("a") is None
+    assert limiter.admit("a") == ClientLimiter.CONCURRENCY_RETRY_AFTER_SECS
+    limiter.release("a")
+    assert limiter.admit("a") is None
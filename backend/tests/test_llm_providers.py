@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+from llm_providers import FakeProvider, LLMRouter, LLMUnavailableError
+from models import TokenUsage
+
+MESSAGES = [{"role": "system", "content": "Answer briefly."}, {"role": "user", "content": "what is rust"}]
+
+
+async def answer(router, token_usage=None, discarded_usage=None, estimated_prompt_tokens=0):
+    chunks = router.stream_chat(
+        MESSAGES,
+        100,
+        token_usage if token_usage is not None else TokenUsage(),
+        discarded_usage=discarded_usage,
+        estimated_prompt_tokens=estimated_prompt_tokens,
+    )
+    return "".join([chunk async for chunk in chunks])
+
+
+def test_the_answer_streams_from_the_best_scored_provider():
+    slow = FakeProvider(name="slow", answer="slow answer", ttft_secs=0)
+    fast = FakeProvider(name="fast", answer="fast answer", ttft_secs=0)
+    slow.stats.ttft_secs = 2.0
+    fast.stats.ttft_secs = 0.1
+    router = LLMRouter([slow, fast])
+    token_usage = TokenUsage()
+
+    assert asyncio.run(answer(router, token_usage)) == "fast answer"
+    assert token_usage.completion_tokens == 2
+    assert fast.stats.num_requests == 1
+    assert slow.stats.num_requests == 0
+
+
+def test_failed_providers_are_skipped_and_penalized():
+    broken = FakeProvider(name="broken", failure_rate=1.0, ttft_secs=0)
+    backup = FakeProvider(name="backup", answer="backup answer", ttft_secs=0)
+    router = LLMRouter([broken, backup])
+
+    assert asyncio.run(answer(router)) == "backup answer"
+    assert broken.stats.error_rate > 0
+    assert router.ranked()[0] is backup
+
+
+def test_all_providers_failing_raises():
+    router = LLMRouter([FakeProvider(failure_rate=1.0, ttft_secs=0)])
+
+    with pytest.raises(LLMUnavailableError):
+        asyncio.run(answer(router))
+
+
+def test_a_hedge_wins_over_a_stalled_provider_and_the_loser_is_settled():
+    stalled = FakeProvider(name="stalled", answer="late answer", ttft_secs=5)
+    hedge = FakeProvider(name="hedge", answer="hedged answer", ttft_secs=0)
+    # The stalled provider looks best, so it is tried first
+    stalled.stats.ttft_secs = stalled.stats.ttft_dev_secs = 0.01
+    router = LLMRouter([stalled, hedge], hedge=True, hedge_min_delay_secs=0.05)
+    discarded_usage = TokenUsage()
+
+    assert asyncio.run(answer(router, discarded_usage=discarded_usage, estimated_prompt_tokens=120)) == "hedged answer"
+    assert router.num_hedges == 1
+    # The loser waited past the hedge delay, so its latency estimate rises, and its prompt counts as spent
+    assert stalled.stats.num_requests == 1
+    assert stalled.stats.ttft_secs > 0.01
+    assert discarded_usage.total_tokens == 120
+
+
+def test_a_stalled_primary_drops_below_its_hedge():
+    stalled = FakeProvider(name="stalled", answer="late answer", ttft_secs=5)
+    hedge = FakeProvider(name="hedge", answer="hedged answer", ttft_secs=0.02)
+    stalled.stats.ttft_secs, stalled.stats.ttft_dev_secs = 0.02, 0.005
+    hedge.stats.ttft_secs = 0.1
+    router = LLMRouter([stalled, hedge], hedge=True, hedge_min_delay_secs=0.05)
+
+    num_requests = 0
+    while router.ranked()[0] is stalled:
+        assert asyncio.run(answer(router)) == "hedged answer"
+        num_requests += 1
+        assert num_requests < 8
+
+    assert asyncio.run(answer(router)) == "hedged answer"
+    assert router.num_hedges == num_requests
+
+
+def test_exploration_tries_the_least_sampled_provider_first():
+    tried = FakeProvider(name="tried")
+    tried.stats.record_success(0.1)
+    untried = FakeProvider(name="untried")
+
+    assert LLMRouter([tried, untried]).ranked()[0] is tried
+    assert LLMRouter([tried, untried], explore_rate=1.0).ranked()[0] is untried
+
+
+def test_a_caller_going_away_records_no_latency():
+    provider = FakeProvider(ttft_secs=5)
+    router = LLMRouter([provider])
+    discarded_usage = TokenUsage()
+
+    async def run():
+        chunks = router.stream_chat(MESSAGES, 100, TokenUsage(), discarded_usage=discarded_usage)
+        first_chunk = asyncio.ensure_future(anext(chunks))
+        await asyncio.sleep(0.05)
+        first_chunk.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first_chunk
+
+    asyncio.run(run())
+    assert provider.stats.num_requests == 0
+    assert provider.stats.ttft_secs == provider.stats.INITIAL_TTFT_SECS
@@ -0,0 +1,41 @@
+from passage_ranker import bm25_scores, query_terms, rank_documents, split_passages
+
+
+def test_passages_are_whole_sentences_of_about_the_given_length():
+    text = "One two three. Four five six. Seven eight nine. Ten."
+
+    assert split_passages(text, 6) == ["One two three. Four five six.", "Seven eight nine. Ten."]
+
+
+def test_stopwords_are_dropped_unless_nothing_else_is_left():
+    assert query_terms("What is the Rust borrow checker?") == ["rust", "borrow", "checker"]
+    assert query_terms("what is it") == ["what", "is", "it"]
+
+
+def test_passages_with_more_query_terms_score_higher():
+    scores = bm25_scores(
+        "rust borrow checker",
+        [
+            "The borrow checker in Rust enforces ownership rules.",
+            "Rust is a systems programming language.",
+            "Bread is made from flour and water.",
+        ],
+    )
+
+    assert scores[0] > scores[1] > scores[2] == 0
+
+
+def test_documents_are_rebuilt_from_matching_passages_best_first():
+    texts = [
+        "Cats sleep a lot. The borrow checker tracks references. Rust has a borrow checker and lifetimes.",
+        "Bread is made from flour and water.",
+    ]
+
+    (first_text, first_relevance), (second_text, second_relevance) = rank_documents(
+        "rust borrow checker", texts, passage_words=5, top_passages=3
+    )
+    assert first_text.startswith("Rust has a borrow checker")
+    assert "Cats" not in first_text
+    assert first_relevance > 0
+    # No matching passage, the document is kept as is with no relevance
+    assert (second_text, second_relevance) == (texts[1], 0.0)
@@ -0,0 +1,40 @@
+import os
+import signal
+import time
+
+import profiler
+
+
+def wait_for(condition, timeout_secs=5.0):
+    deadline = time.monotonic() + timeout_secs
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_profiles_run_one_at_a_time():
+    first = profiler.start_profile(0.2, interval_secs=0.01)
+
+    assert first is not None
+    assert profiler.start_profile(0.2) is None
+    first.stop()
+    wait_for(lambda: not first.is_running())
+    assert first.num_samples > 0
+    assert "test_profiles_run_one_at_a_time" in first.collapsed()
+
+
+def test_a_signal_during_start_profile_does_not_deadlock(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiler.Profiling, "OUTPUT_DIR", str(tmp_path))
+    monkeypatch.setattr(profiler.Profiling, "SIGNAL_SECS", 0.05)
+    previous_handler = signal.getsignal(signal.SIGUSR2)
+    profiler.install_signal_handler()
+    try:
+        # As if the signal arrived while the main thread was inside start_profile
+        with profiler._lock:
+            os.kill(os.getpid(), signal.SIGUSR2)
+            time.sleep(0.05)
+        wait_for(lambda: os.listdir(tmp_path))
+    finally:
+        signal.signal(signal.SIGUSR2, previous_handler)
+
+    assert os.listdir(tmp_path)[0].endswith(".folded")
@@ -0,0 +1,71 @@
+from query_cache import QueryCache, approx_size
+
+
+def test_get_returns_what_was_set():
+    cache = QueryCache(max_entries=10, max_bytes=1_000_000, ttl_secs=60)
+    cache.set("a", {"answer": "x"})
+
+    assert cache.get("a") == {"answer": "x"}
+    assert cache.get("b") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_entries_expire_after_their_ttl(clock):
+    cache = QueryCache(max_entries=10, max_bytes=1_000_000, ttl_secs=60)
+    cache.set("a", "x")
+    cache.set("b", "y", ttl_secs=120)
+
+    clock.advance(60)
+    assert cache.get("a") is None
+    assert cache.get("b") == "y"
+    assert cache.expirations == 1
+    assert cache.num_bytes == approx_size("b") + approx_size("y")
+
+
+def test_least_recently_used_entry_is_evicted_first():
+    cache = QueryCache(max_entries=2, max_bytes=1_000_000, ttl_secs=60)
+    cache.set("a", "x")
+    cache.set("b", "y")
+    cache.get("a")
+    cache.set("c", "z")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "x"
+    assert cache.get("c") == "z"
+    assert cache.evictions == 1
+
+
+def test_entries_are_evicted_to_stay_within_max_bytes():
+    entry_size = approx_size("k0") + approx_size("v" * 100)
+    cache = QueryCache(max_entries=100, max_bytes=3 * entry_size, ttl_secs=60)
+    for i in range(5):
+        cache.set(f"k{i}", "v" * 100)
+
+    assert len(cache.cache) == 3
+    assert cache.num_bytes <= cache.max_bytes
+    assert cache.get("k0") is None
+    assert cache.get("k4") is not None
+
+
+def test_values_larger_than_the_cache_are_not_stored():
+    cache = QueryCache(max_entries=10, max_bytes=100, ttl_secs=60)
+    cache.set("a", "v" * 1000)
+
+    assert cache.get("a") is None
+    assert cache.num_bytes == 0
+
+
+def test_replacing_an_entry_keeps_the_byte_count_exact():
+    cache = QueryCache(max_entries=10, max_bytes=1_000_000, ttl_secs=60)
+    cache.set("a", "short")
+    cache.set("a", "a much longer value")
+    cache.delete("a")
+
+    assert cache.num_bytes == 0
+
+
+def test_stale_hits_are_reported():
+    cache = QueryCache(max_entries=10, max_bytes=1_000_000, ttl_secs=60)
+    cache.record_stale_hit()
+
+    assert cache.stats()["stale_hits"] == 1
@@ -0,0 +1,37 @@
+from query_keys import MinHashIndex, normalize_query
+
+
+def test_case_punctuation_and_whitespace_do_not_change_the_key():
+    assert normalize_query("What is Rust?") == normalize_query("what is  rust ?") == "what is rust"
+
+
+def test_meaningful_punctuation_is_kept():
+    assert normalize_query("What is C#?") == "what is c#"
+    assert normalize_query("node.js vs Deno") == "node.js vs deno"
+    assert normalize_query("Is 3.14 pi") == "is 3.14 pi"
+
+
+def test_unicode_forms_share_a_key():
+    assert normalize_query("ｃａｆé") == normalize_query("café")
+
+
+def test_similar_prompts_are_found_and_counted():
+    index = MinHashIndex(threshold=0.5)
+    index.add("how do rust ownership and borrowing rules prevent data races")
+
+    match = index.lookup("how do rust ownership and borrowing rules prevent a data race")
+    assert match is not None
+    assert match[0] == "how do rust ownership and borrowing rules prevent data races"
+    assert index.lookup("best pizza in naples") is None
+    assert index.stats() == {"entries": 1, "lookups": 2, "hits": 1}
+
+
+def test_removed_and_evicted_keys_are_not_returned():
+    index = MinHashIndex(threshold=0.5, max_entries=1)
+    index.add("what is the capital of france")
+    index.add("how tall is mount everest")
+
+    assert index.lookup("what is the capital of france") is None
+    index.remove("how tall is mount everest")
+    assert index.lookup("how tall is mount everest") is None
+    assert index.buckets == {}
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from rate_limiter import RateLimiter, SqliteTokenBucket, TokenBucket
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_bucket(request, tmp_path):
+    def make(capacity, refill_per_sec):
+        if request.param == "memory":
+            return TokenBucket(capacity, refill_per_sec)
+        return SqliteTokenBucket(str(tmp_path / "buckets.sqlite3"), "test", capacity, refill_per_sec)
+
+    return make
+
+
+def test_tokens_are_taken_until_the_bucket_is_empty(make_bucket, clock):
+    bucket = make_bucket(100, 10)
+
+    assert bucket.try_consume(60) == 0
+    # 20 tokens short at 10 per second
+    assert bucket.try_consume(60) == pytest.approx(2.0)
+    assert bucket.available() == pytest.approx(40)
+
+
+def test_the_bucket_refills_over_time_up_to_capacity(make_bucket, clock):
+    bucket = make_bucket(100, 10)
+    bucket.try_consume(100)
+
+    clock.advance(3)
+    assert bucket.available() == pytest.approx(30)
+    clock.advance(60)
+    assert bucket.available() == pytest.approx(100)
+
+
+def test_unused_reservations_are_refunded_and_overuse_is_recorded(make_bucket, clock):
+    bucket = make_bucket(100, 10)
+    bucket.try_consume(80)
+
+    bucket.consume(-50)
+    assert bucket.available() == pytest.approx(70)
+    # Usage beyond the reservation can take the level below zero
+    bucket.consume(120)
+    assert bucket.available() == pytest.approx(-50)
+    # Refunds never fill the bucket past capacity
+    bucket.consume(-1000)
+    assert bucket.available() == pytest.approx(100)
+
+
+def test_amounts_beyond_capacity_are_admitted_once_full(make_bucket, clock):
+    bucket = make_bucket(100, 10)
+
+    assert bucket.try_consume(500) == 0
+    assert bucket.available() == pytest.approx(0)
+
+
+def test_sqlite_buckets_are_shared_by_name(tmp_path, clock):
+    path = str(tmp_path / "buckets.sqlite3")
+    first = SqliteTokenBucket(path, "groq", 100, 10)
+    second = SqliteTokenBucket(path, "groq", 100, 10)
+    other = SqliteTokenBucket(path, "other", 100, 10)
+    first.try_consume(70)
+
+    assert second.available() == pytest.approx(30)
+    assert other.available() == pytest.approx(100)
+
+
+def test_rate_limiter_reserves_settles_and_reports_headroom():
+    async def run():
+        limiter = RateLimiter(1000, name="test-settle")
+        assert await limiter.try_acquire(600)
+        assert not await limiter.try_acquire(600)
+        assert await limiter.headroom() == pytest.approx(0.4, abs=0.01)
+
+        # Only 100 of the 600 reserved were used
+        await limiter.record(100 - 600)
+        assert await limiter.try_acquire(600)
+
+    asyncio.run(run())
+
+
+def test_rate_limiter_gives_up_when_the_wait_exceeds_the_deadline():
+    async def run():
+        # Refills at 1 token per second
+        limiter = RateLimiter(60, name="test-deadline")
+        assert await limiter.try_acquire(60)
+        assert not await limiter.acquire(30, timeout_secs=0.1)
+
+    asyncio.run(run())
@@ -0,0 +1,334 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import search
+from models import SearchResult
+from query_cache import QueryCache
+from search import WebSearchDocument, scrape_webpages_async
+from search_providers import SearchProvider, WebSearch
+
+
+def html_page(num_words: int, word: str = "text") -> bytes:
+    paragraphs = "".join(f"<p>{' '.join([word] * 10)}</p>" for _ in range(num_words // 10))
+    return f"<html><head><title>Page</title></head><body>{paragraphs}</body></html>".encode()
+
+
+class FakeWeb:
+    """
+    Webpages served through an httpx.MockTransport, each a body or a function of the request returning
+    the response, recording requests and the fetches cancelled midway.
+    """
+
+    def __init__(self):
+        self.pages = {}
+        self.requests = []
+        self.cancelled = []
+
+    def add(self, url, body=b"", status=200, headers=None, delay_secs=0.0):
+        headers = {"content-type": "text/html; charset=utf-8", **(headers or {})}
+        self.pages[url] = (status, {k: v for k, v in headers.items() if v is not None}, body, delay_secs)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        url = str(request.url)
+        self.requests.append(request)
+        status, headers, body, delay_secs = self.pages[url]
+        try:
+            await asyncio.sleep(delay_secs)
+        except asyncio.CancelledError:
+            self.cancelled.append(url)
+            raise
+        if callable(body):
+            return body(request)
+        return httpx.Response(status, headers=headers, content=body)
+
+    def fetched(self, url):
+        return sum(str(request.url) == url for request in self.requests)
+
+
+@pytest.fixture
+def web(monkeypatch):
+    web = FakeWeb()
+    # Fresh in-process caches, and the scrape client routed to the fake web
+    monkeypatch.setattr(search, "page_cache", QueryCache(max_entries=100, max_bytes=1024 * 1024, ttl_secs=3600))
+    monkeypatch.setattr(search, "search_cache", QueryCache(max_entries=100, max_bytes=1024 * 1024, ttl_secs=3600))
+    monkeypatch.setattr(search, "search_refreshes", {})
+    client = httpx.AsyncClient(transport=httpx.MockTransport(web.handle))
+    monkeypatch.setattr(search.HTTP_CLIENTS, "_scrape", client)
+    yield web
+    asyncio.run(client.aclose())
+
+
+def docs(*urls):
+    return [WebSearchDocument(id=i, title=f"Result {i}", url=url) for i, url in enumerate(urls, start=1)]
+
+
+def test_scraping_returns_once_the_quorum_of_usable_documents_arrives(web):
+    web.add("https://a.test/", html_page(100))
+    web.add("https://b.test/", html_page(100))
+    web.add("https://slow.test/", html_page(100), delay_secs=10)
+
+    start = time.monotonic()
+    scraped = asyncio.run(
+        scrape_webpages_async(docs("https://a.test/", "https://slow.test/", "https://b.test/"), quorum=2)
+    )
+
+    assert time.monotonic() - start < 5
+    assert [doc.url for doc in scraped] == ["https://a.test/", "https://b.test/"]
+    assert all(doc.num_tokens >= search.WEBSEARCH_RESULT_MIN_TOKENS for doc in scraped)
+    assert web.cancelled == ["https://slow.test/"]
+
+
+def test_scraping_stops_at_the_deadline(web):
+    web.add("https://a.test/", html_page(100))
+    web.add("https://slow.test/", html_page(100), delay_secs=10)
+
+    scraped = asyncio.run(scrape_webpages_async(docs("https://slow.test/", "https://a.test/"), deadline_secs=0.2))
+
+    assert [doc.url for doc in scraped] == ["https://a.test/"]
+    assert web.cancelled == ["https://slow.test/"]
+
+
+def test_scraping_waits_for_every_page_when_fewer_than_the_quorum_are_usable(web):
+    web.add("https://a.test/", html_page(100))
+    web.add("https://short.test/", html_page(10))
+    web.add("https://missing.test/", status=404)
+
+    scraped = asyncio.run(
+        scrape_webpages_async(docs("https://a.test/", "https://short.test/", "https://missing.test/"), quorum=3)
+    )
+
+    # In search result order, failed pages left empty for the caller to filter
+    assert [(doc.url, bool(doc.text)) for doc in scraped] == [
+        ("https://a.test/", True),
+        ("https://short.test/", True),
+        ("https://missing.test/", False),
+    ]
+    assert scraped[1].num_tokens < search.WEBSEARCH_RESULT_MIN_TOKENS
+    assert web.cancelled == []
+
+
+def cache_page(url, text, etag=None, age_secs=0.0):
+    search.page_cache.set(
+        url,
+        {
+            "text": text,
+            "num_tokens": len(text.split()),
+            "etag": etag,
+            "last_modified": None,
+            "fetched_at": time.time() - age_secs,
+        },
+    )
+
+
+def scrape(url):
+    return asyncio.run(search.scrape_webpage_async(url, search.HTTP_CLIENTS.scrape))
+
+
+def test_fresh_cached_pages_are_served_without_a_request(web):
+    web.add("https://a.test/", html_page(100))
+
+    first = scrape("https://a.test/")
+    assert scrape("https://a.test/") == first
+    assert web.fetched("https://a.test/") == 1
+
+
+def test_a_304_serves_the_cached_text(web):
+    cache_page("https://a.test/", "cached text", etag='"v1"', age_secs=2 * search.Cache.PAGE_CACHE_FRESH_SECS)
+
+    def not_modified(request):
+        assert request.headers["if-none-match"] == '"v1"'
+        return httpx.Response(304)
+
+    web.add("https://a.test/", not_modified)
+
+    assert scrape("https://a.test/") == ("cached text", 2)
+    # Revalidated, so fresh again
+    assert time.time() - search.page_cache.get("https://a.test/")["fetched_at"] < 60
+    assert scrape("https://a.test/") == ("cached text", 2)
+    assert web.fetched("https://a.test/") == 1
+
+
+def test_a_200_replaces_the_cached_page(web):
+    cache_page("https://a.test/", "old text", etag='"v1"', age_secs=2 * search.Cache.PAGE_CACHE_FRESH_SECS)
+    web.add("https://a.test/", html_page(100, word="new"), headers={"etag": '"v2"'})
+
+    text, num_tokens = scrape("https://a.test/")
+
+    assert text.startswith("new new")
+    cached_page = search.page_cache.get("https://a.test/")
+    assert (cached_page["text"], cached_page["num_tokens"], cached_page["etag"]) == (text, num_tokens, '"v2"')
+
+
+def test_an_empty_extraction_keeps_the_cached_page(web):
+    cache_page("https://a.test/", "old text", age_secs=2 * search.Cache.PAGE_CACHE_FRESH_SECS)
+    web.add("https://a.test/", b"<html><body><div>No paragraphs today</div></body></html>")
+
+    assert scrape("https://a.test/") == ("", 0)
+    assert search.page_cache.get("https://a.test/")["text"] == "old text"
+
+
+def extract(url):
+    async def run():
+        async with search.HTTP_CLIENTS.scrape.stream("GET", url) as response:
+            return await search.extract_streamed_html_async(response)
+
+    return asyncio.run(run())
+
+
+def test_reading_stops_at_the_byte_cap(web, monkeypatch):
+    monkeypatch.setattr(search, "WEBSEARCH_MAX_PAGE_BYTES", 64 * 1024)
+    filler = b"<div>" + b"filler " * 100 + b"</div>"
+    body = b"<html><body><p>early paragraph</p>" + filler * 1000 + b"<p>late paragraph</p></body></html>"
+    web.add("https://big.test/", body)
+
+    text, _ = extract("https://big.test/")
+
+    assert "early paragraph" in text
+    assert "late paragraph" not in text
+
+
+def test_non_html_responses_are_skipped(web):
+    web.add("https://a.test/notes.txt", b"<p>not really html</p>", headers={"content-type": "text/plain"})
+    web.add("https://a.test/paper.pdf", b"%PDF-1.7 ...", headers={"content-type": "application/pdf"})
+    web.add("https://a.test/untyped.pdf", b"%PDF-1.7 ...", headers={"content-type": None})
+
+    assert extract("https://a.test/notes.txt") is None
+    assert extract("https://a.test/paper.pdf") is None
+    assert extract("https://a.test/untyped.pdf") is None
+    assert scrape("https://a.test/notes.txt") == ("", 0)
+
+
+def test_responses_without_a_content_type_are_sniffed_as_html(web):
+    web.add("https://a.test/", html_page(20), headers={"content-type": None})
+
+    text, num_tokens = extract("https://a.test/")
+
+    assert text.startswith("text text")
+    assert num_tokens > 0
+
+
+class CountingSearchProvider(SearchProvider):
+    def __init__(self, links):
+        super().__init__("counting")
+        self.links = links
+        self.queries = []
+
+    async def search(self, query, client):
+        self.queries.append(query)
+        return [SearchResult(title=link, link=link) for link in self.links]
+
+
+@pytest.fixture
+def search_provider(monkeypatch):
+    provider = CountingSearchProvider(["https://a.test/", "https://b.test/"])
+    monkeypatch.setattr(search, "WEB_SEARCH", WebSearch([provider]))
+    return provider
+
+
+def cache_search(query, links, age_secs=0.0, ttl_secs=None):
+    entry = {
+        "docs": [{"id": i, "title": link, "url": link} for i, link in enumerate(links, start=1)],
+        "fetched_at": time.time() - age_secs,
+    }
+    search.search_cache.set(search.normalize_query(query), entry, ttl_secs=ttl_secs)
+
+
+def query_links(query):
+    return [doc.url for doc in asyncio.run(search.query_websearch_async(query, None))]
+
+
+def test_fresh_search_results_are_served_from_the_cache(web, search_provider):
+    assert query_links("What is Rust?") == ["https://a.test/", "https://b.test/"]
+    assert query_links("what is rust") == ["https://a.test/", "https://b.test/"]
+    assert search_provider.queries == ["What is Rust?"]
+
+
+def test_stale_search_results_are_served_while_one_refresh_runs(web, search_provider, monkeypatch):
+    monkeypatch.setattr(search.Cache, "SEARCH_CACHE_STALE_WHILE_REVALIDATE", True)
+    cache_search("what is rust", ["https://old.test/"], age_secs=search.Cache.SEARCH_CACHE_FRESH_SECS + 1)
+
+    async def run():
+        first = await search.query_websearch_async("What is Rust?", None)
+        second = await search.query_websearch_async("what is rust", None)
+        assert list(search.search_refreshes) == ["what is rust"]
+        await search.search_refreshes["what is rust"]
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    assert [doc.url for doc in first] == [doc.url for doc in second] == ["https://old.test/"]
+    assert search_provider.queries == ["What is Rust?"]
+    assert search.search_refreshes == {}
+    assert search.search_cache.stats()["stale_hits"] == 2
+    assert query_links("what is rust") == ["https://a.test/", "https://b.test/"]
+
+
+def test_expired_search_results_are_a_miss(web, search_provider):
+    cache_search("what is rust", ["https://old.test/"], ttl_secs=0)
+
+    assert query_links("what is rust") == ["https://a.test/", "https://b.test/"]
+    assert search_provider.queries == ["what is rust"]
+
+
+def test_a_prefetched_page_is_taken_over_by_the_scrape(web):
+    web.add("https://a.test/", html_page(100), delay_secs=0.05)
+
+    async def run():
+        prefetcher = search.PagePrefetcher()
+        prefetcher.prefetch(["https://a.test/"])
+        scraped = await scrape_webpages_async(docs("https://a.test/"), prefetcher=prefetcher)
+        assert prefetcher.tasks == {}
+        return scraped
+
+    [doc] = asyncio.run(run())
+
+    assert doc.num_tokens >= search.WEBSEARCH_RESULT_MIN_TOKENS
+    assert web.fetched("https://a.test/") == 1
+
+
+def test_prefetches_of_links_not_scraped_are_cancelled(web):
+    web.add("https://a.test/", html_page(100), delay_secs=10)
+    web.add("https://b.test/", html_page(100), delay_secs=10)
+
+    async def run():
+        prefetcher = search.PagePrefetcher(max_pages=2)
+        prefetcher.prefetch(["https://a.test/", "https://b.test/", "https://c.test/"])
+        assert list(prefetcher.tasks) == ["https://a.test/", "https://b.test/"]
+        await asyncio.sleep(0.05)
+        prefetcher.retain(["https://b.test/"])
+        await asyncio.sleep(0.05)
+        assert web.cancelled == ["https://a.test/"]
+        await prefetcher.aclose()
+
+    asyncio.run(run())
+    assert web.cancelled == ["https://a.test/", "https://b.test/"]
+
+
+def test_a_cancelled_scrape_cancels_its_prefetches(web):
+    web.add("https://a.test/", html_page(100), delay_secs=10)
+
+    async def run():
+        prefetcher = search.PagePrefetcher()
+        prefetcher.prefetch(["https://a.test/"])
+        scrape_task = asyncio.create_task(scrape_webpages_async(docs("https://a.test/"), prefetcher=prefetcher))
+        await asyncio.sleep(0.05)
+        scrape_task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await scrape_task
+
+    asyncio.run(run())
+    assert web.cancelled == ["https://a.test/"]
+    assert web.fetched("https://a.test/") == 1
+
+
+def test_links_are_reported_as_soon_as_a_provider_answers(web, search_provider):
+    search_provider.links = ["https://www.quora.com/q", "https://a.test/", "https://b.test/"]
+    reported = []
+
+    found = asyncio.run(search.fetch_websearch_async("what is rust", None, on_links=reported.append))
+
+    assert reported == [["https://a.test/", "https://b.test/"]]
+    assert [doc.url for doc in found] == ["https://a.test/", "https://b.test/"]
@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import pytest
+
+from models import SearchResult
+from search_providers import (
+    SearchUnavailableError,
+    StaticSearchProvider,
+    WebSearch,
+    merge_results,
+    normalize_url,
+)
+
+
+@pytest.fixture
+def static_provider(tmp_path):
+    def create(name, results, **kwargs):
+        path = tmp_path / f"{name}.json"
+        path.write_text(json.dumps(results))
+        return StaticSearchProvider(name, str(path), **kwargs)
+
+    return create
+
+
+def results(*links):
+    return [{"title": link, "link": link} for link in links]
+
+
+def links(search_results):
+    return [search_result.link for search_result in search_results]
+
+
+def test_url_spellings_of_the_same_page_normalize_alike():
+    assert normalize_url("https://www.Example.com/page/?utm_source=x&b=2&a=1") == "example.com/page?a=1&b=2"
+    assert normalize_url("http://example.com/page?a=1&b=2&gclid=y") == "example.com/page?a=1&b=2"
+    assert normalize_url("https://example.com:8443/page") == "example.com:8443/page"
+
+
+def test_merging_ranks_pages_found_by_several_providers_first():
+    first = [SearchResult(**r) for r in results("https://a.com", "https://b.com", "https://c.com")]
+    second = [SearchResult(**r) for r in results("https://www.c.com/", "https://d.com")]
+
+    # c.com keeps the spelling from the list where it ranked best
+    merged = merge_results([first, second])
+    assert links(merged) == ["https://www.c.com/", "https://a.com", "https://b.com", "https://d.com"]
+    assert links(merge_results([first])) == links(first)
+
+
+def test_static_provider_answers_unknown_queries_from_the_wildcard(static_provider):
+    provider = static_provider(
+        "static", {"rust": results("https://rust-lang.org"), "*": results("https://example.com")}
+    )
+
+    assert links(asyncio.run(provider.search("rust", None))) == ["https://rust-lang.org"]
+    assert links(asyncio.run(provider.search("zig", None))) == ["https://example.com"]
+
+
+def test_fallback_skips_failing_and_empty_providers(static_provider):
+    stalled = static_provider("stalled", {"*": results("https://late.com")}, latency_secs=1, timeout_secs=0.01)
+    empty = static_provider("empty", {})
+    backup = static_provider("backup", {"*": results("https://backup.com")})
+    web_search = WebSearch([stalled, empty, backup])
+
+    assert links(asyncio.run(web_search.search("rust", None))) == ["https://backup.com"]
+    assert web_search.failures == {"stalled": 1, "empty": 0, "backup": 0}
+
+
+def test_fanout_merges_every_provider_and_reports_results_early(static_provider):
+    fast = static_provider("fast", {"*": results("https://a.com", "https://b.com")})
+    slow = static_provider("slow", {"*": results("https://b.com", "https://c.com")}, latency_secs=0.01)
+    arrived = []
+
+    found = asyncio.run(WebSearch([fast, slow], mode="fanout").search("rust", None, on_results=arrived.append))
+
+    assert links(found) == ["https://b.com", "https://a.com", "https://c.com"]
+    assert [links(batch) for batch in arrived] == [
+        ["https://a.com", "https://b.com"],
+        ["https://b.com", "https://c.com"],
+    ]
+
+
+def test_search_fails_only_when_every_provider_failed(static_provider):
+    stalled = static_provider("stalled", {}, latency_secs=1, timeout_secs=0.01)
+
+    with pytest.raises(SearchUnavailableError):
+        asyncio.run(WebSearch([stalled], mode="fanout").search("rust", None))
+    assert asyncio.run(WebSearch([static_provider("empty", {})]).search("rust", None)) == []
+
+
+def test_unknown_modes_are_rejected():
+    with pytest.raises(ValueError):
+        WebSearch([], mode="roundrobin")
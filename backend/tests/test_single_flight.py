@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+async def collect(stream):
+    return [item async for item in stream]
+
+
+def test_concurrent_subscribers_share_one_run():
+    runs = []
+
+    async def source():
+        runs.append(1)
+        for i in range(3):
+            await asyncio.sleep(0.01)
+            yield i
+
+    async def run():
+        flights = SingleFlight()
+        results = await asyncio.gather(*(collect(flights.subscribe("key", source)) for _ in range(5)))
+
+        assert results == [[0, 1, 2]] * 5
+        assert len(runs) == 1
+        assert flights.stats() == {"in_flight": 0, "started": 1, "joined": 4}
+
+    asyncio.run(run())
+
+
+def test_late_subscribers_replay_items_from_the_start():
+    async def source():
+        yield "first"
+        await asyncio.sleep(0.05)
+        yield "second"
+
+    async def run():
+        flights = SingleFlight()
+        early = asyncio.create_task(collect(flights.subscribe("key", source)))
+        await asyncio.sleep(0.02)
+        late = await collect(flights.subscribe("key", source))
+
+        assert late == ["first", "second"]
+        assert await early == ["first", "second"]
+
+    asyncio.run(run())
+
+
+def test_a_finished_run_is_not_reused():
+    runs = []
+
+    async def source():
+        runs.append(1)
+        yield len(runs)
+
+    async def run():
+        flights = SingleFlight()
+        assert await collect(flights.subscribe("key", source)) == [1]
+        await asyncio.sleep(0)
+        assert await collect(flights.subscribe("key", source)) == [2]
+
+    asyncio.run(run())
+
+
+def test_errors_reach_every_subscriber():
+    async def source():
+        await asyncio.sleep(0.01)
+        yield "partial"
+        raise RuntimeError("upstream failed")
+
+    async def run():
+        flights = SingleFlight()
+        results = await asyncio.gather(
+            *(collect(flights.subscribe("key", source)) for _ in range(2)), return_exceptions=True
+        )
+        assert all(isinstance(result, RuntimeError) for result in results)
+
+    asyncio.run(run())
+
+
+def test_the_run_completes_when_its_subscriber_goes_away():
+    async def run():
+        done = asyncio.Event()
+
+        async def source():
+            await asyncio.sleep(0.02)
+            yield "answer"
+            done.set()
+
+        flights = SingleFlight()
+        subscriber = asyncio.create_task(collect(flights.subscribe("key", source)))
+        await asyncio.sleep(0.01)
+        subscriber.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await subscriber
+        await asyncio.wait_for(done.wait(), 1)
+
+    asyncio.run(run())
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import zlib
+
+import brotli
+import pytest
+
+import stream_frames
+from models import SearchAllStage, StreamSearchResponse
+from stream_frames import (
+    SEPARATOR,
+    TRANSPORTS,
+    BrotliStream,
+    FrameEncoder,
+    GzipStream,
+    negotiate_compression,
+    negotiate_transport,
+    with_heartbeats,
+    write_stream,
+)
+
+RESULTS = StreamSearchResponse(
+    stage=SearchAllStage.SEARCH,
+    data={
+        "results": [
+            {"id": 1, "title": "Rust", "url": "https://rust-lang.org", "text": ""},
+            {"id": 2, "title": "Broken", "url": "javascript:alert(1)"},
+        ]
+    },
+)
+
+
+def decode(encoded: bytes) -> dict:
+    assert encoded.endswith(SEPARATOR)
+    return json.loads(encoded[: -len(SEPARATOR)])
+
+
+def streamed(response: str) -> StreamSearchResponse:
+    return StreamSearchResponse(stage=SearchAllStage.LLM_STREAM, data={"delta": "", "response": response})
+
+
+def test_every_frame_is_the_full_response_by_default():
+    encoder = FrameEncoder()
+
+    first = decode(encoder.encode(RESULTS))
+    second = decode(encoder.encode(streamed("Rust is")))
+
+    assert first["stage"] == "Querying Google"
+    assert first["websearch_docs"] == [{"id": 1, "title": "Rust", "url": "https://rust-lang.org", "text": ""}]
+    assert second["websearch_docs"] == first["websearch_docs"]
+    assert (second["stage"], second["answer"], second["success"]) == ("Querying LLM", "Rust is", True)
+
+
+def test_delta_frames_carry_only_changes_after_a_full_first_frame():
+    encoder = FrameEncoder(delta=True)
+
+    first = decode(encoder.encode(RESULTS))
+    assert set(first) == {"success", "stage", "num_tokens_used", "websearch_docs", "answer", "message"}
+
+    # The first answer text replaces the empty answer, later text is appended
+    assert decode(encoder.encode(streamed("Rust is"))) == {"stage": "Querying LLM", "answer": "Rust is"}
+    assert decode(encoder.encode(streamed("Rust is a language"))) == {"answer_delta": " a language"}
+    # A rewritten answer is sent whole
+    assert decode(encoder.encode(streamed("Rust"))) == {"answer": "Rust"}
+
+    final = StreamSearchResponse(
+        stage=SearchAllStage.LLM,
+        data={"response": "Rust", "sources": [{"title": "The Rust Language", "url": "https://rust-lang.org"}]},
+        token_usage={"total_tokens": 1234},
+    )
+    assert decode(encoder.encode(final)) == {
+        "stage": "Results ready",
+        "num_tokens_used": 1234,
+        "websearch_docs": [{"id": 1, "title": "The Rust Language", "url": "https://rust-lang.org", "text": ""}],
+    }
+
+
+def test_errors_are_framed_as_unsuccessful():
+    encoder = FrameEncoder(delta=True, transport=TRANSPORTS["ndjson"])
+    error = StreamSearchResponse(stage=SearchAllStage.LLM, error="No search results found")
+
+    encoded = encoder.encode(error)
+
+    assert encoded.endswith(b"\n")
+    assert json.loads(encoded) == {
+        "success": False,
+        "stage": "Results ready",
+        "num_tokens_used": 0,
+        "websearch_docs": [],
+        "answer": "",
+        "message": "No search results found",
+    }
+
+
+def test_the_transport_is_named_or_negotiated_from_accept():
+    assert negotiate_transport("ndjson", "text/event-stream").name == "ndjson"
+    assert negotiate_transport(None, "text/html, Text/Event-Stream;q=0.9").name == "sse"
+    assert negotiate_transport(None, "application/jsonl").name == "ndjson"
+    assert negotiate_transport(None, "*/*").name == "json"
+    assert negotiate_transport(None, "").name == "json"
+
+
+def test_compression_prefers_brotli_then_gzip(monkeypatch):
+    assert isinstance(negotiate_compression("gzip, deflate, br"), BrotliStream)
+    assert isinstance(negotiate_compression("gzip;q=1.0, br;q=0"), GzipStream)
+    assert isinstance(negotiate_compression("GZIP"), GzipStream)
+    assert negotiate_compression("gzip;q=0, br;q=0.0") is None
+    assert negotiate_compression("gzip;q=bogus") is None
+    assert negotiate_compression("identity") is None
+    assert negotiate_compression("") is None
+
+    monkeypatch.setattr(stream_frames, "brotli", None)
+    assert isinstance(negotiate_compression("br, gzip"), GzipStream)
+    monkeypatch.setattr(stream_frames.Streaming, "COMPRESSION", False)
+    assert negotiate_compression("br, gzip") is None
+
+
+async def frames(*chunks, delay_secs=0.0, error=None):
+    for chunk in chunks:
+        await asyncio.sleep(delay_secs)
+        yield chunk
+    if error is not None:
+        raise error
+
+
+async def collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+def test_heartbeats_are_sent_while_idle():
+    chunks = asyncio.run(collect(with_heartbeats(frames(b"a", b"b", delay_secs=0.15), 0.05, b"<3")))
+
+    assert [chunk for chunk in chunks if chunk != b"<3"] == [b"a", b"b"]
+    assert chunks.index(b"a") >= 2
+    assert asyncio.run(collect(with_heartbeats(frames(b"a", b"b"), 1, b"<3"))) == [b"a", b"b"]
+
+
+def test_errors_of_the_inner_stream_reach_the_caller():
+    with pytest.raises(ValueError, match="pipeline broke"):
+        asyncio.run(collect(with_heartbeats(frames(b"a", error=ValueError("pipeline broke")), 1, b"<3")))
+    with pytest.raises(ValueError, match="pipeline broke"):
+        asyncio.run(collect(write_stream(frames(b"a", error=ValueError("pipeline broke")), TRANSPORTS["sse"])))
+
+
+def test_sse_streams_get_heartbeats_and_others_do_not(monkeypatch):
+    monkeypatch.setattr(stream_frames.Streaming, "HEARTBEAT_SECS", 0.05)
+
+    sse = asyncio.run(collect(write_stream(frames(b"a", delay_secs=0.15), TRANSPORTS["sse"])))
+    ndjson = asyncio.run(collect(write_stream(frames(b"a", delay_secs=0.15), TRANSPORTS["ndjson"])))
+
+    assert sse[-1] == b"a" and TRANSPORTS["sse"].heartbeat in sse
+    assert ndjson == [b"a"]
+
+
+@pytest.mark.parametrize(
+    "compressor, decompress",
+    [
+        (GzipStream, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS).decompress),
+        (BrotliStream, lambda: brotli.Decompressor().process),
+    ],
+)
+def test_compressed_streams_decompress_frame_by_frame(compressor, decompress):
+    encoder = FrameEncoder(transport=TRANSPORTS["ndjson"])
+    encoded = [encoder.encode(RESULTS), encoder.encode(streamed("Rust is")), encoder.encode(streamed("Rust is fast"))]
+
+    body = asyncio.run(collect(write_stream(frames(*encoded), TRANSPORTS["ndjson"], compressor())))
+
+    # Each frame decompresses in full as soon as it arrives, without waiting for the next
+    assert len(body) == len(encoded) + 1
+    decompress = decompress()
+    assert [decompress(chunk) for chunk in body] == encoded + [b""]
@@ -0,0 +1,44 @@
+import tokenizer
+from tokenizer import allocate_budget, count_tokens, limit_tokens
+
+
+def test_budget_is_split_by_weight():
+    assert allocate_budget([1000, 1000], [3, 1], 400) == [300, 100]
+
+
+def test_budget_left_by_short_documents_goes_to_the_others():
+    allocations = allocate_budget([50, 1000, 1000], [1, 1, 1], 600)
+
+    assert allocations == [50, 275, 275]
+
+
+def test_no_document_gets_more_than_its_length():
+    assert allocate_budget([10, 20], [1, 1], 1000) == [10, 20]
+
+
+def test_documents_without_weight_or_text_get_nothing():
+    assert allocate_budget([100, 0, 100], [0, 1, 1], 100) == [0, 0, 100]
+
+
+def test_rounding_leftovers_go_to_the_heaviest_documents():
+    allocations = allocate_budget([100, 100, 100], [1, 2, 1], 10)
+
+    assert sum(allocations) == 10
+    assert allocations[1] == max(allocations)
+
+
+def test_limit_tokens_truncates_to_the_budget():
+    text = " ".join(f"word{i}" for i in range(200))
+
+    assert limit_tokens(text, 10_000) == text
+    truncated = limit_tokens(text, 20)
+    assert count_tokens(truncated) <= 20
+    assert text.startswith(truncated)
+
+
+def test_encodings_cache_is_bounded():
+    tokenizer.encode.cache_clear()
+    for i in range(tokenizer.ENCODE_CACHE_SIZE * 2):
+        count_tokens(f"text number {i}")
+
+    assert tokenizer.encode.cache_info().currsize == tokenizer.ENCODE_CACHE_SIZE
@@ -0,0 +1,96 @@
+import functools
+import re
+from typing import List, Sequence
+
+from config import Model
+from tracing import print_log
+
+# Encodings kept per worker, a request's documents, passages and messages, each up to a few thousand tokens
+ENCODE_CACHE_SIZE = 32
+
+
+class _ApproximateEncoding:
+    """
+    Stand-in for a BPE encoding when tiktoken or its encoding file is unavailable: splits text
+    into word pieces of at most 4 characters plus punctuation, roughly matching BPE token counts
+    on English text. Tokens are the pieces themselves, so decode is an exact inverse.
+    """
+
+    name = "approximate"
+    piece_regex = re.compile(r"\s*\w{1,4}|\s*[^\w\s]|\s+")
+
+    def encode_ordinary(self, text: str) -> List[str]:
+        return self.piece_regex.findall(text)
+
+    def decode(self, tokens: Sequence[str]) -> str:
+        return "".join(tokens)
+
+
+def _load_encoding():
+    """
+    Load Model.TOKENIZER_ENCODING from tiktoken. tiktoken downloads encoding files on first use
+    and caches them in TIKTOKEN_CACHE_DIR, the Docker image pre-populates that cache at build time
+    so workers never need the network.
+    """
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(Model.TOKENIZER_ENCODING)
+    except Exception as e:
+        print_log(f"Falling back to approximate token counts, cannot load {Model.TOKENIZER_ENCODING}: {e}")
+        return _ApproximateEncoding()
+
+
+ENCODING = _load_encoding()
+
+
+@functools.lru_cache(maxsize=ENCODE_CACHE_SIZE)
+def encode(text: str) -> tuple:
+    """
+    Encode text into tokens, cached since the same document texts are counted and truncated repeatedly
+    while building one prompt. Only a request's worth is kept, whole page texts are too large to hold many.
+    """
+    return tuple(ENCODING.encode_ordinary(text))
+
+
+def decode(tokens: Sequence) -> str:
+    return ENCODING.decode(list(tokens))
+
+
+def count_tokens(text: str) -> int:
+    return len(encode(text))
+
+
+def limit_tokens(text: str, max_tokens: int) -> str:
+    tokens = encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return decode(tokens[:max_tokens])
+
+
+def allocate_budget(lengths: List[int], weights: List[float], budget: int) -> List[int]:
+    """
+    Split a token budget across documents in proportion to their weights, never giving a document
+    more than its length. Budget left over by short documents is redistributed to the others
+    (water-filling), so the budget is used in full whenever the documents are long enough.
+    """
+    allocations = [0] * len(lengths)
+    remaining = budget
+    active = [i for i, length in enumerate(lengths) if length > 0 and weights[i] > 0]
+    while active and remaining > 0:
+        total_weight = sum(weights[i] for i in active)
+        shares = {i: remaining * weights[i] / total_weight for i in active}
+        capped = [i for i in active if lengths[i] - allocations[i] <= shares[i]]
+        if not capped:
+            # Everyone takes their proportional share, rounding leftovers go to the most relevant documents
+            for i in active:
+                allocations[i] += int(shares[i])
+            leftover = budget - sum(allocations)
+            for i in sorted(active, key=lambda i: -weights[i])[:leftover]:
+                allocations[i] += 1
+            break
+        for i in capped:
+            remaining -= lengths[i] - allocations[i]
+            allocations[i] = lengths[i]
+        active = [i for i in active if i not in capped]
+    return allocations
@@ -0,0 +1,312 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import re
+import secrets
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional
+
+import httpx
+
+from config import Tracing
+
+# nginx's $request_id is 32 hex characters, which is exactly a trace ID
+trace_id_regex = re.compile(r"^[0-9a-f]{32}$")
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], kind: str = "internal", attributes=None):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes) if attributes else {}
+        self.error = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_error(self, error):
+        self.error = f"{type(error).__name__}: {error}" if isinstance(error, BaseException) else str(error)
+
+    def end(self):
+        self.end_ns = time.time_ns()
+        self.trace.on_span_end(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "request_id": self.trace.request_id,
+            "name": self.name,
+            "start_time": self.start_ns / 1e9,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _NoopSpan:
+    """Stands in for spans of unsampled requests, so instrumented code never checks for sampling."""
+
+    span_id = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_error(self, error):
+        pass
+
+    def end(self):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """The spans of one request. Spans ending after the request has finished are exported on their own."""
+
+    def __init__(self, request_id: str, sampled: bool):
+        self.request_id = request_id
+        self.trace_id = (
+            request_id if trace_id_regex.match(request_id) else hashlib.sha256(request_id.encode()).hexdigest()[:32]
+        )
+        self.sampled = sampled
+        self.spans: List[Span] = []
+        self.finished = False
+
+    def on_span_end(self, span: Span):
+        if self.finished:
+            EXPORTER.submit([span])
+        else:
+            self.spans.append(span)
+
+    def finish(self):
+        self.finished = True
+        if self.spans:
+            EXPORTER.submit(self.spans)
+            self.spans = []
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def is_sampled(trace_id: str) -> bool:
+    return int(trace_id[:8], 16) < Tracing.SAMPLE_RATE * 0x100000000
+
+
+def start_trace(request_id: Optional[str] = None) -> Trace:
+    """Start the trace of a request in the current context, keyed by its X-Request-ID when it has one."""
+    trace = Trace(request_id or secrets.token_hex(16), sampled=False)
+    trace.sampled = bool(Tracing.EXPORTER) and is_sampled(trace.trace_id)
+    _current_trace.set(trace)
+    _current_span.set(None)
+    return trace
+
+
+def current_request_id() -> Optional[str]:
+    trace = _current_trace.get()
+    return trace.request_id if trace else None
+
+
+def current_span():
+    return _current_span.get() or NOOP_SPAN
+
+
+def start_span(name: str, kind: str = "internal", **attributes):
+    """Start a child of the current span, to be ended by the caller. Does not become the current span."""
+    trace = _current_trace.get()
+    if trace is None or not trace.sampled:
+        return NOOP_SPAN
+    parent = _current_span.get()
+    return Span(trace, name, parent.span_id if parent else None, kind, attributes)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Run the block in a child span of the current span, recording any exception it raises."""
+    child = start_span(name, **attributes)
+    if child is NOOP_SPAN:
+        yield child
+        return
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.set_error(e)
+        raise
+    finally:
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # Generators closed from another task exit in a different context
+            pass
+        child.end()
+
+
+def print_log(*args, **kwargs):
+    datestr = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    request_id = current_request_id()
+    prefix = f"[{datestr}] [{request_id}]" if request_id else f"[{datestr}]"
+    print(prefix, *args, file=sys.stderr, **kwargs)
+
+
+class SpanExporter:
+    """Exports finished spans in the background, so requests never wait on the tracing sink."""
+
+    def __init__(self):
+        self._tasks = set()
+
+    def submit(self, spans: List[Span]):
+        try:
+            task = asyncio.get_running_loop().create_task(self._export_safely(spans))
+        except RuntimeError:
+            return
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _export_safely(self, spans: List[Span]):
+        try:
+            await self.export(spans)
+        except Exception as e:
+            print(f"Error exporting {len(spans)} spans: {e}", file=sys.stderr)
+
+    async def export(self, spans: List[Span]):
+        pass
+
+    async def aclose(self):
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class JsonFileExporter(SpanExporter):
+    """Appends one JSON object per span to a file, written in a single call per trace."""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+
+    def _write(self, text: str):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(text)
+
+    async def export(self, spans):
+        text = "".join(json.dumps(span.to_dict(), default=str) + "\n" for span in spans)
+        await asyncio.to_thread(self._write, text)
+
+
+class OtlpHttpExporter(SpanExporter):
+    """Posts spans to an OpenTelemetry collector with OTLP/HTTP in its JSON encoding."""
+
+    SPAN_KINDS = {"internal": 1, "server": 2, "client": 3}
+
+    def __init__(self, endpoint: str, service_name: str):
+        super().__init__()
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self._client = None
+
+    @staticmethod
+    def _attribute(key: str, value) -> dict:
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        return {"key": key, "value": {"stringValue": str(value)}}
+
+    def _span(self, span: Span) -> dict:
+        otlp_span = {
+            "traceId": span.trace.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": self.SPAN_KINDS[span.kind],
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [self._attribute("request.id", span.trace.request_id)]
+            + [self._attribute(key, value) for key, value in span.attributes.items()],
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+        }
+        if span.parent_id:
+            otlp_span["parentSpanId"] = span.parent_id
+        return otlp_span
+
+    async def export(self, spans):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=5)
+        body = {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [self._attribute("service.name", self.service_name)]},
+                    "scopeSpans": [{"scope": {"name": "perplexed"}, "spans": [self._span(span) for span in spans]}],
+                }
+            ]
+        }
+        response = await self._client.post(self.endpoint, json=body)
+        response.raise_for_status()
+
+    async def aclose(self):
+        await super().aclose()
+        if self._client is not None:
+            await self._client.aclose()
+
+
+def create_exporter() -> SpanExporter:
+    if Tracing.EXPORTER == "file":
+        return JsonFileExporter(Tracing.FILE_PATH)
+    if Tracing.EXPORTER == "otlp":
+        return OtlpHttpExporter(Tracing.OTLP_ENDPOINT, Tracing.SERVICE_NAME)
+    if Tracing.EXPORTER:
+        raise ValueError(f"Unknown trace exporter: {Tracing.EXPORTER}")
+    return SpanExporter()
+
+
+EXPORTER = create_exporter()
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware starting a trace per HTTP request from its X-Request-ID header (set by nginx),
+    with a server span that ends once the response body has been fully sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1").strip()
+        trace = start_trace(request_id or None)
+        root = start_span(f"{scope['method']} {scope['path']}", kind="server", **{"http.method": scope["method"]})
+        _current_span.set(root if root is not NOOP_SPAN else None)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                root.set_attribute("http.status_code", message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            root.set_error(e)
+            raise
+        finally:
+            root.end()
+            trace.finish()
@@ -12,6 +12,9 @@ export class PerplexedContainer extends Container {
     GOOGLE_SEARCH_API_KEY: this.env.GOOGLE_SEARCH_API_KEY,
     GOOGLE_SEARCH_ENGINE_ID: this.env.GOOGLE_SEARCH_ENGINE_ID,
     GROQ_API_KEY: this.env.GROQ_API_KEY,
+    // The container port is only reachable through this Worker, whose requests carry the edge's CF-Connecting-IP
+    TRUSTED_PROXIES: "0.0.0.0/0,::/0",
+    CLIENT_IP_HEADER: "CF-Connecting-IP",
   };
 };
 
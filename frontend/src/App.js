@@ -77,7 +77,8 @@ function App() {
         headers: {
           'Content-Type': 'application/json'
         },
-        body: JSON.stringify({ user_prompt: submittedUserPrompt })
+        // delta: frames after the first only carry changed fields, the answer as appended text
+        body: JSON.stringify({ user_prompt: submittedUserPrompt, delta: true })
       });
 
     } catch (error) {
@@ -100,6 +101,7 @@ function App() {
     const decoder = new TextDecoder('utf-8');
 
     let buffer = '';
+    let state = null;
 
     reader.read().then(function processText({ done, value }) {
       if (done) {
@@ -109,7 +111,7 @@ function App() {
       // console.log("processText");
       // console.log(decoder.decode(value));
 
-      buffer += decoder.decode(value);
+      buffer += decoder.decode(value, { stream: true });
       let boundary = buffer.indexOf(Constants.JSON_STREAM_SEPARATOR);
       while (boundary !== -1) {
         let input = buffer.substring(0, boundary);
@@ -117,7 +119,12 @@ function App() {
         if (input.trim() === '') {
           return;
         }
-        let result = JSON.parse(input);
+        const { answer_delta, ...changes } = JSON.parse(input);
+        state = { ...state, ...changes };
+        if (answer_delta) {
+          state.answer += answer_delta;
+        }
+        const result = state;
         boundary = buffer.indexOf(Constants.JSON_STREAM_SEPARATOR);
 
         const isSuccess = result.success;